@@ -1,50 +1,363 @@
-from flask import Flask, request, jsonify
-import requests
+from flask import Flask, request, jsonify, Response, stream_with_context, make_response
+import os
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
+from cliente_http import ClienteServicio, CircuitoAbierto
+import admision
+import instrumentacion
+import lotes
+import servicio
+from subida import SubidaMultipart, SubidaNoValida, cuerpo_multipart, TAMANO_BLOQUE
+from cola_trabajos import crear_cola_desde_entorno, ColaLlena, PRIORIDADES, TERMINADO
 
 app = Flask(__name__)
 CORS(app)  # Habilita CORS para todos los dominios
+servicio.registrar_listo(app)
+instrumentacion.registrar(app, "api")
 
 ENGINE_URL = "http://engine:5003/procesar"
+
+# Cliente con pool de conexiones keep-alive hacia el motor (configurable con MOTOR_*)
+cliente_motor = ClienteServicio.desde_entorno(
+    "MOTOR", "engine", ENGINE_URL,
+    pool=20, timeout_conexion=2, timeout_lectura=30, reintentos=1
+)
 ALLOWED_IMAGE_TYPES = {
     "image/jpeg", "image/png", "image/jpg",
     "image/bmp", "image/gif", "image/webp"
 }
 
+# Procesamiento por lotes: peticiones simultáneas al motor, elementos por lote, tamaño por imagen y total
+LOTE_CONCURRENCIA = int(os.environ.get("LOTE_CONCURRENCIA", "4"))
+LOTE_MAX_ELEMENTOS = int(os.environ.get("LOTE_MAX_ELEMENTOS", "10000"))
+LOTE_MAX_MB_IMAGEN = float(os.environ.get("LOTE_MAX_MB_IMAGEN", "16"))
+LOTE_MAX_BYTES = int(float(os.environ.get("LOTE_MAX_MB", "1024")) * 1024 * 1024)
+LOTE_TIMEOUT_S = float(os.environ.get("LOTE_TIMEOUT_S", "300"))
+
+# Límites del parser de formularios de Flask (solo lo usan los lotes; el resto de
+# subidas se leen en streaming con sus propios límites): tamaño total y número de partes
+app.config['MAX_CONTENT_LENGTH'] = LOTE_MAX_BYTES
+app.config['MAX_FORM_PARTS'] = LOTE_MAX_ELEMENTOS + 10
+
+# Tamaño máximo (MB) de la imagen de /pixelar_menores y /trabajos, comprobado mientras se lee
+MAX_MB_SUBIDA = float(os.environ.get("MAX_MB_SUBIDA", "16"))
+
+# Cola de trabajos compartida con el motor. Con MODO_SINCRONO="cola" (por defecto)
+# /pixelar_menores y los lotes también pasan por la cola; con "directo" se llama
+# al motor por HTTP como antes.
+MODO_SINCRONO = os.environ.get("MODO_SINCRONO", "cola").lower()
+SINCRONO_TIMEOUT_S = float(os.environ.get("SINCRONO_TIMEOUT_S", "30"))
+TRABAJOS_MAX_ESPERA_S = float(os.environ.get("TRABAJOS_MAX_ESPERA_S", "30"))
+cola = crear_cola_desde_entorno()
+
+# Control de admisión de /pixelar_menores: límite adaptativo de peticiones en
+# curso por proceso y clases de prioridad por clave de API (ver admision.py)
+control_admision = admision.crear_control_desde_entorno()
+if control_admision is not None:
+    instrumentacion.registrar_indicador(
+        "pixelar_admision_limite", "Límite de peticiones síncronas en curso",
+        lambda: control_admision.limite
+    )
+    instrumentacion.registrar_indicador(
+        "pixelar_admision_en_curso", "Peticiones síncronas en curso",
+        lambda: control_admision.en_curso
+    )
+    instrumentacion.registrar_indicador(
+        "pixelar_admision_rechazadas", "Peticiones rechazadas por el control de admisión",
+        lambda: sum(control_admision.estadisticas()["rechazadas"].values())
+    )
+
+def abrir_subida():
+    """
+    Empieza a leer en streaming la imagen del campo `file` (sin `request.files`)
+    y comprueba su tipo con los primeros bytes.
+
+    :return: SubidaMultipart abierta
+    :raises SubidaNoValida: Si la petición o la imagen no son válidas
+    """
+    subida = SubidaMultipart(
+        request.stream, request.headers.get('Content-Type'), 'file',
+        ALLOWED_IMAGE_TYPES, int(MAX_MB_SUBIDA * 1024 * 1024)
+    )
+    subida.abrir()
+    return subida
+
+def error_subida(e):
+    return jsonify({"error": str(e)}), e.codigo
+
+def error_cola_llena(e):
+    reintentar = control_admision.reintentar_tras() if control_admision is not None else 1
+    return jsonify({
+        "error": "Demasiados trabajos en cola, vuelva a intentarlo más tarde",
+        "detalle": str(e),
+    }), 503, {'Retry-After': str(reintentar)}
+
 @app.route("/pixelar_menores", methods=["POST"])
 def upload_image():
-    if 'file' not in request.files:
-        return jsonify({"error": "No se ha enviado ninguna imagen"}), 400
+    """
+    Pixela una imagen de forma síncrona. Si el gateway ya tiene tantas
+    peticiones en curso como permite el control de admisión, responde de
+    inmediato (sin leer la imagen) con 503, o con 429 si lo que está completo
+    es la cuota de la clase de la petición, y `Retry-After`.
+    """
+    if control_admision is None:
+        return pixelar_sincrono()
 
-    file = request.files['file']
-    if file.content_type not in ALLOWED_IMAGE_TYPES:
+    clase = control_admision.clase(request.headers.get(admision.CABECERA_CLAVE))
+    permiso, codigo = control_admision.admitir(clase)
+    if permiso is None:
         return jsonify({
-            "error": f"Tipo de archivo no permitido: {file.content_type}. "
-                     "Use PNG, JPG, JPEG, BMP, GIF o WEBP."
-        }), 400
+            "error": "Servicio saturado, vuelva a intentarlo más tarde",
+            "clase": clase,
+        }), codigo, {'Retry-After': str(control_admision.reintentar_tras())}
 
-    # Verificar si está activado el modo debug
-    debug_mode = request.form.get('debug', 'false').lower() == 'true'
+    try:
+        respuesta = make_response(pixelar_sincrono())
+    except BaseException:
+        permiso.terminar(500)
+        raise
+    # La plaza se libera al terminar de enviar la respuesta (que puede ir en streaming)
+    respuesta.call_on_close(lambda: permiso.terminar(respuesta.status_code))
+    return respuesta
 
+def pixelar_sincrono():
     try:
-        if debug_mode:
-            res = requests.post(
-                ENGINE_URL,
-                files={"imagen": (file.filename, file.read(), file.content_type)},
-                data={"debug": "true"},
-                timeout=30
-            )
-        else:
-            res = requests.post(
-                ENGINE_URL,
-                files={"imagen": (file.filename, file.read(), file.content_type)},
-                timeout=30
+        subida = abrir_subida()
+    except SubidaNoValida as e:
+        return error_subida(e)
+
+    if MODO_SINCRONO == "cola":
+        # La cola guarda la imagen completa: se lee (con el límite de tamaño) una sola vez
+        try:
+            datos = subida.leer()
+        except SubidaNoValida as e:
+            return error_subida(e)
+        # Verificar si está activado el modo debug
+        debug_mode = subida.campos.get('debug', 'false').lower() == 'true'
+
+        # Petición interactiva: carril de prioridad alta y espera al resultado. El plazo
+        # evita que el motor procese (y la cola guarde) imágenes que ya nadie espera
+        try:
+            id_trabajo = cola.encolar(
+                subida.nombre_archivo, subida.tipo, datos, debug_mode, PRIORIDADES["alta"],
+                instrumentacion.id_traza(), plazo=SINCRONO_TIMEOUT_S
             )
+        except ColaLlena as e:
+            return error_cola_llena(e)
+        # Espera en cola más procesamiento en el motor
+        with instrumentacion.medir("cola"):
+            trabajo = cola.esperar(id_trabajo, SINCRONO_TIMEOUT_S)
+        if trabajo is not None and trabajo["estado"] != TERMINADO:
+            # Si el motor aún no lo ha empezado se descarta; si está en curso se puede consultar después
+            if cola.cancelar(id_trabajo):
+                return jsonify({"error": "El motor no ha podido atender la petición a tiempo"}), 504
+            return jsonify({
+                "error": "El motor no ha terminado a tiempo; el resultado puede consultarse más tarde",
+                "id": id_trabajo,
+                "url": f"/trabajos/{id_trabajo}",
+            }), 504
+        return respuesta_trabajo(trabajo)
+
+    # La imagen se reenvía al motor según llega (chunked) y su respuesta se devuelve
+    # según llega, así que en memoria solo hay unos pocos bloques por petición
+    tipo_cuerpo, cuerpo = cuerpo_multipart(subida, 'imagen', ('debug',))
+    res = None
+    try:
+        res = cliente_motor.post(
+            data=cuerpo, headers={'Content-Type': tipo_cuerpo}, stream=True, reintentar=False
+        )
         res.raise_for_status()
-        return res.content, res.status_code, {'Content-Type': res.headers.get('Content-Type', 'application/json')}
+        cabeceras = {'Content-Type': res.headers.get('Content-Type', 'application/json')}
+        if 'Content-Length' in res.headers:
+            cabeceras['Content-Length'] = res.headers['Content-Length']
+        # Tiempos por etapa del motor (instrumentacion añade después los del gateway)
+        if 'Server-Timing' in res.headers:
+            cabeceras['Server-Timing'] = res.headers['Server-Timing']
+        return Response(stream_with_context(reenviar(res)), status=res.status_code, headers=cabeceras)
+    except SubidaNoValida as e:
+        return error_subida(e)
+    except CircuitoAbierto as e:
+        return jsonify({"error": "Motor no disponible", "detalle": str(e)}), 503
     except Exception as e:
+        if res is not None:
+            res.close()
         return jsonify({"error": "Error al contactar con el motor", "detalle": str(e)}), 500
 
+def reenviar(res):
+    """
+    Devuelve el cuerpo de la respuesta del motor bloque a bloque y cierra la conexión al terminar.
+    """
+    try:
+        yield from res.iter_content(TAMANO_BLOQUE)
+    finally:
+        res.close()
+
+@app.route("/trabajos", methods=["POST"])
+def crear_trabajo():
+    """
+    Encola una imagen y responde de inmediato con el identificador del trabajo.
+    El resultado se consulta con GET /trabajos/<id>.
+    """
+    try:
+        subida = abrir_subida()
+        datos = subida.leer()
+    except SubidaNoValida as e:
+        return error_subida(e)
+
+    prioridad = subida.campos.get('prioridad', 'normal').lower()
+    if prioridad not in ('normal', 'baja'):
+        return jsonify({"error": "La prioridad debe ser 'normal' o 'baja'"}), 400
+
+    debug_mode = subida.campos.get('debug', 'false').lower() == 'true'
+    try:
+        id_trabajo = cola.encolar(
+            subida.nombre_archivo, subida.tipo, datos, debug_mode, PRIORIDADES[prioridad], instrumentacion.id_traza()
+        )
+    except ColaLlena as e:
+        return error_cola_llena(e)
+    url = f"/trabajos/{id_trabajo}"
+    return jsonify({"id": id_trabajo, "estado": "pendiente", "url": url}), 202, {'Location': url}
+
+@app.route("/trabajos/<id_trabajo>", methods=["GET"])
+def consultar_trabajo(id_trabajo):
+    """
+    Devuelve el resultado de un trabajo terminado o su estado si aún no ha
+    terminado (202). Con `?esperar=N` espera hasta N segundos a que termine.
+    """
+    try:
+        espera = float(request.args.get('esperar', '0'))
+    except ValueError:
+        return jsonify({"error": "'esperar' debe ser un número de segundos"}), 400
+    espera = min(max(espera, 0.0), TRABAJOS_MAX_ESPERA_S)
+
+    if espera > 0:
+        trabajo = cola.esperar(id_trabajo, espera)
+    else:
+        trabajo = cola.obtener(id_trabajo)
+    return respuesta_trabajo(trabajo)
+
+@app.route("/trabajos", methods=["GET"])
+def estado_cola():
+    return jsonify(cola.estadisticas()), 200
+
+def respuesta_trabajo(trabajo):
+    """
+    Convierte un trabajo de la cola en la respuesta HTTP: el resultado tal cual
+    lo devolvió el motor si ha terminado, 202 con su estado si no, o 404.
+    """
+    if trabajo is None:
+        return jsonify({"error": "Trabajo no encontrado o caducado"}), 404
+    if trabajo["estado"] != TERMINADO:
+        estado = {k: v for k, v in trabajo.items() if k in ("id", "estado", "posicion")}
+        return jsonify(estado), 202
+    cabeceras = {'X-Trabajo-Id': trabajo["id"]}
+    # Tiempos por etapa del motor (instrumentacion añade después los del gateway)
+    if trabajo.get("server_timing"):
+        cabeceras['Server-Timing'] = trabajo["server_timing"]
+    return Response(
+        trabajo["resultado"], status=trabajo["codigo"], content_type=trabajo["tipo"], headers=cabeceras
+    )
+
+def procesar_en_motor(nombre, datos, tipo):
+    """
+    Envía una imagen del lote al motor.
+
+    :return: Tupla (tipo MIME, bytes) de la respuesta
+    :raises Exception: Si el motor no responde correctamente
+    """
+    if tipo not in ALLOWED_IMAGE_TYPES:
+        raise ValueError(f"Tipo de archivo no permitido: {tipo}")
+    if MODO_SINCRONO == "cola":
+        # Los lotes van por el carril de prioridad baja para no retrasar las peticiones interactivas
+        id_trabajo = cola.encolar(nombre, tipo, datos, False, PRIORIDADES["baja"], plazo=LOTE_TIMEOUT_S)
+        trabajo = cola.esperar(id_trabajo, LOTE_TIMEOUT_S)
+        if trabajo is None or trabajo["estado"] != TERMINADO:
+            cola.cancelar(id_trabajo)
+            raise RuntimeError("El motor no ha terminado a tiempo")
+        if trabajo["codigo"] != 200:
+            raise RuntimeError(f"Error del motor ({trabajo['codigo']}): {trabajo['resultado'][:500].decode('utf-8', 'replace')}")
+        return trabajo["tipo"], trabajo["resultado"]
+    res = cliente_motor.post(files={"imagen": (nombre, datos, tipo)})
+    if res.status_code != 200:
+        raise RuntimeError(f"Error del motor ({res.status_code}): {res.text[:500]}")
+    return res.headers.get('Content-Type', 'image/jpeg'), res.content
+
+@app.route("/pixelar_menores/lote", methods=["POST"])
+def upload_batch():
+    """
+    Procesa un lote de imágenes (varios archivos en `files` o un zip/tar en `archivo`)
+    y devuelve los resultados en streaming según terminan, como `multipart/mixed`
+    (por defecto) o como zip (`formato=zip`). Los errores de cada imagen se informan
+    en línea sin interrumpir el lote.
+    """
+    demasiado_grande = jsonify({"error": f"El lote excede el límite de {LOTE_MAX_BYTES // (1024 * 1024)} MB"}), 413
+    # Se comprueba antes de leer el cuerpo; sin Content-Length (chunked) lo corta MAX_CONTENT_LENGTH al leerlo
+    if request.content_length is not None and request.content_length > LOTE_MAX_BYTES:
+        return demasiado_grande
+    try:
+        request.files
+    except RequestEntityTooLarge:
+        return jsonify({"error": "El lote es demasiado grande o tiene demasiadas partes"}), 413
+
+    formato = request.args.get('formato', request.form.get('formato', 'multipart')).lower()
+    if formato not in ('multipart', 'zip'):
+        return jsonify({"error": "El formato debe ser 'multipart' o 'zip'"}), 400
+
+    try:
+        concurrencia = int(request.args.get('concurrencia', LOTE_CONCURRENCIA))
+    except ValueError:
+        return jsonify({"error": "La concurrencia debe ser un entero"}), 400
+    concurrencia = min(max(concurrencia, 1), LOTE_CONCURRENCIA)
+
+    max_bytes = int(LOTE_MAX_MB_IMAGEN * 1024 * 1024)
+    if 'archivo' in request.files:
+        try:
+            elementos = lotes.elementos_comprimido(request.files['archivo'], max_bytes, LOTE_MAX_ELEMENTOS)
+            # Se valida el formato del archivo antes de empezar a responder
+            primero = next(elementos, None)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if primero is not None:
+            elementos = _encadenar(primero, elementos)
+        else:
+            elementos = iter(())
+    elif 'files' in request.files:
+        archivos = request.files.getlist('files')
+        if len(archivos) > LOTE_MAX_ELEMENTOS:
+            return jsonify({"error": f"El lote supera el máximo de {LOTE_MAX_ELEMENTOS} elementos"}), 400
+        elementos = lotes.elementos_archivos(archivos, max_bytes)
+    else:
+        return jsonify({"error": "No se ha enviado ningún lote (use 'files' o 'archivo')"}), 400
+
+    resultados = lotes.procesar_lote(elementos, procesar_en_motor, concurrencia, LOTE_MAX_ELEMENTOS)
+
+    if formato == 'zip':
+        return Response(
+            stream_with_context(lotes.respuesta_zip(resultados)),
+            mimetype='application/zip',
+            headers={'Content-Disposition': 'attachment; filename="pixelado.zip"'}
+        )
+
+    limite = lotes.nuevo_limite()
+    return Response(
+        stream_with_context(lotes.respuesta_multipart(resultados, limite)),
+        content_type=f'multipart/mixed; boundary={limite}'
+    )
+
+def _encadenar(primero, resto):
+    yield primero
+    yield from resto
+
+@app.route("/admision", methods=["GET"])
+def estado_admision():
+    """
+    Estado del control de admisión de este proceso: límite actual, peticiones
+    en curso, admitidas, rechazadas por clase y latencia media.
+    """
+    if control_admision is None:
+        return jsonify({"activada": False}), 200
+    return jsonify({"activada": True, **control_admision.estadisticas()}), 200
+
 @app.route("/", methods=["GET"])
 def health():
     return jsonify({"status": "Public API operativa"}), 200
@@ -0,0 +1,302 @@
+"""
+Control de admisión del gateway.
+
+Cada proceso del gateway deja pasar como mucho `limite` peticiones síncronas a
+la vez hacia el motor. Las que llegan por encima se rechazan de inmediato, sin
+leer la imagen, con `Retry-After`, en lugar de esperar al timeout del motor. El
+límite se adapta a la latencia observada de las peticiones admitidas:
+
+* `gradiente` (por defecto): compara la latencia reciente con la latencia
+  sin carga (la mínima observada) y con la latencia objetivo. Si la reciente
+  crece (se están formando colas en el motor) el límite baja en proporción,
+  y si no, sube poco a poco.
+* `aimd`: suma uno por cada ventana de peticiones por debajo de la latencia
+  objetivo y multiplica por `factor_reduccion` al superarla.
+
+Con los dos algoritmos un error del motor (5xx, timeout o circuito abierto)
+reduce el límite de forma multiplicativa.
+
+Las peticiones se reparten en clases de prioridad según su clave de API
+(cabecera `X-Api-Key`). Cada clase solo puede ocupar una fracción del límite,
+de modo que al acercarse a la saturación se rechazan primero las de menor
+prioridad (429) y queda sitio para las de mayor. Con el límite completo se
+rechaza cualquier petición (503).
+
+Variables de entorno:
+
+* `ADMISION_ACTIVADA`: true (por defecto) o false
+* `ADMISION_ALGORITMO`: `gradiente` o `aimd`
+* `ADMISION_LIMITE_INICIAL`, `ADMISION_LIMITE_MIN`, `ADMISION_LIMITE_MAX`:
+  peticiones en curso por proceso (10, 2 y 24). El máximo debe quedar por
+  debajo de `GUNICORN_THREADS` para que siempre haya hilos libres con los que
+  rechazar
+* `ADMISION_LATENCIA_OBJETIVO_S`: latencia máxima sostenida de las peticiones admitidas (5)
+* `ADMISION_FACTOR_REDUCCION`: factor multiplicativo ante errores o latencia alta (0.9)
+* `ADMISION_CLAVES`: `clave:clase` separados por comas
+* `ADMISION_CLASE_DEFECTO`: clase sin clave o con una clave desconocida (`normal`)
+* `ADMISION_CUOTAS`: fracción del límite por clase (`alta:1.0,normal:0.9,baja:0.5`)
+"""
+import math
+import os
+import threading
+import time
+
+CABECERA_CLAVE = "X-Api-Key"
+CUOTAS_DEFECTO = "alta:1.0,normal:0.9,baja:0.5"
+
+# Códigos de respuesta que indican que el motor está sobrecargado o no responde
+CODIGOS_SOBRECARGA = {500, 502, 503, 504}
+
+
+class LimiteAIMD:
+    """
+    Aumento aditivo y reducción multiplicativa, como el control de congestión de TCP.
+    """
+
+    def __init__(self, inicial, minimo, maximo, latencia_objetivo=5.0, factor_reduccion=0.9):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.latencia_objetivo = float(latencia_objetivo)
+        self.factor_reduccion = float(factor_reduccion)
+        self.limite = float(inicial)
+
+    def exito(self, latencia, en_curso):
+        if latencia > self.latencia_objetivo:
+            self.reducir()
+        elif en_curso * 2 >= self.limite:
+            # Solo crece si el límite se está usando: +1 por cada `limite` peticiones
+            self.limite = min(self.limite + 1.0 / self.limite, self.maximo)
+
+    def reducir(self):
+        self.limite = max(self.limite * self.factor_reduccion, self.minimo)
+
+
+class LimiteGradiente:
+    """
+    Límite por gradiente de latencia (como Gradient de Netflix concurrency-limits).
+
+    Compara la latencia sin carga (la mínima de las últimas `ventana_minima`
+    peticiones) con una media exponencial de las últimas `ventana_corta`. El
+    cociente, con una `tolerancia` y acotado entre 0.5 y 1, multiplica el
+    límite, al que se suma una holgura de raíz del límite: mientras la
+    latencia no crece el límite sube, y cuando las peticiones empiezan a
+    esperar en el motor baja en proporción.
+
+    Con el motor saturado de forma continuada la latencia mínima de la ventana
+    deja de ser la de sin carga, así que el gradiente también se limita por
+    `latencia_objetivo / latencia`: la latencia nunca se estabiliza por
+    encima del objetivo.
+    """
+
+    def __init__(self, inicial, minimo, maximo, latencia_objetivo=5.0, factor_reduccion=0.9, tolerancia=1.5,
+                 ventana_corta=10, ventana_minima=500, suavizado=0.2):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.latencia_objetivo = float(latencia_objetivo)
+        self.factor_reduccion = float(factor_reduccion)
+        self.tolerancia = float(tolerancia)
+        self.alfa = 2.0 / (ventana_corta + 1)
+        self.ventana_minima = int(ventana_minima)
+        self.suavizado = float(suavizado)
+        self.limite = float(inicial)
+        self.latencia = None
+        # Mínimos de la ventana en curso y de la anterior: la mínima se renueva
+        # cada `ventana_minima` peticiones por si el motor se vuelve más lento
+        self._minima_actual = float("inf")
+        self._minima_anterior = float("inf")
+        self._muestras = 0
+
+    def exito(self, latencia, en_curso):
+        self._minima_actual = min(self._minima_actual, latencia)
+        self._muestras += 1
+        if self._muestras >= self.ventana_minima:
+            self._minima_anterior, self._minima_actual, self._muestras = self._minima_actual, float("inf"), 0
+        if self.latencia is None:
+            self.latencia = latencia
+            return
+        self.latencia += self.alfa * (latencia - self.latencia)
+
+        minima = min(self._minima_actual, self._minima_anterior)
+        latencia = max(self.latencia, 1e-6)
+        gradiente = max(0.5, min(1.0, self.tolerancia * minima / latencia, self.latencia_objetivo / latencia))
+        if gradiente >= 1.0 and en_curso * 2 < self.limite:
+            # El límite no se está usando: no hay información para subirlo
+            return
+        # Holgura para crecer, salvo por encima de la latencia objetivo
+        holgura = math.sqrt(self.limite) if latencia <= self.latencia_objetivo else 0.0
+        nuevo = self.limite * gradiente + holgura
+        nuevo = self.limite * (1 - self.suavizado) + nuevo * self.suavizado
+        self.limite = min(max(nuevo, self.minimo), self.maximo)
+
+    def reducir(self):
+        self.limite = max(self.limite * self.factor_reduccion, self.minimo)
+
+
+class Permiso:
+    """
+    Plaza admitida en el control de admisión; se devuelve con `terminar`.
+    """
+
+    def __init__(self, control, clase):
+        self.control = control
+        self.clase = clase
+        self.inicio = time.monotonic()
+        self._terminado = False
+
+    def terminar(self, codigo):
+        """
+        Libera la plaza y comunica el resultado al algoritmo del límite. Las
+        respuestas 2xx aportan su latencia, las de sobrecarga reducen el límite
+        y el resto (errores del cliente) no cuentan. Solo tiene efecto la
+        primera llamada.
+
+        :param codigo: Código HTTP de la respuesta
+        """
+        if self._terminado:
+            return
+        self._terminado = True
+        self.control._terminar(self, codigo, time.monotonic() - self.inicio)
+
+
+class ControlAdmision:
+    """
+    Límite adaptativo de peticiones en curso con clases de prioridad.
+    """
+
+    def __init__(self, algoritmo="gradiente", limite_inicial=10, limite_min=2, limite_max=24,
+                 latencia_objetivo=5.0, factor_reduccion=0.9, cuotas=None, claves=None, clase_defecto="normal"):
+        """
+        :param algoritmo: "gradiente" o "aimd"
+        :param limite_inicial: Límite de peticiones en curso al arrancar
+        :param limite_min: Límite mínimo
+        :param limite_max: Límite máximo
+        :param latencia_objetivo: Latencia (s) a partir de la cual se reduce el límite
+        :param factor_reduccion: Factor por el que se multiplica el límite al reducirlo
+        :param cuotas: Diccionario clase -> fracción del límite que puede ocupar
+        :param claves: Diccionario clave de API -> clase
+        :param clase_defecto: Clase de las peticiones sin clave o con una clave desconocida
+        :raises ValueError: Si el algoritmo, los límites o las clases no son válidos
+        """
+        limite_min = max(int(limite_min), 1)
+        limite_max = max(int(limite_max), limite_min)
+        limite_inicial = min(max(int(limite_inicial), limite_min), limite_max)
+        if algoritmo == "gradiente":
+            self.algoritmo = LimiteGradiente(limite_inicial, limite_min, limite_max, latencia_objetivo, factor_reduccion)
+        elif algoritmo == "aimd":
+            self.algoritmo = LimiteAIMD(limite_inicial, limite_min, limite_max, latencia_objetivo, factor_reduccion)
+        else:
+            raise ValueError(f"Algoritmo de admisión desconocido: {algoritmo}")
+
+        self.nombre_algoritmo = algoritmo
+        self.cuotas = dict(cuotas) if cuotas else leer_pares(CUOTAS_DEFECTO, float)
+        self.claves = dict(claves or {})
+        self.clase_defecto = clase_defecto
+        for clase in list(self.claves.values()) + [clase_defecto]:
+            if clase not in self.cuotas:
+                raise ValueError(f"La clase '{clase}' no tiene cuota en ADMISION_CUOTAS")
+
+        self.en_curso = 0
+        self.admitidas = 0
+        self.rechazadas = {clase: 0 for clase in self.cuotas}
+        self._latencia_media = None
+        self._lock = threading.Lock()
+
+    def clase(self, clave):
+        """
+        :param clave: Clave de API de la petición (o None)
+        :return: Clase de prioridad de la petición
+        """
+        return self.claves.get(clave, self.clase_defecto) if clave else self.clase_defecto
+
+    @property
+    def limite(self):
+        with self._lock:
+            return int(self.algoritmo.limite)
+
+    def admitir(self, clase):
+        """
+        :param clase: Clase de prioridad de la petición
+        :return: Tupla (Permiso o None, código de rechazo: 503 si el límite está
+                 completo, 429 si lo está la cuota de la clase)
+        """
+        with self._lock:
+            limite = int(self.algoritmo.limite)
+            if self.en_curso >= limite:
+                self.rechazadas[clase] += 1
+                return None, 503
+            if self.en_curso >= max(int(limite * self.cuotas[clase]), 1):
+                self.rechazadas[clase] += 1
+                return None, 429
+            self.en_curso += 1
+            self.admitidas += 1
+        return Permiso(self, clase), None
+
+    def _terminar(self, permiso, codigo, latencia):
+        with self._lock:
+            en_curso = self.en_curso
+            self.en_curso -= 1
+            if codigo in CODIGOS_SOBRECARGA:
+                self.algoritmo.reducir()
+            elif 200 <= codigo < 300:
+                self.algoritmo.exito(latencia, en_curso)
+                if self._latencia_media is None:
+                    self._latencia_media = latencia
+                else:
+                    self._latencia_media += 0.05 * (latencia - self._latencia_media)
+
+    def reintentar_tras(self):
+        """
+        :return: Segundos que se sugieren en `Retry-After`: la latencia media de
+                 las peticiones admitidas (lo que tarda en quedar una plaza libre), de 1 a 30
+        """
+        with self._lock:
+            latencia = self._latencia_media or 1.0
+        return min(max(int(math.ceil(latencia)), 1), 30)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "algoritmo": self.nombre_algoritmo,
+                "limite": int(self.algoritmo.limite),
+                "en_curso": self.en_curso,
+                "admitidas": self.admitidas,
+                "rechazadas": dict(self.rechazadas),
+                "latencia_media_s": None if self._latencia_media is None else round(self._latencia_media, 3),
+            }
+
+
+def leer_pares(texto, tipo=str):
+    """
+    :param texto: Pares `clave:valor` separados por comas
+    :param tipo: Tipo al que se convierten los valores
+    :return: Diccionario
+    :raises ValueError: Si algún par no tiene el formato `clave:valor`
+    """
+    pares = {}
+    for par in texto.split(","):
+        if not par.strip():
+            continue
+        clave, separador, valor = par.strip().rpartition(":")
+        if not separador or not clave:
+            raise ValueError(f"Par no válido (se esperaba clave:valor): {par}")
+        pares[clave] = tipo(valor)
+    return pares
+
+
+def crear_control_desde_entorno():
+    """
+    :return: ControlAdmision configurado con las variables ADMISION_*, o None si está desactivado
+    """
+    if os.environ.get("ADMISION_ACTIVADA", "true").lower() != "true":
+        return None
+    return ControlAdmision(
+        algoritmo=os.environ.get("ADMISION_ALGORITMO", "gradiente").lower(),
+        limite_inicial=int(os.environ.get("ADMISION_LIMITE_INICIAL", "10")),
+        limite_min=int(os.environ.get("ADMISION_LIMITE_MIN", "2")),
+        limite_max=int(os.environ.get("ADMISION_LIMITE_MAX", "24")),
+        latencia_objetivo=float(os.environ.get("ADMISION_LATENCIA_OBJETIVO_S", "5")),
+        factor_reduccion=float(os.environ.get("ADMISION_FACTOR_REDUCCION", "0.9")),
+        cuotas=leer_pares(os.environ.get("ADMISION_CUOTAS", CUOTAS_DEFECTO), float),
+        claves=leer_pares(os.environ.get("ADMISION_CLAVES", "")),
+        clase_defecto=os.environ.get("ADMISION_CLASE_DEFECTO", "normal"),
+    )
@@ -0,0 +1,247 @@
+"""
+Procesamiento por lotes para el gateway.
+
+Un lote puede llegar como varios archivos en el campo `files` o como un único
+archivo `.zip`/`.tar`/`.tar.gz` en el campo `archivo`. Los elementos se leen
+de uno en uno, se envían al motor con una concurrencia acotada y los
+resultados se devuelven en streaming según van terminando, como
+`multipart/mixed` o como un zip construido sobre la marcha. En memoria solo
+hay, como mucho, tantos elementos como peticiones en curso.
+"""
+import io
+import json
+import mimetypes
+import tarfile
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+EXTENSIONES_IMAGEN = {".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp"}
+
+
+class ErrorElemento(Exception):
+    """
+    Error de un elemento concreto del lote (se informa en línea, no aborta el lote).
+    """
+
+
+def _es_imagen(nombre):
+    return any(nombre.lower().endswith(ext) for ext in EXTENSIONES_IMAGEN)
+
+
+def _tipo_mime(nombre):
+    return mimetypes.guess_type(nombre)[0] or "application/octet-stream"
+
+
+def elementos_archivos(archivos, max_bytes):
+    """
+    Genera los elementos de un lote enviado como varios archivos.
+
+    :param archivos: Lista de FileStorage
+    :param max_bytes: Tamaño máximo de cada imagen
+    :return: Generador de tuplas (nombre, tipo MIME, función que devuelve los bytes)
+    """
+    for archivo in archivos:
+        def leer(archivo=archivo):
+            datos = archivo.read(max_bytes + 1)
+            if len(datos) > max_bytes:
+                raise ErrorElemento("El archivo excede el tamaño máximo permitido")
+            return datos
+        yield archivo.filename, archivo.content_type or _tipo_mime(archivo.filename), leer
+
+
+def elementos_comprimido(archivo, max_bytes, max_miembros):
+    """
+    Genera los elementos de un lote enviado como archivo zip o tar. Cada miembro
+    se descomprime solo cuando se pide el siguiente elemento, es decir, cuando
+    hay hueco para procesarlo.
+
+    :param archivo: FileStorage con el zip o tar
+    :param max_bytes: Tamaño máximo de cada imagen descomprimida
+    :param max_miembros: Número máximo de miembros (incluidos directorios y otros no archivos)
+    :return: Generador de tuplas (nombre, tipo MIME, función que devuelve los bytes)
+    :raises ValueError: Si el archivo no es un zip ni un tar válido o un zip tiene demasiados miembros
+    """
+    flujo = archivo.stream
+    if zipfile.is_zipfile(flujo):
+        flujo.seek(0)
+        with zipfile.ZipFile(flujo) as zf:
+            # El directorio central ya está leído: se rechaza antes de empezar a responder
+            if len(zf.infolist()) > max_miembros:
+                raise ValueError(f"El archivo supera el máximo de {max_miembros} miembros")
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                # Se extrae aquí (y no en el hilo de trabajo) porque el zip se cierra al agotar el generador
+                try:
+                    datos, error = _leer_miembro_zip(zf, info, max_bytes), None
+                except ErrorElemento as e:
+                    datos, error = None, e
+                yield info.filename, _tipo_mime(info.filename), (lambda datos=datos, error=error: _devolver(datos, error))
+        return
+
+    flujo.seek(0)
+    try:
+        tf = tarfile.open(fileobj=flujo, mode="r:*")
+    except tarfile.TarError:
+        raise ValueError("El archivo debe ser un .zip o un .tar (opcionalmente comprimido)")
+    with tf:
+        # En un tar los miembros se descubren al leerlo: al pasar del máximo se informa y se deja de leer
+        for numero, miembro in enumerate(tf):
+            if numero >= max_miembros:
+                error = ErrorElemento(f"El archivo supera el máximo de {max_miembros} miembros")
+                yield miembro.name, _tipo_mime(miembro.name), (lambda error=error: _devolver(None, error))
+                return
+            if not miembro.isfile():
+                continue
+            # Los tar se leen en orden, así que el contenido se extrae antes de pasar al siguiente miembro
+            try:
+                datos, error = _leer_miembro_tar(tf, miembro, max_bytes), None
+            except ErrorElemento as e:
+                datos, error = None, e
+            yield miembro.name, _tipo_mime(miembro.name), (lambda datos=datos, error=error: _devolver(datos, error))
+
+
+def _leer_miembro_zip(zf, info, max_bytes):
+    if not _es_imagen(info.filename):
+        raise ErrorElemento("El archivo no es una imagen")
+    if info.file_size > max_bytes:
+        raise ErrorElemento("El archivo excede el tamaño máximo permitido")
+    with zf.open(info) as miembro:
+        # El tamaño de la cabecera del zip puede no ser cierto: se lee un byte más para comprobarlo
+        datos = miembro.read(max_bytes + 1)
+    if len(datos) > max_bytes:
+        raise ErrorElemento("El archivo excede el tamaño máximo permitido")
+    return datos
+
+
+def _leer_miembro_tar(tf, miembro, max_bytes):
+    if not _es_imagen(miembro.name):
+        raise ErrorElemento("El archivo no es una imagen")
+    if miembro.size > max_bytes:
+        raise ErrorElemento("El archivo excede el tamaño máximo permitido")
+    return tf.extractfile(miembro).read()
+
+
+def _devolver(datos, error):
+    if error is not None:
+        raise error
+    return datos
+
+
+def procesar_lote(elementos, procesar, concurrencia, max_elementos):
+    """
+    Procesa los elementos con como mucho `concurrencia` peticiones en curso y
+    devuelve los resultados según terminan.
+
+    :param elementos: Generador de (nombre, tipo MIME, función de lectura)
+    :param procesar: Función (nombre, bytes, tipo MIME) -> (tipo MIME, bytes del resultado)
+    :param concurrencia: Número máximo de elementos en curso
+    :param max_elementos: Número máximo de elementos del lote
+    :return: Generador de diccionarios con "indice", "nombre", "ok", "tipo" y "contenido"
+    """
+    def tarea(indice, nombre, tipo, leer):
+        try:
+            datos = leer()
+            tipo_resultado, contenido = procesar(nombre, datos, tipo)
+            return {"indice": indice, "nombre": nombre, "ok": True, "tipo": tipo_resultado, "contenido": contenido}
+        except Exception as e:
+            error = json.dumps({"error": str(e), "nombre": nombre}).encode("utf-8")
+            return {"indice": indice, "nombre": nombre, "ok": False, "tipo": "application/json", "contenido": error}
+
+    iterador = iter(elementos)
+    # La lectura de los elementos (p. ej. un tar) no es segura entre hilos
+    lock_lectura = threading.Lock()
+
+    def siguiente():
+        with lock_lectura:
+            return next(iterador, None)
+
+    with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+        en_curso = set()
+        indice = 0
+        agotado = False
+        while True:
+            while not agotado and len(en_curso) < concurrencia:
+                elemento = siguiente()
+                if elemento is None:
+                    agotado = True
+                    break
+                if indice >= max_elementos:
+                    agotado = True
+                    yield {
+                        "indice": indice, "nombre": elemento[0], "ok": False, "tipo": "application/json",
+                        "contenido": json.dumps({"error": f"El lote supera el máximo de {max_elementos} elementos"}).encode("utf-8"),
+                    }
+                    break
+                en_curso.add(ejecutor.submit(tarea, indice, *elemento))
+                indice += 1
+            if not en_curso:
+                return
+            terminados, en_curso = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                yield futuro.result()
+
+
+def respuesta_multipart(resultados, limite):
+    """
+    Serializa los resultados como partes de un `multipart/mixed`.
+
+    :param resultados: Generador de resultados de `procesar_lote`
+    :param limite: Cadena delimitadora (boundary)
+    :return: Generador de bytes
+    """
+    for resultado in resultados:
+        nombre = resultado["nombre"].replace('"', "").replace("\r", "").replace("\n", "")
+        cabeceras = (
+            f"--{limite}\r\n"
+            f"Content-Type: {resultado['tipo']}\r\n"
+            f"Content-Disposition: attachment; filename=\"{nombre}\"\r\n"
+            f"X-Indice: {resultado['indice']}\r\n"
+            f"X-Estado: {'ok' if resultado['ok'] else 'error'}\r\n"
+            f"Content-Length: {len(resultado['contenido'])}\r\n\r\n"
+        )
+        yield cabeceras.encode("utf-8") + resultado["contenido"] + b"\r\n"
+    yield f"--{limite}--\r\n".encode("utf-8")
+
+
+class _Buffer(io.RawIOBase):
+    # Destino no posicionable para zipfile: acumula lo escrito hasta que se vacía
+    def __init__(self):
+        self.partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self.partes.append(bytes(datos))
+        return len(datos)
+
+    def vaciar(self):
+        datos = b"".join(self.partes)
+        self.partes = []
+        return datos
+
+
+def respuesta_zip(resultados):
+    """
+    Construye un zip sobre la marcha con los resultados. Los errores se añaden
+    como `<nombre>.error.json`.
+
+    :param resultados: Generador de resultados de `procesar_lote`
+    :return: Generador de bytes
+    """
+    buffer = _Buffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        for resultado in resultados:
+            nombre = resultado["nombre"]
+            if not resultado["ok"]:
+                nombre = f"{nombre}.error.json"
+            zf.writestr(f"{resultado['indice']:06d}_{nombre}", resultado["contenido"])
+            yield buffer.vaciar()
+    yield buffer.vaciar()
+
+
+def nuevo_limite():
+    return uuid.uuid4().hex
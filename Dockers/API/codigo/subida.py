@@ -0,0 +1,250 @@
+"""
+Lectura en streaming de las subidas `multipart/form-data` del gateway.
+
+El cuerpo de la petición se lee en bloques de `TAMANO_BLOQUE` bytes y se
+analiza con el decodificador incremental de Werkzeug, sin pasar por
+`request.files`, de modo que el archivo nunca está entero en memoria (ni en un
+temporal) en el gateway. Las comprobaciones se hacen sobre el flujo:
+
+* el tipo declarado de la parte del archivo tiene que estar permitido y
+  coincidir con los bytes mágicos de su primer bloque;
+* el archivo no puede superar `max_bytes` (se corta en cuanto se pasa) y los
+  campos de texto no pueden superar `MAX_BYTES_CAMPO`.
+
+`cuerpo_multipart` genera el cuerpo `multipart/form-data` que se reenvía al
+motor a partir de la subida, bloque a bloque, para enviarlo con
+`Transfer-Encoding: chunked`.
+"""
+import uuid
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Epilogue, Field, File, MultipartDecoder, NeedData
+
+TAMANO_BLOQUE = 64 * 1024
+MAX_BYTES_CAMPO = 64 * 1024
+MAX_PARTES = 16
+
+# Bytes mágicos de cada tipo MIME permitido en el gateway
+_FIRMAS = {
+    "image/jpeg": (b"\xff\xd8\xff",),
+    "image/jpg": (b"\xff\xd8\xff",),
+    "image/png": (b"\x89PNG\r\n\x1a\n",),
+    "image/gif": (b"GIF87a", b"GIF89a"),
+    "image/bmp": (b"BM",),
+}
+_LONGITUD_FIRMA = 12
+
+
+class SubidaNoValida(ValueError):
+    """
+    La subida no es válida; `codigo` es el código HTTP que debe devolverse (400 o 413).
+    """
+
+    def __init__(self, mensaje, codigo=400):
+        super().__init__(mensaje)
+        self.codigo = codigo
+
+
+def _coincide_firma(tipo, cabecera):
+    if tipo == "image/webp":
+        return cabecera[:4] == b"RIFF" and cabecera[8:12] == b"WEBP"
+    return any(cabecera.startswith(firma) for firma in _FIRMAS.get(tipo, ()))
+
+
+class SubidaMultipart:
+    """
+    Subida multipart con un archivo (`campo_archivo`) y campos de texto, leída en streaming.
+
+    Uso: `abrir()` lee hasta el primer bloque del archivo y valida su tipo;
+    después `trozos()` genera el contenido del archivo y termina de leer el
+    resto del cuerpo. `campos` contiene los campos de texto leídos hasta el
+    momento (todos, una vez consumido `trozos()`).
+    """
+
+    def __init__(self, flujo, tipo_contenido, campo_archivo, tipos_permitidos, max_bytes):
+        """
+        :param flujo: Flujo con el cuerpo de la petición (`request.stream`)
+        :param tipo_contenido: Cabecera Content-Type de la petición
+        :param campo_archivo: Nombre del campo del archivo
+        :param tipos_permitidos: Tipos MIME permitidos para el archivo
+        :param max_bytes: Tamaño máximo del archivo en bytes
+        :raises SubidaNoValida: Si la petición no es multipart/form-data
+        """
+        mime, opciones = parse_options_header(tipo_contenido or "")
+        if mime != "multipart/form-data" or not opciones.get("boundary"):
+            raise SubidaNoValida("La petición debe ser multipart/form-data")
+        self.campo_archivo = campo_archivo
+        self.tipos_permitidos = tipos_permitidos
+        self.max_bytes = int(max_bytes)
+        self.campos = {}
+        self.nombre_archivo = None
+        self.tipo = None
+        self.tamano = 0
+
+        # Además del archivo solo caben campos de texto pequeños
+        self._max_cuerpo = self.max_bytes + MAX_PARTES * (MAX_BYTES_CAMPO + 1024)
+        self._leidos = 0
+        self._flujo = flujo
+        # El búfer del decodificador está acotado por el tamaño de bloque; el de los campos, en _leer_campo
+        self._decodificador = MultipartDecoder(opciones["boundary"].encode("latin-1"), max_parts=MAX_PARTES)
+        self._eventos = self._leer_eventos()
+        self._pendientes = []
+        self._abierta = False
+
+    def _leer_eventos(self):
+        # Genera los eventos del decodificador leyendo el cuerpo bloque a bloque
+        while True:
+            bloque = self._flujo.read(TAMANO_BLOQUE)
+            self._leidos += len(bloque)
+            if self._leidos > self._max_cuerpo:
+                raise SubidaNoValida("La petición es demasiado grande", 413)
+            try:
+                self._decodificador.receive_data(bloque or None)
+                evento = self._decodificador.next_event()
+                while not isinstance(evento, NeedData):
+                    if isinstance(evento, Epilogue):
+                        return
+                    yield evento
+                    evento = self._decodificador.next_event()
+            except RequestEntityTooLarge:
+                raise SubidaNoValida("La petición tiene demasiadas partes", 413)
+            except ValueError as e:
+                raise SubidaNoValida(f"Cuerpo multipart no válido: {e}")
+            if not bloque:
+                raise SubidaNoValida("La subida está incompleta")
+
+    def _leer_campo(self, nombre):
+        valor = []
+        for evento in self._eventos:
+            valor.append(evento.data)
+            if sum(len(v) for v in valor) > MAX_BYTES_CAMPO:
+                raise SubidaNoValida(f"El campo '{nombre}' es demasiado grande", 413)
+            if not evento.more_data:
+                break
+        self.campos[nombre] = b"".join(valor).decode("utf-8", "replace")
+
+    def _descartar_parte(self):
+        for evento in self._eventos:
+            if not evento.more_data:
+                break
+
+    def abrir(self):
+        """
+        Lee el cuerpo hasta el primer bloque del archivo y comprueba su tipo.
+
+        :raises SubidaNoValida: Si no hay archivo, su tipo no está permitido o no coincide con su contenido
+        """
+        for evento in self._eventos:
+            if isinstance(evento, Field):
+                self._leer_campo(evento.name)
+            elif isinstance(evento, File) and evento.name == self.campo_archivo:
+                self.nombre_archivo = evento.filename or ""
+                self.tipo = evento.headers.get("Content-Type", "application/octet-stream")
+                break
+            elif isinstance(evento, File):
+                self._descartar_parte()
+        else:
+            raise SubidaNoValida("No se ha enviado ninguna imagen")
+
+        if self.tipo not in self.tipos_permitidos:
+            raise SubidaNoValida(
+                f"Tipo de archivo no permitido: {self.tipo}. Use PNG, JPG, JPEG, BMP, GIF o WEBP."
+            )
+
+        # Primeros bytes del archivo para comprobar que el contenido coincide con el tipo declarado
+        cabecera = b""
+        for evento in self._eventos:
+            self._pendientes.append(evento)
+            cabecera += evento.data
+            if len(cabecera) >= _LONGITUD_FIRMA or not evento.more_data:
+                break
+        if not cabecera:
+            raise SubidaNoValida("El archivo está vacío")
+        if not _coincide_firma(self.tipo, cabecera[:_LONGITUD_FIRMA]):
+            raise SubidaNoValida(f"El contenido del archivo no corresponde al tipo {self.tipo}")
+        self._abierta = True
+
+    def trozos(self):
+        """
+        Genera el contenido del archivo bloque a bloque y, al terminar, lee el
+        resto del cuerpo (los campos posteriores al archivo).
+
+        :raises SubidaNoValida: Si el archivo supera `max_bytes` o el cuerpo no es válido
+        """
+        if not self._abierta:
+            self.abrir()
+
+        terminado = False
+        while not terminado:
+            evento = self._pendientes.pop(0) if self._pendientes else next(self._eventos, None)
+            if evento is None:
+                raise SubidaNoValida("La subida está incompleta")
+            self.tamano += len(evento.data)
+            if self.tamano > self.max_bytes:
+                raise SubidaNoValida(
+                    f"El archivo supera el tamaño máximo de {self.max_bytes // (1024 * 1024)} MB", 413
+                )
+            if evento.data:
+                yield evento.data
+            terminado = not evento.more_data
+
+        for evento in self._eventos:
+            if isinstance(evento, Field):
+                self._leer_campo(evento.name)
+            elif isinstance(evento, File):
+                self._descartar_parte()
+
+    def leer(self):
+        """
+        :return: Contenido completo del archivo (acotado por `max_bytes`)
+        """
+        return b"".join(self.trozos())
+
+
+def _parte(limite, cabeceras):
+    return f"--{limite}\r\n{cabeceras}\r\n\r\n".encode("utf-8")
+
+
+def _comillas(valor):
+    # Como los navegadores (HTML5): las comillas y los saltos de línea se codifican
+    return valor.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+def cuerpo_multipart(subida, campo_destino, campos, limite=None):
+    """
+    Genera el cuerpo multipart que se reenvía al motor, bloque a bloque.
+
+    Los campos de texto leídos antes del archivo se envían delante de él y los
+    que llegan después, detrás.
+
+    :param subida: SubidaMultipart ya abierta
+    :param campo_destino: Nombre del campo del archivo en el cuerpo generado
+    :param campos: Nombres de los campos de texto que se reenvían
+    :param limite: Separador de las partes (por defecto uno aleatorio)
+    :return: Tupla (Content-Type, generador de bytes)
+    """
+    limite = limite or uuid.uuid4().hex
+
+    def generar():
+        enviados = set()
+
+        def campos_pendientes():
+            for nombre in campos:
+                if nombre in subida.campos and nombre not in enviados:
+                    enviados.add(nombre)
+                    yield _parte(limite, f'Content-Disposition: form-data; name="{nombre}"')
+                    yield subida.campos[nombre].encode("utf-8") + b"\r\n"
+
+        yield from campos_pendientes()
+        yield _parte(
+            limite,
+            f'Content-Disposition: form-data; name="{campo_destino}"; filename="{_comillas(subida.nombre_archivo)}"\r\n'
+            f"Content-Type: {subida.tipo}",
+        )
+        yield from subida.trozos()
+        yield b"\r\n"
+        yield from campos_pendientes()
+        yield f"--{limite}--\r\n".encode("utf-8")
+
+    return f"multipart/form-data; boundary={limite}", generar()
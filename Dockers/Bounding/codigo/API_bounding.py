@@ -1,17 +1,49 @@
 from flask import Flask, jsonify, request
-import numpy as np
-import cv2
-from retinaface import RetinaFace
 from io import BytesIO
 from PIL import Image
 import werkzeug
+import os
+import deteccion
+import detectores
+import instrumentacion
+import servicio
+import validacion
 
 # Create the Flask application
 app = Flask(__name__)
 
+# Detector de caras elegido con DETECTOR ("retinaface" o "yunet", ver detectores.py)
+detector = detectores.crear_detector_desde_entorno()
+
+# El servicio no recibe tráfico (GET /listo) hasta que el detector está cargado y calentado
+servicio.requerir(detector.nombre)
+servicio.registrar_listo(app)
+instrumentacion.registrar(app, "bounding")
+
 # Allowed image file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+# Lado mayor máximo (px) de la imagen que se pasa al detector (0 para no reducir)
+MAX_LADO_DETECCION = int(os.environ.get("MAX_LADO_DETECCION", "1280"))
+# Segunda pasada a resolución completa alrededor de las caras pequeñas
+SEGUNDA_PASADA = os.environ.get("SEGUNDA_PASADA", "false").lower() == "true"
+# Lado (px, en la imagen reducida) por debajo del cual una cara se considera pequeña
+LADO_CARA_PEQUENA = int(os.environ.get("LADO_CARA_PEQUENA", "24"))
+
+# Detección por teselas para imágenes muy grandes: "auto" (si el lado mayor supera
+# UMBRAL_TESELAS), "siempre" o "nunca"
+MODO_TESELAS = os.environ.get("MODO_TESELAS", "auto").lower()
+UMBRAL_TESELAS = int(os.environ.get("UMBRAL_TESELAS", "6000"))
+LADO_TESELA = int(os.environ.get("LADO_TESELA", "1024"))
+SOLAPE_TESELA = int(os.environ.get("SOLAPE_TESELA", "128"))
+HILOS_TESELAS = int(os.environ.get("HILOS_TESELAS", "1"))
+
+# Límites de tamaño de archivo y de petición (MB), ampliables para escaneos y panorámicas
+MAX_MB_ARCHIVO = float(os.environ.get("MAX_MB_ARCHIVO", "10"))
+MAX_MB_PETICION = float(os.environ.get("MAX_MB_PETICION", "16"))
+# Número máximo de píxeles, comprobado en la cabecera antes de decodificar
+MAX_MEGAPIXELES = float(os.environ.get("MAX_MEGAPIXELES", "100"))
+
 def allowed_file(filename):
     """
     Comprueba que el archivo subido sea compatible para la detección de caras (que sea imagen).
@@ -22,33 +54,75 @@ def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def validate_image(file):
+def leer_imagen(file):
     """
-    Valida la imagen antes de la detección de caras.
+    Lee la imagen subida, la valida a partir de su cabecera (tamaño, bytes mágicos
+    y número de píxeles) y la decodifica una sola vez.
     
-    :param file: Archivo de imagen a validar
+    :param file: Archivo de imagen
+    :return: Imagen BGR decodificada
     :raises ValueError: Si la imagen no es válida
     """
-    # Verificar tamaño máximo (por ejemplo, 10MB)
-    file.seek(0, 2)  # Mover al final del archivo
-    file_size = file.tell()
-    file.seek(0)  # Reiniciar puntero de archivo
-    
-    if file_size > 10 * 1024 * 1024:  # 10MB
-        raise ValueError("El tamaño del archivo excede el límite de 10MB")
-    
-    # Intentar abrir la imagen para validarla
-    try:
-        # Use OpenCV to read and validate the image
-        img_bytes = file.read()
-        file.seek(0)  # Reset file pointer
-        img_np = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
-        
-        if img_np is None or img_np.size == 0:
-            raise ValueError("No se puede leer la imagen")
-        
-    except Exception as e:
-        raise ValueError(f"Archivo de imagen no válido: {str(e)}")
+    return validacion.decodificar(
+        file.read(),
+        max_bytes=int(MAX_MB_ARCHIVO * 1024 * 1024),
+        max_pixeles=int(MAX_MEGAPIXELES * 1_000_000)
+    )
+
+def usar_teselas(img_np, teselas=None):
+    """
+    Decide si la imagen se procesa por teselas.
+
+    :param img_np: Imagen decodificada
+    :param teselas: Valor indicado en la petición (None para usar MODO_TESELAS)
+    :return: Booleano
+    """
+    if teselas is not None:
+        return teselas
+    if MODO_TESELAS == "siempre":
+        return True
+    if MODO_TESELAS == "nunca":
+        return False
+    return max(img_np.shape[:2]) > UMBRAL_TESELAS
+
+def detectar_caras_bgr(img_np, max_lado=None, segunda_pasada=None, teselas=None):
+    """
+    Detecta las caras de una imagen BGR, por teselas si es muy grande o reducida en otro caso.
+
+    :param img_np: Imagen BGR (tal como la devuelve cv2.imdecode)
+    :param max_lado: Lado mayor máximo para la detección (por defecto MAX_LADO_DETECCION)
+    :param segunda_pasada: Si se hace la segunda pasada (por defecto SEGUNDA_PASADA)
+    :param teselas: Si se fuerza (True) o se desactiva (False) la detección por teselas
+    :return: Lista de caras con "facial_area", "score" y "landmarks"
+    """
+    max_lado = MAX_LADO_DETECCION if max_lado is None else max_lado
+    if usar_teselas(img_np, teselas):
+        return deteccion.detectar_teselas(
+            detector.detectar, img_np,
+            lado_tesela=LADO_TESELA, solape=SOLAPE_TESELA,
+            hilos=HILOS_TESELAS, max_lado_global=max_lado
+        )
+
+    # El detector recibe la imagen BGR reducida (RetinaFace la convierte a RGB tras reducirla)
+    return deteccion.detectar_escalado(
+        detector.detectar,
+        img_np,
+        max_lado=max_lado,
+        segunda_pasada=SEGUNDA_PASADA if segunda_pasada is None else segunda_pasada,
+        lado_cara_pequena=LADO_CARA_PEQUENA,
+    )
+
+def detectar(img_np, max_lado=None, segunda_pasada=None, teselas=None):
+    """
+    Detecta las caras de una imagen ya decodificada.
+
+    :param img_np: Imagen BGR (tal como la devuelve cv2.imdecode)
+    :param max_lado: Lado mayor máximo para la detección (por defecto MAX_LADO_DETECCION)
+    :param segunda_pasada: Si se hace la segunda pasada (por defecto SEGUNDA_PASADA)
+    :param teselas: Si se fuerza (True) o se desactiva (False) la detección por teselas
+    :return: Lista de detecciones con "bbox", "confidence", "id" y "landmarks"
+    """
+    return deteccion.formatear(detectar_caras_bgr(img_np, max_lado, segunda_pasada, teselas))
 
 @app.route("/detectar_caras", methods=["POST"])
 def detectar_caras():
@@ -77,22 +151,28 @@ def detectar_caras():
                 "error": "Tipo de archivo no permitido. Use PNG, JPG, JPEG, GIF, BMP o WEBP."
             }), 400
 
+        # Parámetros opcionales de la petición que sustituyen a la configuración
         try:
-            # Validar imagen
-            validate_image(file)
-            
-            # Leer imagen con OpenCV
-            img_bytes = file.read()
-            file.seek(0)  # Resetear puntero de archivo
-            
-            # Decodificar imagen con OpenCV
-            img_np = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
-            
-            # Convertir de BGR a RGB (RetinaFace prefiere RGB)
-            img_rgb = cv2.cvtColor(img_np, cv2.COLOR_BGR2RGB)
+            max_lado = int(request.form["max_lado"]) if "max_lado" in request.form else None
+        except ValueError:
+            return jsonify({"error": "El campo 'max_lado' debe ser un entero."}), 400
+        if max_lado is not None and max_lado < 0:
+            return jsonify({"error": "El campo 'max_lado' no puede ser negativo."}), 400
+        segunda_pasada = None
+        if "segunda_pasada" in request.form:
+            segunda_pasada = request.form["segunda_pasada"].lower() == "true"
+        teselas = None
+        if "teselas" in request.form:
+            teselas = request.form["teselas"].lower() == "true"
+
+        try:
+            # Validar la cabecera y decodificar la imagen una sola vez
+            with instrumentacion.medir("decodificacion"):
+                img_np = leer_imagen(file)
             
-            # Detectar caras
-            resp = RetinaFace.detect_faces(img_rgb)
+            # Detectar caras (por teselas o sobre la imagen reducida, con cajas en coordenadas originales)
+            with instrumentacion.medir("deteccion"):
+                caras = detectar_caras_bgr(img_np, max_lado, segunda_pasada, teselas)
             
         except ValueError as ve:
             return jsonify({"error": str(ve)}), 400
@@ -105,16 +185,7 @@ def detectar_caras():
 
         try:
             # Procesar caras detectadas
-            facial_areas = []
-            for key, item in resp.items():
-                if item.get("facial_area"):
-                    # Convertir valores a enteros
-                    facial_area = [int(i) for i in item["facial_area"]]
-                    facial_areas.append({
-                        "bbox": facial_area,
-                        "confidence": float(item.get("score", 0)),
-                        "id": key  # Añadir identificador único de cara
-                    })
+            facial_areas = deteccion.formatear(caras)
 
             # Devolver resultados de detección
             return jsonify({
@@ -146,13 +217,39 @@ def inicio():
     """
     return jsonify({
         "message": "API de Detección Facial operativa",
+        "detector": detector.nombre,
     }), 200
 
 
 
 # Configuración de la aplicación Flask
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB tamaño máximo de carga
+app.config['MAX_CONTENT_LENGTH'] = int(MAX_MB_PETICION * 1024 * 1024)  # 16MB tamaño máximo de carga por defecto
+
+def calentar_modelo():
+    """
+    Carga el detector y ejecuta una detección de prueba para que la primera
+    petición real no pague la carga del modelo.
+    """
+    detector.calentar()
+    # Todo lo que cambia las detecciones forma parte de la versión del servicio (caché del Engine)
+    servicio.fijar_version("deteccion", {
+        **detector.configuracion(),
+        "max_lado": MAX_LADO_DETECCION,
+        "segunda_pasada": SEGUNDA_PASADA,
+        "lado_cara_pequena": LADO_CARA_PEQUENA,
+        "modo_teselas": MODO_TESELAS,
+        "umbral_teselas": UMBRAL_TESELAS,
+        "lado_tesela": LADO_TESELA,
+        "solape_tesela": SOLAPE_TESELA,
+    })
+    servicio.marcar_listo(detector.nombre)
+
+# Carga y calentamiento del modelo al arrancar el proceso
+try:
+    calentar_modelo()
+except Exception as e:
+    print(f"No se pudo precargar el detector {detector.nombre}:", e)
 
 if __name__ == "__main__":
     # Ejecutar la aplicación
-    app.run(host="0.0.0.0", port=5001, debug=True)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5001, debug=False)
\ No newline at end of file
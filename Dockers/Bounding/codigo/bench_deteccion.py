@@ -0,0 +1,79 @@
+"""
+Benchmark de velocidad frente a recall de la detección reducida.
+
+Para cada imagen se toma como referencia la detección de RetinaFace a
+resolución completa y se mide, para varios valores de `max_lado` (con y sin
+segunda pasada), el tiempo de detección y la fracción de caras de referencia
+recuperadas (IoU >= 0.5).
+
+Uso:
+    python bench_deteccion.py [img1.jpg img2.jpg] [--lados 640 960 1280 1600] [--repeticiones 3]
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+from retinaface import RetinaFace
+
+import deteccion
+
+
+def iou(a, b):
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    interseccion = max(ix2 - ix1, 0) * max(iy2 - iy1, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - interseccion
+    return interseccion / union if union > 0 else 0.0
+
+
+def recall(referencia, caras, umbral=0.5):
+    if not referencia:
+        return 1.0
+    encontradas = 0
+    for ref in referencia:
+        if any(iou(ref["facial_area"], c["facial_area"]) >= umbral for c in caras):
+            encontradas += 1
+    return encontradas / len(referencia)
+
+
+def medir(img_rgb, repeticiones, **kwargs):
+    tiempos = []
+    caras = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        caras = deteccion.detectar_escalado(RetinaFace.detect_faces, img_rgb, **kwargs)
+        tiempos.append(time.perf_counter() - inicio)
+    return caras, float(np.median(tiempos)) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("imagenes", nargs="*", default=["img1.jpg", "img2.jpg"])
+    parser.add_argument("--lados", nargs="+", type=int, default=[640, 960, 1280, 1600])
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    # Calentamiento del modelo para no contar su carga
+    RetinaFace.detect_faces(np.zeros((64, 64, 3), dtype=np.uint8))
+
+    for ruta in args.imagenes:
+        img = cv2.imread(ruta)
+        if img is None:
+            print(f"No se pudo leer {ruta}")
+            continue
+        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        alto, ancho = img_rgb.shape[:2]
+
+        referencia, t_ref = medir(img_rgb, args.repeticiones, max_lado=None)
+        print(f"\n{ruta} ({ancho}x{alto}): {len(referencia)} caras a resolución completa en {t_ref:.0f} ms")
+        print(f"{'max_lado':>9} {'2ª pasada':>10} {'caras':>6} {'recall':>7} {'ms':>8} {'acel.':>6}")
+        for lado in args.lados:
+            for segunda in (False, True):
+                caras, t = medir(img_rgb, args.repeticiones, max_lado=lado, segunda_pasada=segunda)
+                print(f"{lado:>9} {'sí' if segunda else 'no':>10} {len(caras):>6} "
+                      f"{recall(referencia, caras):>7.2f} {t:>8.0f} {t_ref / t if t else 0:>5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
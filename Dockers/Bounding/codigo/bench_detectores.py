@@ -0,0 +1,174 @@
+"""
+Comparación de recall y velocidad entre detectores (RetinaFace, YuNet).
+
+La referencia de cada imagen son las caras anotadas en `--anotaciones` o, si no
+se indican, las que detecta el detector de `--referencia` (RetinaFace por
+defecto) a resolución completa. Para cada detector y cada `max_lado` se mide:
+
+* recall: fracción de caras de referencia encontradas (IoU >= 0.5), en total
+  y solo para las caras pequeñas (lado menor que `--lado-pequena` px)
+* caras extra: detecciones que no corresponden a ninguna cara de referencia
+* latencia p50/p95 por imagen y throughput en imágenes por segundo
+
+El archivo de anotaciones es un JSON {"nombre_imagen": [[x1, y1, x2, y2], ...]}.
+
+Uso:
+    python bench_detectores.py img1.jpg img2.jpg --detectores retinaface yunet --lados 640 1280
+    python bench_detectores.py --corpus fotos/ --anotaciones cajas.json --salida comparacion.json
+"""
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+import deteccion
+from detectores import DETECTORES, crear_detector
+
+EXTENSIONES_IMAGEN = {".png", ".jpg", ".jpeg", ".bmp"}
+
+
+def iou(a, b):
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    interseccion = max(ix2 - ix1, 0) * max(iy2 - iy1, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - interseccion
+    return interseccion / union if union > 0 else 0.0
+
+
+def cargar_rutas(args):
+    rutas = list(args.imagenes)
+    if args.corpus:
+        rutas.extend(
+            os.path.join(args.corpus, nombre) for nombre in sorted(os.listdir(args.corpus))
+            if os.path.splitext(nombre)[1].lower() in EXTENSIONES_IMAGEN
+        )
+    return rutas or ["img1.jpg", "img2.jpg"]
+
+
+def emparejar(referencia, cajas, umbral=0.5):
+    """
+    Empareja cada caja de referencia con como mucho una detección (la de mayor IoU).
+
+    :return: Tupla (lista de booleanos "encontrada" por caja de referencia, detecciones sin pareja)
+    """
+    libres = list(range(len(cajas)))
+    encontradas = []
+    for ref in referencia:
+        mejor, mejor_iou = None, umbral
+        for i in libres:
+            valor = iou(ref, cajas[i])
+            if valor >= mejor_iou:
+                mejor, mejor_iou = i, valor
+        if mejor is not None:
+            libres.remove(mejor)
+        encontradas.append(mejor is not None)
+    return encontradas, len(libres)
+
+
+def detectar(detector, img, max_lado):
+    inicio = time.perf_counter()
+    caras = deteccion.detectar_escalado(detector.detectar, img, max_lado=max_lado)
+    return [c["facial_area"] for c in caras], time.perf_counter() - inicio
+
+
+def formato(valor):
+    return f"{valor:.2f}" if valor is not None else "-"
+
+
+def percentil(valores, p):
+    return float(np.percentile(valores, p)) * 1000.0 if valores else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("imagenes", nargs="*")
+    parser.add_argument("--corpus", help="Directorio con imágenes")
+    parser.add_argument("--anotaciones", help="JSON con las cajas reales de cada imagen")
+    parser.add_argument("--referencia", choices=DETECTORES, default="retinaface",
+                        help="Detector de referencia a resolución completa si no hay anotaciones")
+    parser.add_argument("--detectores", nargs="+", choices=DETECTORES, default=list(DETECTORES))
+    parser.add_argument("--lados", nargs="+", type=int, default=[640, 1280],
+                        help="Valores de max_lado (0 para resolución completa)")
+    parser.add_argument("--umbral", type=float, default=0.9, help="Puntuación mínima de los detectores")
+    parser.add_argument("--lado-pequena", type=int, default=32, help="Lado (px) por debajo del cual una cara es pequeña")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--salida", help="Archivo JSON en el que guardar los resultados")
+    args = parser.parse_args()
+
+    imagenes = []
+    for ruta in cargar_rutas(args):
+        img = cv2.imread(ruta)
+        if img is None:
+            print(f"No se pudo leer {ruta}")
+            continue
+        imagenes.append((os.path.basename(ruta), img))
+    if not imagenes:
+        parser.error("No hay imágenes que procesar")
+
+    detectores = {}
+    for nombre in set(args.detectores) | ({args.referencia} if not args.anotaciones else set()):
+        detectores[nombre] = crear_detector(nombre, args.umbral)
+        # Calentamiento del modelo para no contar su carga
+        detectores[nombre].calentar()
+
+    if args.anotaciones:
+        with open(args.anotaciones, encoding="utf-8") as f:
+            anotaciones = json.load(f)
+        referencias = {nombre: [list(map(float, c)) for c in anotaciones.get(nombre, [])] for nombre, _ in imagenes}
+        origen = args.anotaciones
+    else:
+        referencias = {nombre: detectar(detectores[args.referencia], img, None)[0] for nombre, img in imagenes}
+        origen = f"{args.referencia} a resolución completa"
+    total_ref = sum(len(r) for r in referencias.values())
+    print(f"{len(imagenes)} imágenes, {total_ref} caras de referencia ({origen})")
+
+    resultados = []
+    print(f"\n{'detector':>11} {'max_lado':>9} {'recall':>7} {'r.peq.':>7} {'extra':>6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'img/s':>7}")
+    for nombre in args.detectores:
+        for lado in args.lados:
+            encontradas, pequenas, extra, tiempos = [], [], 0, []
+            for nombre_img, img in imagenes:
+                referencia = referencias[nombre_img]
+                for _ in range(args.repeticiones):
+                    cajas, segundos = detectar(detectores[nombre], img, lado or None)
+                    tiempos.append(segundos)
+                marcas, sobrantes = emparejar(referencia, cajas)
+                encontradas.extend(marcas)
+                extra += sobrantes
+                pequenas.extend(
+                    m for m, c in zip(marcas, referencia)
+                    if min(c[2] - c[0], c[3] - c[1]) < args.lado_pequena
+                )
+            fila = {
+                "detector": nombre,
+                "max_lado": lado,
+                "recall": round(float(np.mean(encontradas)), 4) if encontradas else None,
+                "recall_pequenas": round(float(np.mean(pequenas)), 4) if pequenas else None,
+                "caras_pequenas": len(pequenas),
+                "caras_extra": extra,
+                "p50_ms": round(percentil(tiempos, 50), 1),
+                "p95_ms": round(percentil(tiempos, 95), 1),
+                "imagenes_por_segundo": round(len(tiempos) / sum(tiempos), 2) if sum(tiempos) else None,
+            }
+            resultados.append(fila)
+            print(f"{nombre:>11} {lado:>9} {formato(fila['recall']):>7} {formato(fila['recall_pequenas']):>7} "
+                  f"{extra:>6} {fila['p50_ms']:>8.1f} {fila['p95_ms']:>8.1f} {formato(fila['imagenes_por_segundo']):>7}")
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump({
+                "referencia": origen,
+                "imagenes": len(imagenes),
+                "caras_referencia": total_ref,
+                "umbral": args.umbral,
+                "resultados": resultados,
+            }, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Detección de caras consciente de la resolución.
+
+El detector se ejecuta sobre una copia reducida de la imagen (lado mayor
+limitado a `max_lado`) y las cajas y landmarks se devuelven en coordenadas de
+la imagen original. Opcionalmente se hace una segunda pasada a resolución
+completa solo en las zonas alrededor de las caras pequeñas, que es donde la
+reducción puede haber hecho perder otras caras.
+
+Para imágenes muy grandes (escaneos, panorámicas) `detectar_teselas` divide
+la imagen en teselas solapadas, detecta en cada una y fusiona con NMS las
+caras repetidas en las costuras.
+
+Las funciones reciben el detector como parámetro: cualquier función que
+acepte una imagen y devuelva un diccionario con el formato de
+`RetinaFace.detect_faces` ({"face_1": {"score", "facial_area", "landmarks"}, ...}),
+como el método `detectar` de los detectores de `detectores.py`.
+"""
+import cv2
+import numpy as np
+
+
+def normalizar(resp):
+    """
+    Convierte la salida del detector en una lista de caras.
+
+    :param resp: Diccionario devuelto por el detector (o tupla vacía si no hay caras)
+    :return: Lista de diccionarios con "facial_area" (floats), "score" y "landmarks"
+    """
+    caras = []
+    if not isinstance(resp, dict):
+        return caras
+    for item in resp.values():
+        if not item.get("facial_area"):
+            continue
+        caras.append({
+            "facial_area": [float(v) for v in item["facial_area"]],
+            "score": float(item.get("score", 0)),
+            "landmarks": {k: [float(v) for v in p] for k, p in (item.get("landmarks") or {}).items()},
+        })
+    return caras
+
+
+def transformar(cara, escala, dx=0.0, dy=0.0):
+    """
+    Lleva una cara a otro sistema de coordenadas: multiplica por `escala` y desplaza (dx, dy).
+
+    :param cara: Cara con "facial_area" y "landmarks"
+    :param escala: Factor de escala
+    :param dx: Desplazamiento horizontal tras escalar
+    :param dy: Desplazamiento vertical tras escalar
+    :return: Nueva cara transformada
+    """
+    x1, y1, x2, y2 = cara["facial_area"]
+    return {
+        "facial_area": [x1 * escala + dx, y1 * escala + dy, x2 * escala + dx, y2 * escala + dy],
+        "score": cara["score"],
+        "landmarks": {k: [x * escala + dx, y * escala + dy] for k, (x, y) in cara["landmarks"].items()},
+    }
+
+
+def nms(caras, umbral_iou=0.4, umbral_contencion=None):
+    """
+    Supresión de no máximos: elimina las cajas duplicadas quedándose con la de mayor puntuación.
+
+    :param caras: Lista de caras con "facial_area" y "score"
+    :param umbral_iou: IoU a partir del cual dos cajas se consideran la misma cara
+    :param umbral_contencion: Si se indica, también se suprime una caja cuya intersección
+        cubre esta fracción de la más pequeña (cajas cortadas en los bordes de una tesela).
+        La caja conservada se amplía a la unión con las suprimidas por contención, porque
+        la de mayor puntuación puede ser justo el trozo recortado en la costura
+    :return: Lista de caras sin duplicados, ordenada por puntuación descendente
+    """
+    if not caras:
+        return []
+    cajas = np.array([c["facial_area"] for c in caras], dtype=np.float64)
+    orden = np.argsort([-c["score"] for c in caras], kind="stable")
+    areas = np.maximum(cajas[:, 2] - cajas[:, 0], 0) * np.maximum(cajas[:, 3] - cajas[:, 1], 0)
+
+    conservadas = []
+    uniones = {}
+    while orden.size:
+        i = orden[0]
+        conservadas.append(i)
+        resto = orden[1:]
+        ix1 = np.maximum(cajas[i, 0], cajas[resto, 0])
+        iy1 = np.maximum(cajas[i, 1], cajas[resto, 1])
+        ix2 = np.minimum(cajas[i, 2], cajas[resto, 2])
+        iy2 = np.minimum(cajas[i, 3], cajas[resto, 3])
+        interseccion = np.maximum(ix2 - ix1, 0) * np.maximum(iy2 - iy1, 0)
+        union = areas[i] + areas[resto] - interseccion
+        iou = np.where(union > 0, interseccion / np.maximum(union, 1e-9), 0)
+        duplicada = iou > umbral_iou
+        if umbral_contencion is not None:
+            menor = np.minimum(areas[i], areas[resto])
+            contenida = (interseccion / np.maximum(menor, 1e-9)) > umbral_contencion
+            if contenida.any():
+                grupo = cajas[np.append(resto[contenida], i)]
+                uniones[i] = [grupo[:, 0].min(), grupo[:, 1].min(), grupo[:, 2].max(), grupo[:, 3].max()]
+            duplicada |= contenida
+        orden = resto[~duplicada]
+    return [
+        {**caras[i], "facial_area": [float(v) for v in uniones[i]]} if i in uniones else caras[i]
+        for i in conservadas
+    ]
+
+
+def regiones_caras_pequenas(caras, escala, lado_minimo, alto, ancho, factor_contexto=4.0, lado_region=512):
+    """
+    Calcula las zonas de la imagen original donde conviene una segunda pasada:
+    alrededor de cada cara que, en la imagen reducida, mide menos de `lado_minimo`.
+    Las zonas que se solapan se fusionan.
+
+    :param caras: Caras en coordenadas de la imagen original
+    :param escala: Factor de reducción aplicado en la primera pasada (< 1)
+    :param lado_minimo: Lado (px, en la imagen reducida) por debajo del cual una cara es pequeña
+    :param alto: Alto de la imagen original
+    :param ancho: Ancho de la imagen original
+    :param factor_contexto: Tamaño de la zona respecto a la cara
+    :param lado_region: Lado mínimo de cada zona (px, en la imagen original)
+    :return: Lista de zonas (x1, y1, x2, y2) en enteros
+    """
+    regiones = []
+    for cara in caras:
+        x1, y1, x2, y2 = cara["facial_area"]
+        lado = min(x2 - x1, y2 - y1)
+        if lado * escala >= lado_minimo:
+            continue
+        mitad = max(lado * factor_contexto, lado_region) / 2.0
+        cx, cy = (x1 + x2) / 2.0, (y1 + y2) / 2.0
+        regiones.append([
+            max(int(cx - mitad), 0), max(int(cy - mitad), 0),
+            min(int(cx + mitad), ancho), min(int(cy + mitad), alto),
+        ])
+
+    # Fusionar zonas solapadas hasta que no quede ninguna intersección
+    fusionadas = True
+    while fusionadas:
+        fusionadas = False
+        for i in range(len(regiones)):
+            for j in range(i + 1, len(regiones)):
+                a, b = regiones[i], regiones[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regiones[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del regiones[j]
+                    fusionadas = True
+                    break
+            if fusionadas:
+                break
+    return [tuple(r) for r in regiones]
+
+
+def detectar_escalado(detector, img, max_lado=None, segunda_pasada=False,
+                      lado_cara_pequena=24, max_regiones=8):
+    """
+    Detecta caras sobre una versión reducida de la imagen y devuelve las cajas en
+    coordenadas originales.
+
+    :param detector: Función imagen -> diccionario con el formato de RetinaFace
+    :param img: Imagen a resolución original (en el formato que espere el detector)
+    :param max_lado: Lado mayor máximo para la detección (None o 0 para no reducir)
+    :param segunda_pasada: Si se repite la detección a resolución completa alrededor de las caras pequeñas
+    :param lado_cara_pequena: Lado (px, en la imagen reducida) por debajo del cual una cara es pequeña
+    :param max_regiones: Número máximo de zonas de la segunda pasada
+    :return: Lista de caras con "facial_area" (floats), "score" y "landmarks"
+    """
+    alto, ancho = img.shape[:2]
+    escala = 1.0
+    reducida = img
+    if max_lado and max(alto, ancho) > max_lado:
+        escala = max_lado / float(max(alto, ancho))
+        tamano = (max(int(round(ancho * escala)), 1), max(int(round(alto * escala)), 1))
+        reducida = cv2.resize(img, tamano, interpolation=cv2.INTER_AREA)
+        # Escala real de cada eje tras el redondeo
+        escala_x = tamano[0] / float(ancho)
+        escala_y = tamano[1] / float(alto)
+    else:
+        escala_x = escala_y = 1.0
+
+    caras = []
+    for cara in normalizar(detector(reducida)):
+        x1, y1, x2, y2 = cara["facial_area"]
+        caras.append({
+            "facial_area": [x1 / escala_x, y1 / escala_y, x2 / escala_x, y2 / escala_y],
+            "score": cara["score"],
+            "landmarks": {k: [x / escala_x, y / escala_y] for k, (x, y) in cara["landmarks"].items()},
+        })
+
+    if segunda_pasada and escala < 1.0:
+        regiones = regiones_caras_pequenas(caras, escala, lado_cara_pequena, alto, ancho)
+        for x1, y1, x2, y2 in regiones[:max_regiones]:
+            tesela = np.ascontiguousarray(img[y1:y2, x1:x2])
+            caras.extend(transformar(c, 1.0, x1, y1) for c in normalizar(detector(tesela)))
+        caras = nms(caras, umbral_iou=0.4, umbral_contencion=0.8)
+
+    return caras
+
+
+def formatear(caras):
+    """
+    Convierte las caras al formato de detecciones de la API.
+
+    :param caras: Lista de caras con "facial_area", "score" y "landmarks"
+    :return: Lista de detecciones con "bbox" (enteros), "confidence", "id" y "landmarks"
+    """
+    detecciones = []
+    for i, cara in enumerate(caras, start=1):
+        detecciones.append({
+            "bbox": [int(v) for v in cara["facial_area"]],
+            "confidence": float(cara["score"]),
+            "id": f"face_{i}",  # Identificador único de cara
+            "landmarks": {k: [float(x), float(y)] for k, (x, y) in cara["landmarks"].items()},
+        })
+    return detecciones
+
+
+def generar_teselas(alto, ancho, lado, solape):
+    """
+    Divide la imagen en teselas cuadradas solapadas que la cubren por completo.
+
+    :param alto: Alto de la imagen
+    :param ancho: Ancho de la imagen
+    :param lado: Lado de cada tesela en píxeles
+    :param solape: Píxeles compartidos entre teselas vecinas
+    :return: Lista de teselas (x1, y1, x2, y2)
+    """
+    paso = max(lado - solape, 1)
+
+    def inicios(total):
+        if total <= lado:
+            return [0]
+        posiciones = list(range(0, total - lado, paso))
+        # La última tesela se alinea con el borde para no dejar una tira estrecha
+        posiciones.append(total - lado)
+        return posiciones
+
+    return [
+        (x, y, min(x + lado, ancho), min(y + lado, alto))
+        for y in inicios(alto)
+        for x in inicios(ancho)
+    ]
+
+
+def detectar_teselas(detector, img, lado_tesela=1024, solape=128, hilos=1, max_lado_global=None):
+    """
+    Detecta caras en una imagen grande por teselas solapadas y fusiona las
+    detecciones repetidas en las costuras con NMS. Cada inferencia trabaja
+    sobre una sola tesela, así que la memoria por inferencia está acotada.
+
+    Si se indica `max_lado_global`, se añade una pasada sobre la imagen
+    completa reducida para encontrar las caras mayores que una tesela.
+
+    :param detector: Función imagen -> diccionario con el formato de RetinaFace
+    :param img: Imagen completa (en el formato que espere el detector)
+    :param lado_tesela: Lado de cada tesela en píxeles
+    :param solape: Píxeles compartidos entre teselas vecinas
+    :param hilos: Número de teselas que se procesan en paralelo
+    :param max_lado_global: Lado mayor de la pasada global reducida (None para omitirla)
+    :return: Lista de caras con "facial_area", "score" y "landmarks" en coordenadas de la imagen
+    """
+    alto, ancho = img.shape[:2]
+    teselas = generar_teselas(alto, ancho, lado_tesela, solape)
+
+    def procesar(tesela):
+        x1, y1, x2, y2 = tesela
+        recorte = np.ascontiguousarray(img[y1:y2, x1:x2])
+        return [transformar(c, 1.0, x1, y1) for c in normalizar(detector(recorte))]
+
+    caras = []
+    if hilos > 1 and len(teselas) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+            for resultado in ejecutor.map(procesar, teselas):
+                caras.extend(resultado)
+    else:
+        for tesela in teselas:
+            caras.extend(procesar(tesela))
+
+    if max_lado_global and len(teselas) > 1:
+        caras.extend(detectar_escalado(detector, img, max_lado=max_lado_global))
+
+    # Las caras cortadas por el borde de una tesela quedan contenidas en su detección completa;
+    # la caja que sobrevive se amplía a la unión para no perder la parte fuera de la tesela
+    return nms(caras, umbral_iou=0.4, umbral_contencion=0.7)
@@ -0,0 +1,180 @@
+"""
+Detectores de caras del servicio Bounding.
+
+El servicio elige el detector con `DETECTOR`:
+
+* `retinaface` (por defecto): `retina-face` sobre TensorFlow. Es el más
+  preciso con caras pequeñas, de perfil o parcialmente tapadas, y el más lento.
+* `yunet`: el detector YuNet de OpenCV (`cv2.FaceDetectorYN`, modelo ONNX de
+  unos 230 KB). Solo necesita `opencv-python-headless`.
+
+Cada detector describe con `configuracion()` lo que determina sus resultados
+(umbral, modelo), que el servicio publica como su versión.
+
+Todos reciben una imagen BGR y devuelven un diccionario con el formato de
+`RetinaFace.detect_faces` ({"face_1": {"score", "facial_area", "landmarks"}, ...}),
+que es el que esperan las funciones de `deteccion.py`, así que la reducción,
+la segunda pasada, las teselas y el formato de `detecciones` son los mismos
+con cualquier detector. Las dependencias de cada detector se importan solo al
+crearlo.
+"""
+import hashlib
+import os
+import threading
+from importlib import metadata
+
+import cv2
+import numpy as np
+
+DETECTORES = ("retinaface", "yunet")
+
+# Modelo de YuNet por defecto (opencv_zoo, face_detection_yunet_2023mar.onnx)
+RUTA_YUNET = "./face_detection_yunet_2023mar.onnx"
+
+# Orden de los landmarks en la salida de YuNet, con los nombres de RetinaFace
+LANDMARKS_YUNET = ("right_eye", "left_eye", "nose", "mouth_right", "mouth_left")
+
+
+class DetectorRetinaFace:
+    """
+    RetinaFace (retina-face) sobre TensorFlow.
+    """
+
+    nombre = "retinaface"
+
+    def __init__(self, umbral=0.9):
+        from retinaface import RetinaFace
+        self._retinaface = RetinaFace
+        self.umbral = umbral
+
+    def configuracion(self):
+        """
+        :return: Diccionario con lo que determina las detecciones (para la versión del servicio)
+        """
+        try:
+            paquete = metadata.version("retina-face")
+        except metadata.PackageNotFoundError:
+            paquete = None
+        return {"detector": self.nombre, "umbral": self.umbral, "retina-face": paquete}
+
+    def calentar(self):
+        """
+        Construye el modelo y ejecuta una detección de prueba.
+        """
+        self._retinaface.build_model()
+        self.detectar(np.zeros((64, 64, 3), dtype=np.uint8))
+
+    def detectar(self, img_bgr):
+        """
+        :param img_bgr: Imagen BGR
+        :return: Diccionario con el formato de RetinaFace.detect_faces
+        """
+        # RetinaFace trabaja en RGB: la conversión se hace solo sobre la imagen reducida o la tesela
+        return self._retinaface.detect_faces(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB), threshold=self.umbral)
+
+
+class DetectorYuNet:
+    """
+    YuNet (cv2.FaceDetectorYN) sobre el módulo DNN de OpenCV.
+    """
+
+    nombre = "yunet"
+
+    def __init__(self, ruta=RUTA_YUNET, umbral=0.9, umbral_nms=0.3, max_caras=5000):
+        if not hasattr(cv2, "FaceDetectorYN"):
+            raise RuntimeError("YuNet necesita OpenCV 4.5.4 o posterior")
+        if not os.path.exists(ruta):
+            raise FileNotFoundError(f"No existe el modelo de YuNet: {ruta}")
+        self.ruta = ruta
+        self.umbral = umbral
+        self.umbral_nms = umbral_nms
+        self.max_caras = max_caras
+        # Cada instancia guarda el tamaño de entrada: una por hilo (peticiones y teselas en paralelo)
+        self._local = threading.local()
+
+    def _instancia(self):
+        detector = getattr(self._local, "detector", None)
+        if detector is None:
+            detector = cv2.FaceDetectorYN.create(
+                self.ruta, "", (320, 320), self.umbral, self.umbral_nms, self.max_caras
+            )
+            self._local.detector = detector
+        return detector
+
+    def configuracion(self):
+        """
+        :return: Diccionario con lo que determina las detecciones (para la versión del servicio)
+        """
+        suma = hashlib.sha256()
+        with open(self.ruta, "rb") as f:
+            for bloque in iter(lambda: f.read(1024 * 1024), b""):
+                suma.update(bloque)
+        return {
+            "detector": self.nombre, "umbral": self.umbral, "umbral_nms": self.umbral_nms,
+            "max_caras": self.max_caras, "modelo": suma.hexdigest(),
+        }
+
+    def calentar(self):
+        """
+        Carga el modelo y ejecuta una detección de prueba.
+        """
+        self.detectar(np.zeros((64, 64, 3), dtype=np.uint8))
+
+    def detectar(self, img_bgr):
+        """
+        :param img_bgr: Imagen BGR
+        :return: Diccionario con el formato de RetinaFace.detect_faces
+        """
+        alto, ancho = img_bgr.shape[:2]
+        detector = self._instancia()
+        detector.setInputSize((ancho, alto))
+        _, caras = detector.detect(np.ascontiguousarray(img_bgr))
+
+        resultado = {}
+        if caras is None:
+            return resultado
+        for i, fila in enumerate(caras, start=1):
+            x, y, w, h = (float(v) for v in fila[:4])
+            # Las cajas de YuNet pueden salirse de la imagen
+            x1, y1 = max(x, 0.0), max(y, 0.0)
+            x2, y2 = min(x + w, float(ancho)), min(y + h, float(alto))
+            if x2 <= x1 or y2 <= y1:
+                continue
+            resultado[f"face_{i}"] = {
+                "score": float(fila[14]),
+                "facial_area": [x1, y1, x2, y2],
+                "landmarks": {
+                    nombre: [float(fila[4 + 2 * j]), float(fila[5 + 2 * j])]
+                    for j, nombre in enumerate(LANDMARKS_YUNET)
+                },
+            }
+        return resultado
+
+
+def crear_detector(nombre, umbral=0.9, ruta=None):
+    """
+    :param nombre: "retinaface" o "yunet"
+    :param umbral: Puntuación mínima de una cara
+    :param ruta: Archivo del modelo (solo YuNet; por defecto RUTA_YUNET)
+    :return: Detector con los métodos `detectar(img_bgr)` y `calentar()`
+    :raises ValueError: Si el detector no existe
+    """
+    nombre = nombre.lower()
+    if nombre not in DETECTORES:
+        raise ValueError(f"Detector desconocido: {nombre} (use {', '.join(DETECTORES)})")
+    if nombre == "retinaface":
+        return DetectorRetinaFace(umbral)
+    return DetectorYuNet(ruta or RUTA_YUNET, umbral)
+
+
+def crear_detector_desde_entorno():
+    """
+    Crea el detector según `DETECTOR`, `UMBRAL_DETECCION` y `MODELO_YUNET`.
+
+    :return: Detector con los métodos `detectar(img_bgr)` y `calentar()`
+    """
+    return crear_detector(
+        os.environ.get("DETECTOR", "retinaface"),
+        float(os.environ.get("UMBRAL_DETECCION", "0.9")),
+        os.environ.get("MODELO_YUNET") or None,
+    )
@@ -1,15 +1,153 @@
 from flask import Flask, jsonify, request
 import numpy as np
 import cv2
-from keras.models import load_model
 import json
+import os
+import threading
+import atexit
+from planificador_lotes import PlanificadorLotes
+from backends_modelo import crear_backend_desde_entorno
+from cache_caras import crear_cache_caras_desde_entorno, hashes_perceptuales, suma_modelo
+import formato_caras
+import instrumentacion
+import servicio
+import validacion
 
 # Create the Flask application
 app = Flask(__name__)
 
+# El servicio no recibe tráfico (GET /listo) hasta que el modelo está cargado y calentado
+servicio.requerir("modelo_edad")
+servicio.registrar_listo(app)
+instrumentacion.registrar(app, "clasificacion")
+
 # Allowed image file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+# Límites de cada cara recibida: tamaño de archivo y píxeles (comprobados antes de decodificar)
+MAX_BYTES_CARA = int(float(os.environ.get("MAX_MB_ARCHIVO", "10")) * 1024 * 1024)
+MAX_PIXELES_CARA = int(float(os.environ.get("MAX_MEGAPIXELES", "25")) * 1_000_000)
+
+# Tamaño de entrada y umbral de clasificación. El backend de inferencia
+# (keras, tflite u onnx) y su archivo se eligen con MODELO_BACKEND y MODELO_RUTA
+# (ver backends_modelo.py y exportar_modelo.py)
+INPUT_SIZE = 64
+UMBRAL = 0.6
+
+# Modelo compartido por todo el proceso (se carga una única vez)
+_modelo = None
+_modelo_lock = threading.Lock()
+
+# Caché de probabilidades por cara (hash perceptual, ver cache_caras.py); se
+# asocia a la suma del archivo del modelo al cargarlo. Con CACHE_CARAS_RUTA se
+# vuelca al terminar el proceso y se recupera al arrancar con el mismo modelo
+cache_caras = crear_cache_caras_desde_entorno()
+CACHE_CARAS_RUTA = os.environ.get("CACHE_CARAS_RUTA", "")
+# Las caras cuya probabilidad guardada está a menos de este margen del umbral se
+# vuelven a pasar por el modelo: ahí una coincidencia falsa cambiaría la decisión
+CACHE_CARAS_MARGEN = float(os.environ.get("CACHE_CARAS_MARGEN", "0.05"))
+if cache_caras is not None:
+    for nombre, clave in (("aciertos", "aciertos"), ("fallos", "fallos"), ("entradas", "entradas")):
+        instrumentacion.registrar_indicador(
+            f"pixelar_cache_caras_{nombre}", f"Caché de caras: {nombre}",
+            lambda clave=clave: cache_caras.estadisticas()[clave]
+        )
+    if CACHE_CARAS_RUTA:
+        atexit.register(lambda: cache_caras.volcar(CACHE_CARAS_RUTA))
+
+def obtener_modelo():
+    """
+    Devuelve el modelo de clasificación, cargándolo la primera vez que se pide.
+    Tras la carga se hace una inferencia de calentamiento para que la primera
+    petición real no pague la inicialización del grafo.
+
+    :return: Backend del modelo cargado (con el método `predecir`)
+    """
+    global _modelo
+    if _modelo is None:
+        with _modelo_lock:
+            if _modelo is None:
+                modelo = crear_backend_desde_entorno()
+                modelo.predecir(np.zeros((1, INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32))
+                suma = suma_modelo(modelo.ruta)
+                # El modelo y el umbral forman parte de la versión del servicio (caché del Engine)
+                servicio.fijar_version("clasificacion", {
+                    "backend": modelo.nombre, "modelo": suma, "umbral": UMBRAL, "entrada": INPUT_SIZE,
+                })
+                if cache_caras is not None:
+                    cache_caras.fijar_version(suma)
+                    if CACHE_CARAS_RUTA:
+                        cache_caras.cargar(CACHE_CARAS_RUTA)
+                _modelo = modelo
+                servicio.marcar_listo("modelo_edad")
+    return _modelo
+
+def inferir(lote):
+    """
+    Ejecuta el modelo sobre un lote ya normalizado.
+
+    :param lote: Array float32 de Nx64x64x3 con valores en [0, 1]
+    :return: Array con la predicción del modelo para cada cara
+    """
+    # Con el planificador se ejecuta en su hilo: cuenta en el histograma, no en la traza de la petición
+    with instrumentacion.medir("inferencia"):
+        return obtener_modelo().predecir(lote)
+
+# Agrupación de caras de peticiones concurrentes en un único lote de inferencia
+LOTE_ACTIVADO = os.environ.get("LOTE_ACTIVADO", "true").lower() == "true"
+planificador = PlanificadorLotes(
+    inferir,
+    max_caras=int(os.environ.get("LOTE_MAX_CARAS", "32")),
+    max_espera_ms=float(os.environ.get("LOTE_MAX_ESPERA_MS", "5")),
+) if LOTE_ACTIVADO else None
+if planificador is not None:
+    instrumentacion.registrar_indicador(
+        "pixelar_clasificacion_caras_en_cola", "Caras esperando a formar un lote",
+        lambda: planificador.metricas()["caras_en_cola"]
+    )
+
+def inferir_caras(caras):
+    """
+    Ejecuta el modelo sobre las caras, en el planificador si está activo.
+
+    :param caras: Lista o array de imágenes BGR de 64x64
+    :return: Lista de probabilidades (float)
+    """
+    lote = np.stack(caras).astype(np.float32) / 255.0
+    if planificador is not None:
+        predicciones = planificador.predecir(lote)
+    else:
+        predicciones = inferir(lote)
+    return [float(p[0]) for p in predicciones]
+
+def predecir_lote(caras):
+    """
+    Clasifica todas las caras de una petición en una única inferencia. Si el
+    planificador está activo, la inferencia se comparte con otras peticiones
+    concurrentes. Con la caché de caras activa, solo pasan por el modelo las
+    caras cuyo hash perceptual no está (ni a la distancia de Hamming permitida)
+    y las que tienen guardada una probabilidad a menos de CACHE_CARAS_MARGEN del umbral.
+
+    :param caras: Lista de imágenes BGR ya redimensionadas a 64x64
+    :return: Lista de probabilidades (float), una por cara y en el mismo orden
+    """
+    if len(caras) == 0:
+        return []
+    if cache_caras is None:
+        return inferir_caras(caras)
+
+    with instrumentacion.medir("cache_caras"):
+        hashes = hashes_perceptuales(caras)
+        probabilidades = [cache_caras.buscar(h) for h in hashes]
+    pendientes = [
+        i for i, p in enumerate(probabilidades) if p is None or abs(p - UMBRAL) < CACHE_CARAS_MARGEN
+    ]
+    if pendientes:
+        for i, probabilidad in zip(pendientes, inferir_caras([caras[i] for i in pendientes])):
+            probabilidades[i] = probabilidad
+            cache_caras.guardar(hashes[i], probabilidad)
+    return [float(p) for p in probabilidades]
+
 def allowed_file(filename):
     """
     Comprueba que el archivo subido sea compatible para la detección de caras (que sea imagen).
@@ -20,33 +158,103 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def validate_image(file):
+def leer_imagen(file):
     """
-    Valida la imagen antes de la detección de caras.
+    Lee la imagen subida, la valida a partir de su cabecera (tamaño, bytes mágicos
+    y número de píxeles) y la decodifica una sola vez.
     
-    :param file: Archivo de imagen a validar
+    :param file: Archivo de imagen
+    :return: Imagen BGR decodificada
     :raises ValueError: Si la imagen no es válida
     """
-    # Verificar tamaño máximo (por ejemplo, 10MB)
-    file.seek(0, 2)  # Mover al final del archivo
-    file_size = file.tell()
-    file.seek(0)  # Reiniciar puntero de archivo
-    
-    if file_size > 10 * 1024 * 1024:  # 10MB
-        raise ValueError("El tamaño del archivo excede el límite de 10MB")
-    
-    # Intentar abrir la imagen para validarla
+    return validacion.decodificar(file.read(), max_bytes=MAX_BYTES_CARA, max_pixeles=MAX_PIXELES_CARA)
+
+def detalle_error(i, mensaje):
+    """
+    Construye la entrada de detalle de una imagen que no se ha podido clasificar.
+
+    :param i: Posición de la imagen en la petición
+    :param mensaje: Descripción del error
+    :return: Diccionario con el formato de "detalle"
+    """
+    return {
+        "imagen_id": i,
+        "probabilidad": 0.0,
+        "es_menor": False,
+        "error": mensaje
+    }
+
+def completar_predicciones(caras, indices, resultados, resultados_detalle):
+    """
+    Clasifica las caras válidas en una sola llamada y rellena sus posiciones en
+    las listas de resultados.
+
+    :param caras: Lista de caras BGR ya redimensionadas a 64x64
+    :param indices: Posición original de cada cara en la petición
+    :param resultados: Lista de 0/1 a completar
+    :param resultados_detalle: Lista de detalle a completar
+    """
+    # Predicción binaria de todas las caras en una sola llamada
     try:
-        # Validamos y abrimos la imagen con cv2 
-        img_bytes = file.read()
-        file.seek(0)  # Reset file pointer
-        img_np = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
-        
-        if img_np is None or img_np.size == 0:
-            raise ValueError("No se puede leer la imagen")
-        
+        probabilidades = predecir_lote(caras)
     except Exception as e:
-        raise ValueError(f"Archivo de imagen no válido: {str(e)}")
+        for i in indices:
+            resultados_detalle[i] = detalle_error(i, f"Error al procesar imagen: {str(e)}")
+        return
+
+    for i, probabilidad_raw in zip(indices, probabilidades):
+        # Umbral de 0.6 para clasificar como menor
+        es_menor = probabilidad_raw < UMBRAL
+        resultados[i] = int(es_menor)
+        resultados_detalle[i] = {
+            "imagen_id": i,
+            "probabilidad": probabilidad_raw,
+            "es_menor": es_menor,
+            "confianza": abs(probabilidad_raw - UMBRAL),  # Qué tan lejos está del umbral
+            "umbral_usado": UMBRAL
+        }
+
+def formatear_respuesta(resultados, resultados_detalle, debug_mode):
+    """
+    Da a los resultados el formato de respuesta de /menores.
+
+    :param resultados: Lista de 0/1
+    :param resultados_detalle: Lista de detalle por imagen
+    :param debug_mode: Si es True se devuelve la salida detallada
+    :return: Lista de 0/1 o diccionario con el detalle (modo debug)
+    """
+    if debug_mode:
+        return {
+            "resultados": resultados,
+            "detalle": resultados_detalle,
+            "debug": True,
+            "total_imagenes": len(resultados),
+            "menores_detectados": sum(resultados)
+        }
+    return resultados
+
+def clasificar_caras(caras, debug_mode=False):
+    """
+    Clasifica recortes de caras ya decodificados, sin pasar por HTTP.
+
+    :param caras: Lista de recortes BGR de cualquier tamaño
+    :param debug_mode: Si es True se devuelve la salida detallada
+    :return: Misma estructura que devuelve el endpoint /menores
+    """
+    resultados = [0] * len(caras)
+    resultados_detalle = [None] * len(caras)
+    redimensionadas = []
+    indices = []
+
+    for i, cara in enumerate(caras):
+        if cara is None or cara.size == 0:
+            resultados_detalle[i] = detalle_error(i, "No se pudo decodificar la imagen")
+            continue
+        redimensionadas.append(cv2.resize(cara, (INPUT_SIZE, INPUT_SIZE)))
+        indices.append(i)
+
+    completar_predicciones(redimensionadas, indices, resultados, resultados_detalle)
+    return formatear_respuesta(resultados, resultados_detalle, debug_mode)
 
 @app.route("/menores", methods=["POST"])
 def detectar_menores():
@@ -62,105 +270,91 @@ def detectar_menores():
         # Verificar si está activado el modo debug
         debug_mode = request.form.get('debug', 'false').lower() == 'true'
 
-        # Cargar el modelo
+        # Cargar el modelo (solo la primera vez en el proceso)
         try:
-            model = load_model("./modelo.keras")
+            obtener_modelo()
         except Exception as e:
             return jsonify({"error": "Error al cargar el modelo.", "detalle": str(e)}), 500
 
         # Leer las imágenes
         archivos = request.files.getlist("imagenes")
-        resultados = []
-        resultados_detalle = []
+        resultados = [0] * len(archivos)
+        resultados_detalle = [None] * len(archivos)
+
+        # Caras válidas pendientes de clasificar y su posición original
+        caras = []
+        indices = []
 
         for i, archivo in enumerate(archivos):
             if archivo.filename == '':
-                resultado_simple = 0
-                resultado_detallado = {
-                    "imagen_id": i,
-                    "probabilidad": 0.0,
-                    "es_menor": False,
-                    "error": "Archivo vacío"
-                }
-                resultados.append(resultado_simple)
-                resultados_detalle.append(resultado_detallado)
+                resultados_detalle[i] = detalle_error(i, "Archivo vacío")
                 continue
 
             if not allowed_file(archivo.filename):
-                resultado_simple = 0
-                resultado_detallado = {
-                    "imagen_id": i,
-                    "probabilidad": 0.0,
-                    "es_menor": False,
-                    "error": "Tipo de archivo no permitido"
-                }
-                resultados.append(resultado_simple)
-                resultados_detalle.append(resultado_detallado)
+                resultados_detalle[i] = detalle_error(i, "Tipo de archivo no permitido")
                 continue
 
             try:
-                validate_image(archivo)
-
-                file_bytes = np.frombuffer(archivo.read(), np.uint8)
-                image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-
-                if image is None:
-                    resultado_simple = 0
-                    resultado_detallado = {
-                        "imagen_id": i,
-                        "probabilidad": 0.0,
-                        "es_menor": False,
-                        "error": "No se pudo decodificar la imagen"
-                    }
-                    resultados.append(resultado_simple)
-                    resultados_detalle.append(resultado_detallado)
-                    continue
-
-                resized = cv2.resize(image, (64, 64))
-                normalized = resized / 255.0
-                input_data = np.expand_dims(normalized, axis=0)
-
-                # Predicción binaria directamente del modelo
-                prediccion = model.predict(input_data)
-                probabilidad_raw = float(prediccion[0][0])
-                
-                # Umbral de 0.6 para clasificar como menor
-                es_menor = probabilidad_raw < 0.6
-                resultado_simple = int(es_menor)
-                
-                resultado_detallado = {
-                    "imagen_id": i,
-                    "probabilidad": probabilidad_raw,
-                    "es_menor": es_menor,
-                    "confianza": abs(probabilidad_raw - 0.6),  # Qué tan lejos está del umbral
-                    "umbral_usado": 0.6
-                }
-                
-                resultados.append(resultado_simple)
-                resultados_detalle.append(resultado_detallado)
+                # Validar la cabecera y decodificar una sola vez
+                with instrumentacion.medir("decodificacion"):
+                    image = leer_imagen(archivo)
+
+                with instrumentacion.medir("recorte"):
+                    caras.append(cv2.resize(image, (INPUT_SIZE, INPUT_SIZE)))
+                indices.append(i)
 
             except Exception as e:
-                resultado_simple = 0
-                resultado_detallado = {
-                    "imagen_id": i,
-                    "probabilidad": 0.0,
-                    "es_menor": False,
-                    "error": f"Error al procesar imagen: {str(e)}"
-                }
-                resultados.append(resultado_simple)
-                resultados_detalle.append(resultado_detallado)
+                resultados_detalle[i] = detalle_error(i, f"Error al procesar imagen: {str(e)}")
+
+        with instrumentacion.medir("clasificacion"):
+            completar_predicciones(caras, indices, resultados, resultados_detalle)
 
         # Retornar respuesta según el modo
-        if debug_mode:
+        return jsonify(formatear_respuesta(resultados, resultados_detalle, debug_mode)), 200
+
+    except Exception as e:
+        return jsonify({
+            "error": "Error interno del servidor.",
+            "detalle": str(e)
+        }), 500
+
+
+@app.route("/menores_binario", methods=["POST"])
+def detectar_menores_binario():
+    """
+    Endpoint para clasificar un lote de caras ya redimensionadas y sin comprimir.
+    El cuerpo sigue el formato de `formato_caras` (cabecera + array uint8 de Nx64x64x3 en BGR),
+    así que no hay que validar ni decodificar ninguna imagen.
+    El modo debug se activa con el parámetro de consulta `debug=true`.
+
+    :return: Misma respuesta que /menores
+    """
+    try:
+        debug_mode = request.args.get('debug', 'false').lower() == 'true'
+
+        try:
+            with instrumentacion.medir("decodificacion"):
+                caras = formato_caras.desempaquetar(request.get_data(cache=False))
+        except ValueError as e:
+            return jsonify({"error": f"Lote de caras no válido: {str(e)}"}), 400
+
+        if caras.shape[1:] != (INPUT_SIZE, INPUT_SIZE, 3):
             return jsonify({
-                "resultados": resultados,
-                "detalle": resultados_detalle,
-                "debug": True,
-                "total_imagenes": len(archivos),
-                "menores_detectados": sum(resultados)
-            }), 200
-        else:
-            return jsonify(resultados), 200
+                "error": f"Las caras deben ser de {INPUT_SIZE}x{INPUT_SIZE}x3, se recibió {caras.shape[1:]}"
+            }), 400
+
+        # Cargar el modelo (solo la primera vez en el proceso)
+        try:
+            obtener_modelo()
+        except Exception as e:
+            return jsonify({"error": "Error al cargar el modelo.", "detalle": str(e)}), 500
+
+        resultados = [0] * len(caras)
+        resultados_detalle = [None] * len(caras)
+        with instrumentacion.medir("clasificacion"):
+            completar_predicciones(caras, list(range(len(caras))), resultados, resultados_detalle)
+
+        return jsonify(formatear_respuesta(resultados, resultados_detalle, debug_mode)), 200
 
     except Exception as e:
         return jsonify({
@@ -169,6 +363,30 @@ def detectar_menores():
         }), 500
 
 
+@app.route("/metricas", methods=["GET"])
+def metricas():
+    """
+    Endpoint con las métricas del planificador de lotes.
+
+    :return: Respuesta JSON con la profundidad de la cola y el histograma de tamaños de lote
+    """
+    if planificador is None:
+        return jsonify({"lote_activado": False}), 200
+    return jsonify({"lote_activado": True, **planificador.metricas()}), 200
+
+
+@app.route("/cache", methods=["GET"])
+def estado_cache():
+    """
+    Endpoint con las estadísticas de la caché de caras.
+
+    :return: Respuesta JSON con las entradas, los aciertos (exactos y aproximados) y la tasa de aciertos
+    """
+    if cache_caras is None:
+        return jsonify({"activada": False}), 200
+    return jsonify({"activada": True, **cache_caras.estadisticas()}), 200
+
+
 @app.route("/", methods=["GET"])
 def inicio():
     """
@@ -185,6 +403,12 @@ def inicio():
 # Configuración de la aplicación Flask
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB tamaño máximo de carga
 
+# Carga y calentamiento del modelo al arrancar el proceso
+try:
+    obtener_modelo()
+except Exception as e:
+    print("No se pudo precargar el modelo:", e)
+
 if __name__ == "__main__":
     # Ejecutar la aplicación
     app.run(host="0.0.0.0", port=5002, debug=False)
\ No newline at end of file
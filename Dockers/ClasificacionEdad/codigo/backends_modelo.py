@@ -0,0 +1,157 @@
+"""
+Backends de inferencia del modelo de edad.
+
+El servicio elige el backend con `MODELO_BACKEND`:
+
+* `keras` (por defecto): el modelo original `modelo.keras` con TensorFlow.
+* `tflite`: el modelo exportado con `exportar_modelo.py` (float32 o int8),
+  ejecutado con `tflite_runtime` o, si no está instalado, con `tf.lite`.
+* `onnx`: el modelo exportado a ONNX, ejecutado con `onnxruntime`.
+
+Todos reciben el mismo lote (Nx64x64x3 float32 en [0, 1], BGR, como lo prepara
+el servicio) y devuelven un array Nx1 con la probabilidad de ser adulto. Las
+dependencias de cada backend se importan solo al crearlo, de modo que una
+imagen con `tflite_runtime` u `onnxruntime` no necesita TensorFlow.
+"""
+import os
+import threading
+
+import numpy as np
+
+BACKENDS = ("keras", "tflite", "onnx")
+
+# Archivo del modelo por defecto de cada backend
+RUTAS_POR_DEFECTO = {
+    "keras": "./modelo.keras",
+    "tflite": "./modelo.tflite",
+    "onnx": "./modelo.onnx",
+}
+
+
+class BackendKeras:
+    """
+    Modelo de Keras con TensorFlow.
+    """
+
+    nombre = "keras"
+
+    def __init__(self, ruta):
+        from keras.models import load_model
+        self.ruta = ruta
+        self.modelo = load_model(ruta)
+
+    def predecir(self, lote):
+        """
+        :param lote: Array float32 de Nx64x64x3 con valores en [0, 1]
+        :return: Array Nx1 con la predicción de cada cara
+        """
+        return self.modelo.predict(lote, verbose=0)
+
+
+class BackendTFLite:
+    """
+    Modelo TFLite (float32 o cuantizado a int8 con entrada y salida float32).
+    """
+
+    nombre = "tflite"
+
+    def __init__(self, ruta, hilos=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.ruta = ruta
+        self.interprete = Interpreter(model_path=ruta, num_threads=hilos)
+        self.interprete.allocate_tensors()
+        self.entrada = self.interprete.get_input_details()[0]
+        self.salida = self.interprete.get_output_details()[0]
+        self._tamano_lote = int(self.entrada["shape"][0])
+        # El intérprete no es seguro entre hilos
+        self._lock = threading.Lock()
+
+    def _cuantizar(self, lote):
+        # Modelos con entrada int8/uint8: se aplica la escala de la cuantización
+        escala, cero = self.entrada["quantization"]
+        if self.entrada["dtype"] == np.float32 or not escala:
+            return lote.astype(np.float32, copy=False)
+        info = np.iinfo(self.entrada["dtype"])
+        return np.clip(np.round(lote / escala + cero), info.min, info.max).astype(self.entrada["dtype"])
+
+    def _decuantizar(self, salida):
+        escala, cero = self.salida["quantization"]
+        if self.salida["dtype"] == np.float32 or not escala:
+            return salida.astype(np.float32, copy=False)
+        return (salida.astype(np.float32) - cero) * escala
+
+    def predecir(self, lote):
+        """
+        :param lote: Array float32 de Nx64x64x3 con valores en [0, 1]
+        :return: Array Nx1 con la predicción de cada cara
+        """
+        with self._lock:
+            if len(lote) != self._tamano_lote:
+                self.interprete.resize_tensor_input(self.entrada["index"], list(lote.shape))
+                self.interprete.allocate_tensors()
+                self.entrada = self.interprete.get_input_details()[0]
+                self.salida = self.interprete.get_output_details()[0]
+                self._tamano_lote = len(lote)
+            self.interprete.set_tensor(self.entrada["index"], self._cuantizar(lote))
+            self.interprete.invoke()
+            return self._decuantizar(self.interprete.get_tensor(self.salida["index"])).copy()
+
+
+class BackendONNX:
+    """
+    Modelo ONNX (float32 o cuantizado) con onnxruntime en CPU.
+    """
+
+    nombre = "onnx"
+
+    def __init__(self, ruta, hilos=None):
+        import onnxruntime
+        opciones = onnxruntime.SessionOptions()
+        if hilos:
+            opciones.intra_op_num_threads = int(hilos)
+        self.ruta = ruta
+        self.sesion = onnxruntime.InferenceSession(ruta, opciones, providers=["CPUExecutionProvider"])
+        self.nombre_entrada = self.sesion.get_inputs()[0].name
+
+    def predecir(self, lote):
+        """
+        :param lote: Array float32 de Nx64x64x3 con valores en [0, 1]
+        :return: Array Nx1 con la predicción de cada cara
+        """
+        return self.sesion.run(None, {self.nombre_entrada: lote.astype(np.float32, copy=False)})[0]
+
+
+def crear_backend(nombre, ruta=None, hilos=None):
+    """
+    :param nombre: "keras", "tflite" u "onnx"
+    :param ruta: Archivo del modelo (por defecto el de RUTAS_POR_DEFECTO)
+    :param hilos: Hilos de inferencia de los backends tflite y onnx (None: los del runtime)
+    :return: Backend con el método `predecir(lote)`
+    :raises ValueError: Si el backend no existe
+    """
+    nombre = nombre.lower()
+    if nombre not in BACKENDS:
+        raise ValueError(f"Backend de modelo desconocido: {nombre} (use {', '.join(BACKENDS)})")
+    ruta = ruta or RUTAS_POR_DEFECTO[nombre]
+    if nombre == "keras":
+        return BackendKeras(ruta)
+    if nombre == "tflite":
+        return BackendTFLite(ruta, hilos)
+    return BackendONNX(ruta, hilos)
+
+
+def crear_backend_desde_entorno():
+    """
+    Crea el backend según `MODELO_BACKEND`, `MODELO_RUTA` y `MODELO_HILOS`.
+
+    :return: Backend con el método `predecir(lote)`
+    """
+    hilos = os.environ.get("MODELO_HILOS")
+    return crear_backend(
+        os.environ.get("MODELO_BACKEND", "keras"),
+        os.environ.get("MODELO_RUTA") or None,
+        int(hilos) if hilos else None,
+    )
@@ -0,0 +1,360 @@
+"""
+Caché de probabilidades de edad por cara, direccionada por un hash perceptual.
+
+Las mismas personas (personal de un centro, asistentes habituales, ráfagas de
+fotos casi iguales) aparecen en miles de imágenes. Antes de pasar una cara por
+el modelo se calcula el pHash de 64 bits de su recorte normalizado de 64x64 y
+se busca una cara guardada a una distancia de Hamming de como mucho
+`distancia` bits; si la hay, se devuelve su probabilidad sin inferencia.
+
+El índice guarda millones de entradas en arrays compactos (`array.array`),
+sin un objeto de Python por entrada:
+
+* los hashes, las probabilidades y una lista doblemente enlazada para la
+  expulsión LRU, en arrays de tamaño fijo (`capacidad` entradas);
+* una tabla hash por tramo del hash (búsqueda multi-índice): si dos hashes
+  están a distancia <= d y se parten en d + 1 trozos, al menos un trozo es
+  idéntico, así que basta con mirar el cubo de cada trozo. Con más de 3 bits
+  de tolerancia los trozos serían de menos de 16 bits y, con millones de
+  entradas, los cubos se llenarían de candidatos (y en caras distintas a esa
+  distancia ya hay coincidencias falsas), así que la distancia máxima es 3.
+
+Las entradas llevan la versión del modelo (la suma SHA-256 de su archivo): al
+cambiar de modelo la caché se vacía, y el volcado a disco solo se carga si
+corresponde al modelo actual.
+"""
+import hashlib
+import os
+import threading
+from array import array
+
+import numpy as np
+
+# Bytes de los arrays por entrada (sin las tablas de cada tramo): hash, probabilidad y enlaces LRU
+_BYTES_ENTRADA = 8 + 4 + 4 + 4
+# Bytes por entrada y tramo: enlace en la lista de su cubo y, como mucho, dos cabezas de cubo
+_BYTES_TRAMO = 4 + 8
+MAX_DISTANCIA = 3
+
+_MASCARA_64 = (1 << 64) - 1
+_MEZCLA = 0x9E3779B97F4A7C15
+
+
+def _matriz_dct(n):
+    # Matriz de la DCT-II ortonormal de tamaño n
+    k = np.arange(n).reshape(-1, 1)
+    matriz = np.cos(np.pi * (2 * np.arange(n) + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matriz[0] /= np.sqrt(2.0)
+    return matriz.astype(np.float32)
+
+
+# Solo hacen falta las 8 frecuencias más bajas de la DCT de 32x32
+_DCT_8 = _matriz_dct(32)[:8]
+_PESOS_GRIS = np.array([0.114, 0.587, 0.299], dtype=np.float32)
+
+
+def hashes_perceptuales(caras):
+    """
+    pHash de 64 bits de cada cara: el recorte en gris reducido a 32x32, su DCT
+    y los 8x8 coeficientes de menor frecuencia comparados con su mediana.
+
+    :param caras: Array uint8 de Nx64x64x3 (BGR) o lista de caras de 64x64x3
+    :return: Lista de N enteros de 64 bits
+    """
+    caras = np.asarray(caras)
+    if len(caras) == 0:
+        return []
+    gris = caras.astype(np.float32) @ _PESOS_GRIS
+    n, alto, ancho = gris.shape
+    reducida = gris.reshape(n, 32, alto // 32, 32, ancho // 32).mean(axis=(2, 4))
+    coeficientes = (_DCT_8 @ reducida @ _DCT_8.T).reshape(n, 64)
+    bits = coeficientes > np.median(coeficientes, axis=1, keepdims=True)
+    return [int(h) for h in np.packbits(bits, axis=1).view(">u8").ravel()]
+
+
+def suma_modelo(ruta):
+    """
+    :param ruta: Archivo del modelo (o directorio, p. ej. un SavedModel)
+    :return: Suma SHA-256 en hexadecimal del contenido del modelo
+    """
+    suma = hashlib.sha256()
+    if os.path.isdir(ruta):
+        archivos = sorted(os.path.join(raiz, nombre) for raiz, _, nombres in os.walk(ruta) for nombre in nombres)
+    else:
+        archivos = [ruta]
+    for archivo in archivos:
+        suma.update(os.path.relpath(archivo, ruta).encode("utf-8"))
+        with open(archivo, "rb") as f:
+            for bloque in iter(lambda: f.read(1024 * 1024), b""):
+                suma.update(bloque)
+    return suma.hexdigest()
+
+
+class CacheCaras:
+    """
+    Caché LRU de probabilidades por hash perceptual, con tolerancia de Hamming.
+    """
+
+    def __init__(self, capacidad, distancia=0, version=None):
+        """
+        :param capacidad: Número máximo de caras guardadas
+        :param distancia: Distancia de Hamming máxima (bits) para considerar dos caras iguales (0 a 3)
+        :param version: Versión del modelo (suma de su archivo) a la que corresponden las entradas
+        :raises ValueError: Si la capacidad o la distancia no son válidas
+        """
+        if capacidad < 1:
+            raise ValueError("La capacidad debe ser al menos 1")
+        if not 0 <= distancia <= MAX_DISTANCIA:
+            raise ValueError(f"La distancia debe estar entre 0 y {MAX_DISTANCIA}")
+        self.capacidad = int(capacidad)
+        self.distancia = int(distancia)
+        self.version = version
+        self.tramos = self.distancia + 1
+        anchos = [64 // self.tramos + (1 if i < 64 % self.tramos else 0) for i in range(self.tramos)]
+        self._desplazamientos = [sum(anchos[:i]) for i in range(self.tramos)]
+        self._anchos = anchos
+        # Cubos por tramo: potencia de dos >= capacidad
+        self._bits_cubos = max((self.capacidad - 1).bit_length(), 4)
+        self._lock = threading.Lock()
+        self._vaciar()
+
+        self.aciertos_exactos = 0
+        self.aciertos_aproximados = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self.invalidaciones = 0
+
+    def _vaciar(self):
+        capacidad = self.capacidad
+        self._hashes = array("Q", bytes(8 * capacidad))
+        self._probabilidades = array("f", bytes(4 * capacidad))
+        self._anterior = array("i", [-1]) * capacidad
+        self._siguiente = array("i", [-1]) * capacidad
+        self._cabezas = [array("i", [-1]) * (1 << self._bits_cubos) for _ in range(self.tramos)]
+        self._enlaces = [array("i", [-1]) * capacidad for _ in range(self.tramos)]
+        self._usadas = 0
+        # Extremos de la lista LRU: la más reciente y la menos reciente
+        self._primera = -1
+        self._ultima = -1
+
+    def __len__(self):
+        return self._usadas
+
+    # Tramos del hash y su cubo
+
+    def _trozo(self, valor, tramo):
+        return (valor >> self._desplazamientos[tramo]) & ((1 << self._anchos[tramo]) - 1)
+
+    def _cubo(self, trozo, tramo):
+        return (((trozo + tramo) * _MEZCLA) & _MASCARA_64) >> (64 - self._bits_cubos)
+
+    # Lista LRU
+
+    def _desenlazar_lru(self, posicion):
+        anterior, siguiente = self._anterior[posicion], self._siguiente[posicion]
+        if anterior != -1:
+            self._siguiente[anterior] = siguiente
+        else:
+            self._primera = siguiente
+        if siguiente != -1:
+            self._anterior[siguiente] = anterior
+        else:
+            self._ultima = anterior
+
+    def _enlazar_primera(self, posicion):
+        self._anterior[posicion] = -1
+        self._siguiente[posicion] = self._primera
+        if self._primera != -1:
+            self._anterior[self._primera] = posicion
+        self._primera = posicion
+        if self._ultima == -1:
+            self._ultima = posicion
+
+    # Cubos de cada tramo
+
+    def _insertar_en_cubos(self, posicion, valor):
+        for tramo in range(self.tramos):
+            cubo = self._cubo(self._trozo(valor, tramo), tramo)
+            self._enlaces[tramo][posicion] = self._cabezas[tramo][cubo]
+            self._cabezas[tramo][cubo] = posicion
+
+    def _quitar_de_cubos(self, posicion, valor):
+        for tramo in range(self.tramos):
+            cubo = self._cubo(self._trozo(valor, tramo), tramo)
+            cabezas, enlaces = self._cabezas[tramo], self._enlaces[tramo]
+            actual, previa = cabezas[cubo], -1
+            while actual != -1 and actual != posicion:
+                previa, actual = actual, enlaces[actual]
+            if actual == -1:
+                continue
+            if previa == -1:
+                cabezas[cubo] = enlaces[posicion]
+            else:
+                enlaces[previa] = enlaces[posicion]
+            enlaces[posicion] = -1
+
+    def _buscar_posicion(self, valor, distancia):
+        # Posición de la entrada más cercana a distancia <= `distancia`, o -1.
+        # Para una coincidencia exacta basta con el primer tramo
+        mejor, mejor_distancia = -1, distancia + 1
+        hashes = self._hashes
+        for tramo in range(self.tramos if distancia else 1):
+            enlaces = self._enlaces[tramo]
+            desplazamiento, mascara = self._desplazamientos[tramo], (1 << self._anchos[tramo]) - 1
+            trozo = (valor >> desplazamiento) & mascara
+            posicion = self._cabezas[tramo][self._cubo(trozo, tramo)]
+            while posicion != -1:
+                guardado = hashes[posicion]
+                # Otros trozos del mismo cubo (colisiones de la tabla) se descartan sin contar bits
+                if ((guardado >> desplazamiento) & mascara) == trozo:
+                    d = (guardado ^ valor).bit_count()
+                    if d < mejor_distancia:
+                        mejor, mejor_distancia = posicion, d
+                        if d == 0:
+                            return mejor, 0
+                posicion = enlaces[posicion]
+        return mejor, mejor_distancia
+
+    def buscar(self, valor):
+        """
+        :param valor: Hash perceptual de la cara
+        :return: Probabilidad guardada de la cara más cercana, o None si no hay ninguna a distancia <= `distancia`
+        """
+        with self._lock:
+            posicion, distancia = self._buscar_posicion(valor, self.distancia)
+            if posicion == -1:
+                self.fallos += 1
+                return None
+            if distancia == 0:
+                self.aciertos_exactos += 1
+            else:
+                self.aciertos_aproximados += 1
+            self._desenlazar_lru(posicion)
+            self._enlazar_primera(posicion)
+            return self._probabilidades[posicion]
+
+    def guardar(self, valor, probabilidad):
+        """
+        Guarda la probabilidad de una cara, expulsando la menos usada si la caché está llena.
+
+        :param valor: Hash perceptual de la cara
+        :param probabilidad: Probabilidad que ha devuelto el modelo
+        """
+        with self._lock:
+            self._guardar(valor, probabilidad)
+
+    def _guardar(self, valor, probabilidad):
+        posicion, _ = self._buscar_posicion(valor, 0)
+        if posicion == -1:
+            if self._usadas < self.capacidad:
+                posicion = self._usadas
+                self._usadas += 1
+            else:
+                posicion = self._ultima
+                self._desenlazar_lru(posicion)
+                self._quitar_de_cubos(posicion, self._hashes[posicion])
+                self.expulsiones += 1
+            self._hashes[posicion] = valor
+            self._insertar_en_cubos(posicion, valor)
+        else:
+            self._desenlazar_lru(posicion)
+        self._probabilidades[posicion] = probabilidad
+        self._enlazar_primera(posicion)
+
+    def fijar_version(self, version):
+        """
+        Asocia la caché a una versión del modelo; si es distinta de la actual, la vacía.
+
+        :param version: Suma del archivo del modelo
+        """
+        with self._lock:
+            if version != self.version:
+                if self._usadas:
+                    self.invalidaciones += 1
+                self._vaciar()
+                self.version = version
+
+    def volcar(self, ruta):
+        """
+        Guarda las entradas (de la menos a la más reciente) y la versión en un archivo .npz.
+
+        :param ruta: Archivo de destino (se escribe en un temporal y se renombra)
+        """
+        with self._lock:
+            orden = []
+            posicion = self._ultima
+            while posicion != -1:
+                orden.append(posicion)
+                posicion = self._anterior[posicion]
+            indices = np.array(orden, dtype=np.int64)
+            hashes = np.frombuffer(self._hashes, dtype=np.uint64)[indices]
+            probabilidades = np.frombuffer(self._probabilidades, dtype=np.float32)[indices]
+            version = self.version or ""
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, "wb") as f:
+            np.savez(f, hashes=hashes, probabilidades=probabilidades, version=np.array(version))
+        os.replace(temporal, ruta)
+
+    def cargar(self, ruta):
+        """
+        Carga un volcado si existe y corresponde a la versión actual del modelo.
+
+        :param ruta: Archivo generado con `volcar`
+        :return: Número de entradas cargadas
+        """
+        if not os.path.exists(ruta):
+            return 0
+        with np.load(ruta) as datos:
+            if str(datos["version"]) != (self.version or ""):
+                return 0
+            hashes, probabilidades = datos["hashes"], datos["probabilidades"]
+        with self._lock:
+            # Las más recientes al final, para que queden al principio de la lista LRU
+            for valor, probabilidad in zip(hashes[-self.capacidad:].tolist(), probabilidades[-self.capacidad:].tolist()):
+                self._guardar(valor, probabilidad)
+        return min(len(hashes), self.capacidad)
+
+    def estadisticas(self):
+        with self._lock:
+            aciertos = self.aciertos_exactos + self.aciertos_aproximados
+            total = aciertos + self.fallos
+            return {
+                "entradas": self._usadas,
+                "capacidad": self.capacidad,
+                "distancia": self.distancia,
+                "version": self.version,
+                "aciertos": aciertos,
+                "aciertos_exactos": self.aciertos_exactos,
+                "aciertos_aproximados": self.aciertos_aproximados,
+                "fallos": self.fallos,
+                "tasa_aciertos": (aciertos / total) if total else 0.0,
+                "expulsiones": self.expulsiones,
+                "invalidaciones": self.invalidaciones,
+            }
+
+
+def bytes_por_entrada(distancia):
+    """
+    :param distancia: Distancia de Hamming de la caché
+    :return: Memoria aproximada por entrada en bytes
+    """
+    return _BYTES_ENTRADA + (distancia + 1) * _BYTES_TRAMO
+
+
+def crear_cache_caras_desde_entorno():
+    """
+    Crea la caché de caras según las variables de entorno:
+
+    * `CACHE_CARAS_MAX_MB`: memoria máxima en MB (0, por defecto, la desactiva)
+    * `CACHE_CARAS_DISTANCIA`: distancia de Hamming máxima entre hashes (0 por defecto: solo hashes idénticos)
+
+    :return: CacheCaras o None si está desactivada
+    """
+    max_mb = float(os.environ.get("CACHE_CARAS_MAX_MB", "0"))
+    distancia = int(os.environ.get("CACHE_CARAS_DISTANCIA", "0"))
+    if max_mb <= 0:
+        return None
+    return CacheCaras(int(max_mb * 1024 * 1024) // bytes_por_entrada(distancia), distancia)
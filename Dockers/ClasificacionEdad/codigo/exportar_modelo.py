@@ -0,0 +1,322 @@
+"""
+Exporta `modelo.keras` a un runtime ligero de CPU (TFLite u ONNX), opcionalmente
+cuantizado a int8, y compara el resultado con el modelo original.
+
+El directorio de `--datos` tiene las subcarpetas `0` (menores) y `1` (adultos),
+como el que prepara el notebook de entrenamiento. Sus imágenes se barajan con
+una semilla fija y se reparten en dos conjuntos disjuntos: `--calibracion`
+imágenes para calibrar la cuantización int8 y el resto (hasta `--evaluacion`)
+para el informe. Se preprocesan igual que en el servicio (BGR, 64x64, /255).
+
+El informe (`--informe`, JSON) incluye:
+
+* Paridad con Keras al umbral de 0.6: porcentaje de caras con la misma
+  decisión menor/adulto, diferencia de probabilidades y exactitud y
+  sensibilidad para menores de cada modelo frente a las etiquetas.
+* Latencia por lote (p50/p95 y caras/s) para varios tamaños de lote.
+* Memoria residente de un proceso que solo carga el backend y hace una inferencia.
+
+Uso:
+    python exportar_modelo.py --formato tflite --datos face_age_binary/ --salida modelo.tflite
+    python exportar_modelo.py --formato tflite --int8 --datos face_age_binary/ --salida modelo.tflite --informe informe.json
+    python exportar_modelo.py --formato onnx --int8 --datos face_age_binary/ --salida modelo.onnx
+    python exportar_modelo.py --formato tflite --salida modelo.tflite --solo-informe --datos face_age_binary/
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from backends_modelo import crear_backend
+
+TAMANO = 64
+UMBRAL = 0.6
+EXTENSIONES_IMAGEN = {".png", ".jpg", ".jpeg", ".bmp"}
+
+
+def cargar_imagenes(directorio, semilla):
+    """
+    Carga y preprocesa las imágenes de `directorio/0` y `directorio/1` en orden aleatorio.
+
+    :param directorio: Directorio con las subcarpetas 0 (menores) y 1 (adultos)
+    :param semilla: Semilla del barajado
+    :return: Tupla (array Nx64x64x3 float32, array de etiquetas 0/1)
+    """
+    rutas = []
+    for etiqueta in (0, 1):
+        carpeta = os.path.join(directorio, str(etiqueta))
+        if not os.path.isdir(carpeta):
+            raise ValueError(f"No existe la carpeta {carpeta}")
+        rutas.extend(
+            (os.path.join(carpeta, nombre), etiqueta) for nombre in sorted(os.listdir(carpeta))
+            if os.path.splitext(nombre)[1].lower() in EXTENSIONES_IMAGEN
+        )
+    orden = np.random.default_rng(semilla).permutation(len(rutas))
+
+    imagenes, etiquetas = [], []
+    for i in orden:
+        ruta, etiqueta = rutas[i]
+        imagen = cv2.imread(ruta, cv2.IMREAD_COLOR)
+        if imagen is None:
+            continue
+        imagenes.append(cv2.resize(imagen, (TAMANO, TAMANO)))
+        etiquetas.append(etiqueta)
+    if not imagenes:
+        raise ValueError(f"No hay imágenes en {directorio}")
+    return np.stack(imagenes).astype(np.float32) / 255.0, np.asarray(etiquetas)
+
+
+def exportar_tflite(modelo, salida, calibracion=None):
+    """
+    :param modelo: Modelo de Keras
+    :param salida: Archivo .tflite
+    :param calibracion: Lote de calibración para la cuantización int8 (None: float32)
+    """
+    import tensorflow as tf
+
+    conversor = tf.lite.TFLiteConverter.from_keras_model(modelo)
+    if calibracion is not None:
+        def representativo():
+            for i in range(len(calibracion)):
+                yield [calibracion[i:i + 1]]
+        conversor.optimizations = [tf.lite.Optimize.DEFAULT]
+        conversor.representative_dataset = representativo
+        # Pesos y activaciones en int8; la entrada y la salida siguen en float32
+        conversor.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(salida, "wb") as f:
+        f.write(conversor.convert())
+
+
+class _LectorCalibracion:
+    # CalibrationDataReader de onnxruntime sobre un array en memoria
+    def __init__(self, nombre_entrada, calibracion):
+        self._datos = iter([{nombre_entrada: calibracion[i:i + 1]} for i in range(len(calibracion))])
+
+    def get_next(self):
+        return next(self._datos, None)
+
+
+def exportar_onnx(modelo, salida, calibracion=None):
+    """
+    :param modelo: Modelo de Keras
+    :param salida: Archivo .onnx
+    :param calibracion: Lote de calibración para la cuantización int8 (None: float32)
+    """
+    import tensorflow as tf
+    import tf2onnx
+
+    firma = (tf.TensorSpec((None, TAMANO, TAMANO, 3), tf.float32, name="entrada"),)
+    if calibracion is None:
+        tf2onnx.convert.from_keras(modelo, input_signature=firma, opset=13, output_path=salida)
+        return
+
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+    with tempfile.TemporaryDirectory() as directorio:
+        flotante = os.path.join(directorio, "modelo_float.onnx")
+        tf2onnx.convert.from_keras(modelo, input_signature=firma, opset=13, output_path=flotante)
+        quantize_static(
+            flotante, salida, _LectorCalibracion("entrada", calibracion),
+            quant_format=QuantFormat.QDQ, activation_type=QuantType.QInt8, weight_type=QuantType.QInt8,
+        )
+
+
+def predecir_todo(backend, imagenes, lote=64):
+    """
+    :return: Array de probabilidades (una por imagen)
+    """
+    salidas = [backend.predecir(imagenes[i:i + lote]) for i in range(0, len(imagenes), lote)]
+    return np.concatenate(salidas).reshape(-1)
+
+
+def metricas_clasificacion(probabilidades, etiquetas, umbral=UMBRAL):
+    """
+    :param probabilidades: Probabilidad de ser adulto de cada cara
+    :param etiquetas: 0 (menor) o 1 (adulto)
+    :return: Exactitud, sensibilidad y precisión para menores y matriz de confusión
+    """
+    es_menor = probabilidades < umbral
+    menor_real = etiquetas == 0
+    vp = int(np.sum(es_menor & menor_real))
+    fn = int(np.sum(~es_menor & menor_real))
+    fp = int(np.sum(es_menor & ~menor_real))
+    vn = int(np.sum(~es_menor & ~menor_real))
+    return {
+        "exactitud": round((vp + vn) / len(etiquetas), 4),
+        # Menores que se dejarían sin pixelar: la métrica que no puede empeorar
+        "sensibilidad_menores": round(vp / (vp + fn), 4) if vp + fn else None,
+        "precision_menores": round(vp / (vp + fp), 4) if vp + fp else None,
+        "confusion": {"menor_como_menor": vp, "menor_como_adulto": fn, "adulto_como_menor": fp, "adulto_como_adulto": vn},
+    }
+
+
+def informe_paridad(referencia, nuevo, etiquetas, umbral=UMBRAL):
+    """
+    Compara las predicciones del backend exportado con las de Keras.
+
+    :param referencia: Probabilidades de Keras
+    :param nuevo: Probabilidades del backend exportado
+    :param etiquetas: Etiquetas reales
+    :param umbral: Umbral de decisión del servicio
+    :return: Diccionario del informe
+    """
+    decision_ref = referencia < umbral
+    decision_nueva = nuevo < umbral
+    diferencia = np.abs(referencia - nuevo)
+    cambios = decision_ref != decision_nueva
+    return {
+        "imagenes": int(len(referencia)),
+        "umbral": umbral,
+        "acuerdo_decisiones": round(float(np.mean(~cambios)), 5),
+        "decisiones_distintas": int(np.sum(cambios)),
+        "menor_pasa_a_adulto": int(np.sum(decision_ref & ~decision_nueva)),
+        "adulto_pasa_a_menor": int(np.sum(~decision_ref & decision_nueva)),
+        "diferencia_probabilidad": {
+            "media": round(float(diferencia.mean()), 6),
+            "p99": round(float(np.percentile(diferencia, 99)), 6),
+            "max": round(float(diferencia.max()), 6),
+        },
+        "keras": metricas_clasificacion(referencia, etiquetas, umbral),
+        "exportado": metricas_clasificacion(nuevo, etiquetas, umbral),
+    }
+
+
+def medir_latencia(backend, imagenes, tamanos, repeticiones):
+    """
+    :return: Diccionario tamaño de lote -> p50/p95 (ms) y caras por segundo
+    """
+    resultado = {}
+    for tamano in tamanos:
+        indices = np.arange(tamano) % len(imagenes)
+        lote = imagenes[indices]
+        backend.predecir(lote)
+        tiempos = []
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            backend.predecir(lote)
+            tiempos.append(time.perf_counter() - inicio)
+        p50 = float(np.percentile(tiempos, 50))
+        resultado[str(tamano)] = {
+            "p50_ms": round(p50 * 1000.0, 3),
+            "p95_ms": round(float(np.percentile(tiempos, 95)) * 1000.0, 3),
+            "caras_por_segundo": round(tamano / p50, 1) if p50 > 0 else None,
+        }
+    return resultado
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def medir_memoria(backend, ruta):
+    """
+    Carga el backend en un proceso nuevo y mide su memoria residente.
+
+    :return: Diccionario con la memoria antes y después de cargar el modelo (MB)
+    """
+    salida = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--medir-memoria", backend, ruta],
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def _medir_memoria_proceso(backend, ruta):
+    antes = _rss_mb()
+    modelo = crear_backend(backend, ruta)
+    modelo.predecir(np.zeros((32, TAMANO, TAMANO, 3), dtype=np.float32))
+    despues = _rss_mb()
+    print(json.dumps({"rss_base_mb": round(antes, 1), "rss_mb": round(despues, 1), "modelo_mb": round(despues - antes, 1)}))
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--medir-memoria":
+        _medir_memoria_proceso(sys.argv[2], sys.argv[3])
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modelo", default="modelo.keras", help="Modelo de Keras de referencia")
+    parser.add_argument("--formato", choices=("tflite", "onnx"), required=True)
+    parser.add_argument("--salida", required=True, help="Archivo del modelo exportado")
+    parser.add_argument("--int8", action="store_true", help="Cuantización int8 calibrada con --datos")
+    parser.add_argument("--datos", help="Directorio con las subcarpetas 0 (menores) y 1 (adultos)")
+    parser.add_argument("--calibracion", type=int, default=500, help="Imágenes de calibración")
+    parser.add_argument("--evaluacion", type=int, default=5000, help="Imágenes de evaluación como máximo")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--lotes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--repeticiones", type=int, default=50)
+    parser.add_argument("--solo-informe", action="store_true", help="No exportar: comparar un modelo ya exportado")
+    parser.add_argument("--informe", help="Archivo JSON en el que guardar el informe")
+    args = parser.parse_args()
+
+    if args.int8 and not args.datos:
+        parser.error("La cuantización int8 necesita imágenes de calibración (--datos)")
+
+    calibracion = evaluacion = etiquetas = None
+    if args.datos:
+        imagenes, todas_etiquetas = cargar_imagenes(args.datos, args.semilla)
+        n_calibracion = min(args.calibracion, len(imagenes) // 2) if args.int8 else 0
+        calibracion = imagenes[:n_calibracion]
+        evaluacion = imagenes[n_calibracion:n_calibracion + args.evaluacion]
+        etiquetas = todas_etiquetas[n_calibracion:n_calibracion + args.evaluacion]
+        print(f"{len(calibracion)} imágenes de calibración y {len(evaluacion)} de evaluación")
+
+    if not args.solo_informe:
+        from keras.models import load_model
+        modelo = load_model(args.modelo)
+        inicio = time.perf_counter()
+        exportar = exportar_tflite if args.formato == "tflite" else exportar_onnx
+        exportar(modelo, args.salida, calibracion if args.int8 else None)
+        print(f"Modelo exportado en {args.salida} ({os.path.getsize(args.salida) / 1024:.0f} KB) "
+              f"en {time.perf_counter() - inicio:.1f} s")
+
+    keras = crear_backend("keras", args.modelo)
+    exportado = crear_backend(args.formato, args.salida)
+    informe = {
+        "formato": args.formato,
+        "int8": args.int8,
+        "tamano_kb": {
+            "keras": round(os.path.getsize(args.modelo) / 1024, 1),
+            args.formato: round(os.path.getsize(args.salida) / 1024, 1),
+        },
+    }
+
+    if evaluacion is not None and len(evaluacion):
+        informe["paridad"] = informe_paridad(predecir_todo(keras, evaluacion), predecir_todo(exportado, evaluacion), etiquetas)
+        muestras = evaluacion
+    else:
+        print("Sin --datos no hay informe de paridad; la latencia se mide con imágenes aleatorias")
+        muestras = np.random.default_rng(args.semilla).random((64, TAMANO, TAMANO, 3), dtype=np.float32)
+
+    informe["latencia"] = {
+        "keras": medir_latencia(keras, muestras, args.lotes, args.repeticiones),
+        args.formato: medir_latencia(exportado, muestras, args.lotes, args.repeticiones),
+    }
+    informe["memoria"] = {
+        "keras": medir_memoria("keras", args.modelo),
+        args.formato: medir_memoria(args.formato, args.salida),
+    }
+
+    print(json.dumps(informe, indent=2, ensure_ascii=False))
+    if args.informe:
+        with open(args.informe, "w", encoding="utf-8") as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+        print(f"Informe guardado en {args.informe}")
+
+
+if __name__ == "__main__":
+    main()
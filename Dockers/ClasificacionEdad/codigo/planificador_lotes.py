@@ -0,0 +1,169 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+# Límites superiores de los cubos del histograma de tamaños de lote
+CUBOS_HISTOGRAMA = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class _Peticion:
+    """
+    Caras de una petición pendiente y el hueco donde se deja su resultado.
+    """
+
+    def __init__(self, caras):
+        self.caras = caras
+        self.resultado = None
+        self.error = None
+        self.evento = threading.Event()
+
+
+class PlanificadorLotes:
+    """
+    Agrupa las caras de peticiones concurrentes en un único lote de inferencia.
+
+    Un hilo en segundo plano espera a que llegue la primera petición y sigue
+    acumulando hasta alcanzar `max_caras` o hasta que pasen `max_espera_ms`
+    desde esa primera petición. Después ejecuta una sola inferencia y reparte a
+    cada petición su parte del resultado. Las peticiones nunca se parten: si una
+    sola supera `max_caras` se ejecuta sola en su propio lote.
+    """
+
+    def __init__(self, inferir, max_caras=32, max_espera_ms=5.0):
+        """
+        :param inferir: Función que recibe un array Nx64x64x3 y devuelve N predicciones
+        :param max_caras: Número máximo de caras por lote
+        :param max_espera_ms: Tiempo máximo (ms) que se retiene la primera petición del lote
+        """
+        self.inferir = inferir
+        self.max_caras = max(int(max_caras), 1)
+        self.max_espera = max(float(max_espera_ms), 0.0) / 1000.0
+
+        self._cola = deque()
+        self._condicion = threading.Condition()
+        self._hilo = None
+
+        # Métricas
+        self._caras_en_cola = 0
+        self._lotes = 0
+        self._caras_procesadas = 0
+        self._peticiones_procesadas = 0
+        self._histograma = [0] * (len(CUBOS_HISTOGRAMA) + 1)
+
+    def _arrancar(self):
+        # El hilo se crea en la primera petición para que funcione también
+        # tras un fork del proceso (servidores con varios workers)
+        if self._hilo is None or not self._hilo.is_alive():
+            self._hilo = threading.Thread(target=self._bucle, name="planificador-lotes", daemon=True)
+            self._hilo.start()
+
+    def predecir(self, caras):
+        """
+        Encola las caras de una petición y bloquea hasta tener su resultado.
+
+        :param caras: Array Nx64x64x3 con las caras de la petición
+        :return: Array con las N predicciones correspondientes a esas caras
+        """
+        peticion = _Peticion(caras)
+        with self._condicion:
+            self._arrancar()
+            self._cola.append(peticion)
+            self._caras_en_cola += len(caras)
+            self._condicion.notify()
+
+        peticion.evento.wait()
+        if peticion.error is not None:
+            raise peticion.error
+        return peticion.resultado
+
+    def _recoger_lote(self):
+        """
+        Espera a la primera petición y acumula más hasta llenar el lote o agotar la espera.
+
+        :return: Lista de peticiones que forman el lote
+        """
+        with self._condicion:
+            while not self._cola:
+                self._condicion.wait()
+
+            lote = [self._cola.popleft()]
+            total = len(lote[0].caras)
+            limite = time.monotonic() + self.max_espera
+
+            while total < self.max_caras:
+                if self._cola:
+                    # No partimos peticiones: si la siguiente no cabe, va al próximo lote
+                    if total + len(self._cola[0].caras) > self.max_caras:
+                        break
+                    peticion = self._cola.popleft()
+                    lote.append(peticion)
+                    total += len(peticion.caras)
+                    continue
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                self._condicion.wait(restante)
+
+            self._caras_en_cola -= total
+            return lote
+
+    def _bucle(self):
+        while True:
+            lote = self._recoger_lote()
+            try:
+                entrada = np.concatenate([p.caras for p in lote], axis=0)
+                salida = self.inferir(entrada)
+                inicio = 0
+                for peticion in lote:
+                    fin = inicio + len(peticion.caras)
+                    peticion.resultado = salida[inicio:fin]
+                    inicio = fin
+            except Exception as e:
+                for peticion in lote:
+                    peticion.error = e
+
+            self._registrar(lote)
+            for peticion in lote:
+                peticion.evento.set()
+
+    def _registrar(self, lote):
+        tamano = sum(len(p.caras) for p in lote)
+        with self._condicion:
+            self._lotes += 1
+            self._caras_procesadas += tamano
+            self._peticiones_procesadas += len(lote)
+            for i, limite in enumerate(CUBOS_HISTOGRAMA):
+                if tamano <= limite:
+                    self._histograma[i] += 1
+                    break
+            else:
+                self._histograma[-1] += 1
+
+    def metricas(self):
+        """
+        Devuelve el estado del planificador.
+
+        :return: Diccionario con la profundidad de la cola y el histograma de tamaños de lote
+        """
+        with self._condicion:
+            # Histograma acumulado: lotes con tamaño menor o igual que cada límite
+            histograma = {}
+            acumulado = 0
+            for limite, n in zip(CUBOS_HISTOGRAMA, self._histograma):
+                acumulado += n
+                histograma[f"le_{limite}"] = acumulado
+            histograma["le_inf"] = acumulado + self._histograma[-1]
+            return {
+                "peticiones_en_cola": len(self._cola),
+                "caras_en_cola": self._caras_en_cola,
+                "lotes_ejecutados": self._lotes,
+                "caras_procesadas": self._caras_procesadas,
+                "peticiones_procesadas": self._peticiones_procesadas,
+                "tamano_medio_lote": (self._caras_procesadas / self._lotes) if self._lotes else 0.0,
+                "histograma_tamano_lote": histograma,
+                "max_caras": self.max_caras,
+                "max_espera_ms": self.max_espera * 1000.0,
+            }
@@ -0,0 +1,433 @@
+"""
+Benchmark de carga del pipeline completo (gateway/motor -> bounding -> clasificación -> pixelado).
+
+Reproduce un corpus de imágenes con distinto número de caras y resolución con
+una concurrencia configurable y mide el rendimiento (imágenes/s) y la latencia
+p50/p95/p99 de extremo a extremo y de cada etapa. Las etapas se leen de la
+cabecera Server-Timing que devuelve el motor.
+
+Dos modos:
+
+* Contenedores (`--url`): envía las imágenes por HTTP al motor
+  (`http://localhost:5003/procesar`, campo `imagen`) o al gateway
+  (`http://localhost:8000/pixelar_menores`, campo `file`).
+* En proceso (sin `--url`): importa `engine_api` y lo llama con el cliente de
+  pruebas de Flask. La detección y la clasificación se sustituyen por stubs
+  que devuelven las caras conocidas del corpus sintético tras una latencia
+  simulada; la decodificación, los recortes, el pixelado y la codificación
+  JPEG son los reales. Sirve para medir cambios del motor sin modelos.
+
+El resultado se guarda en JSON (`--salida`) y se puede comparar con otra
+ejecución (`--comparar base.json`).
+
+Uso:
+    python bench_pipeline.py --peticiones 200 --concurrencia 8 --salida base.json
+    python bench_pipeline.py --url http://localhost:5003/procesar --concurrencia 16 --salida nuevo.json --comparar base.json
+    python bench_pipeline.py --corpus fotos/ --lados 640 1920 --caras 1 10
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+EXTENSIONES_IMAGEN = {".png", ".jpg", ".jpeg", ".bmp", ".webp"}
+PERCENTILES = (50, 95, 99)
+
+
+def generar_imagen(ancho, alto, caras, rng):
+    """
+    Genera una imagen sintética con `caras` óvalos de color piel en posiciones aleatorias.
+
+    :param ancho: Ancho en píxeles
+    :param alto: Alto en píxeles
+    :param caras: Número de caras
+    :param rng: Generador aleatorio de numpy
+    :return: Tupla (imagen BGR, lista de cajas [x1, y1, x2, y2])
+    """
+    # Fondo con textura para que el JPEG tenga un tamaño realista
+    pequena = rng.integers(0, 256, size=(max(alto // 16, 1), max(ancho // 16, 1), 3), dtype=np.uint8)
+    imagen = cv2.resize(pequena, (ancho, alto), interpolation=cv2.INTER_LINEAR)
+    cajas = []
+    lado_max = max(min(ancho, alto) // 4, 16)
+    for _ in range(caras):
+        lado = int(rng.integers(max(lado_max // 3, 8), lado_max + 1))
+        x1 = int(rng.integers(0, max(ancho - lado, 1)))
+        y1 = int(rng.integers(0, max(alto - lado, 1)))
+        centro = (x1 + lado // 2, y1 + lado // 2)
+        cv2.ellipse(imagen, centro, (lado // 2 - 2, lado // 2), 0, 0, 360, (140, 170, 220), -1)
+        cajas.append([x1, y1, min(x1 + lado, ancho), min(y1 + lado, alto)])
+    return imagen, cajas
+
+
+def _caja(ancho, alto, rng):
+    # Caja aleatoria para imágenes reales en modo en proceso (el stub no detecta de verdad)
+    lado = int(rng.integers(max(min(ancho, alto) // 12, 8), max(min(ancho, alto) // 4, 9)))
+    x1 = int(rng.integers(0, max(ancho - lado, 1)))
+    y1 = int(rng.integers(0, max(alto - lado, 1)))
+    return [x1, y1, min(x1 + lado, ancho), min(y1 + lado, alto)]
+
+
+def codificar(imagen, calidad):
+    ok, buffer = cv2.imencode(".jpg", imagen, [cv2.IMWRITE_JPEG_QUALITY, calidad])
+    if not ok:
+        raise ValueError("No se pudo codificar la imagen")
+    return buffer.tobytes()
+
+
+def corpus_sintetico(resoluciones, caras, calidad, semilla):
+    """
+    :return: Lista de elementos {"nombre", "datos", "cajas", "resolucion", "caras"}
+    """
+    rng = np.random.default_rng(semilla)
+    elementos = []
+    for ancho, alto in resoluciones:
+        for n in caras:
+            imagen, cajas = generar_imagen(ancho, alto, n, rng)
+            elementos.append({
+                "nombre": f"sintetica_{ancho}x{alto}_{n}caras.jpg", "datos": codificar(imagen, calidad),
+                "cajas": cajas, "resolucion": f"{ancho}x{alto}", "caras": n,
+            })
+    return elementos
+
+
+def corpus_directorio(directorio, lados, caras, calidad, semilla):
+    """
+    Carga las imágenes de un directorio y las reescala a cada lado largo de `lados`.
+    Las cajas solo las usa el stub de detección del modo en proceso.
+
+    :return: Lista de elementos como en `corpus_sintetico`
+    """
+    rng = np.random.default_rng(semilla)
+    elementos = []
+    for nombre in sorted(os.listdir(directorio)):
+        if os.path.splitext(nombre)[1].lower() not in EXTENSIONES_IMAGEN:
+            continue
+        imagen = cv2.imread(os.path.join(directorio, nombre), cv2.IMREAD_COLOR)
+        if imagen is None:
+            continue
+        for lado in lados or [max(imagen.shape[:2])]:
+            escala = lado / max(imagen.shape[:2])
+            reescalada = cv2.resize(imagen, None, fx=escala, fy=escala, interpolation=cv2.INTER_AREA) \
+                if escala != 1 else imagen
+            alto, ancho = reescalada.shape[:2]
+            datos = codificar(reescalada, calidad)
+            for n in caras:
+                elementos.append({
+                    "nombre": f"{os.path.splitext(nombre)[0]}_{lado}_{n}caras.jpg", "datos": datos,
+                    "cajas": [_caja(ancho, alto, rng) for _ in range(n)],
+                    "resolucion": f"{ancho}x{alto}", "caras": n,
+                })
+    return elementos
+
+
+def leer_server_timing(cabecera):
+    """
+    :param cabecera: Valor de Server-Timing ("etapa;dur=12.3, otra;dur=4")
+    :return: Diccionario etapa -> milisegundos
+    """
+    etapas = {}
+    for entrada in (cabecera or "").split(","):
+        partes = [p.strip() for p in entrada.split(";")]
+        for parte in partes[1:]:
+            if parte.startswith("dur="):
+                try:
+                    etapas[partes[0]] = float(parte[4:])
+                except ValueError:
+                    pass
+    return etapas
+
+
+class ClienteHTTP:
+    """
+    Envía cada imagen a un contenedor con una sesión por hilo.
+    """
+
+    def __init__(self, url, campo, timeout):
+        import requests
+        self.requests = requests
+        self.url = url
+        self.campo = campo
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def enviar(self, elemento):
+        sesion = getattr(self._local, "sesion", None)
+        if sesion is None:
+            sesion = self._local.sesion = self.requests.Session()
+        res = sesion.post(
+            self.url, files={self.campo: (elemento["nombre"], elemento["datos"], "image/jpeg")}, timeout=self.timeout
+        )
+        return res.status_code, len(res.content), leer_server_timing(res.headers.get("Server-Timing"))
+
+
+class ClienteEnProceso:
+    """
+    Llama a `engine_api` en este mismo proceso con stubs en lugar de los modelos.
+    """
+
+    def __init__(self, corpus, latencia_deteccion, latencia_cara, latencia_clasificacion, modo_pixelado="parches"):
+        raiz = os.path.dirname(os.path.abspath(__file__))
+        for ruta in (raiz, os.path.join(raiz, "..", "..", "comun"), os.path.join(raiz, "..", "..", "Pixelado", "codigo")):
+            if ruta not in sys.path:
+                sys.path.insert(0, os.path.normpath(ruta))
+        # Sin cola, sin caché y en modo microservicios: se miden todas las etapas
+        os.environ["TRABAJOS_ACTIVADOS"] = "false"
+        os.environ["MODO_PIPELINE"] = "microservicios"
+        os.environ["MODO_PIXELADO"] = modo_pixelado
+        os.environ.pop("CACHE_BACKEND", None)
+
+        import engine_api
+        import formato_parches
+        import pixelado
+
+        # El nombre del archivo identifica cada elemento del corpus (varios pueden compartir los bytes)
+        cajas = {e["nombre"]: e["cajas"] for e in corpus}
+
+        def detectar(nombre, tipo, imagen_bytes):
+            time.sleep(latencia_deteccion)
+            return [{"bbox": caja, "confianza": 0.99} for caja in cajas.get(nombre, [])]
+
+        def clasificar_trozo(imagen_np, detecciones, debug_mode):
+            # Recortes reales (lo que haría el transporte binario) y predicción simulada
+            lote = np.empty((len(detecciones), engine_api.TAMANO_CARA, engine_api.TAMANO_CARA, 3), dtype=np.uint8)
+            for i, d in enumerate(detecciones):
+                x1, y1, x2, y2 = d["bbox"]
+                lote[i] = cv2.resize(imagen_np[max(y1, 0):y2, max(x1, 0):x2], lote.shape[1:3])
+            time.sleep(latencia_clasificacion + latencia_cara * len(detecciones))
+            resultados = [i % 2 for i in range(len(detecciones))]
+            if not debug_mode:
+                return resultados
+            return {
+                "resultados": resultados,
+                "detalle": [{"imagen_id": i, "probabilidad": 0.5, "es_menor": bool(r)} for i, r in enumerate(resultados)],
+                "debug": True, "total_imagenes": len(resultados), "menores_detectados": sum(resultados),
+            }
+
+        def pixelar(nombre, tipo, imagen_bytes, menores_bboxes):
+            # Lo mismo que hace el servicio Pixelado: decodificar, pixelar y codificar
+            imagen = cv2.imdecode(np.frombuffer(imagen_bytes, np.uint8), cv2.IMREAD_COLOR)
+            imagen = pixelado.pixelar_rectangulos(imagen, menores_bboxes)
+            return cv2.imencode(".jpg", imagen)[1].tobytes()
+
+        def pixelar_parches(imagen_np, menores_bboxes):
+            # Lo mismo que el motor y el servicio en modo parches: empaquetar, pixelar y recomponer
+            grupos = pixelado.agrupar_rectangulos(menores_bboxes, *imagen_np.shape[:2])
+            if not grupos:
+                return imagen_np
+            cuerpo = bytearray(formato_parches.empaquetar(
+                [imagen_np[y1:y2, x1:x2] for (x1, y1, x2, y2), _ in grupos], [r for _, r in grupos]
+            ))
+            parches, rectangulos = formato_parches.desempaquetar(cuerpo)
+            for parche, rects in zip(parches, rectangulos):
+                pixelado.pixelar_rectangulos(parche, rects)
+            for ((x1, y1, x2, y2), _), parche in zip(grupos, parches):
+                imagen_np[y1:y2, x1:x2] = parche
+            return imagen_np
+
+        engine_api.detectar_remoto = detectar
+        engine_api.clasificar_trozo = clasificar_trozo
+        engine_api.pixelar_remoto = pixelar
+        engine_api.pixelar_parches_remoto = pixelar_parches
+        self.cliente = engine_api.app.test_client()
+
+    def enviar(self, elemento):
+        res = self.cliente.post(
+            "/procesar", data={"imagen": (io.BytesIO(elemento["datos"]), elemento["nombre"], "image/jpeg")},
+            content_type="multipart/form-data",
+        )
+        return res.status_code, len(res.data), leer_server_timing(res.headers.get("Server-Timing"))
+
+
+def resumen(valores):
+    """
+    :param valores: Lista de milisegundos
+    :return: Diccionario con "n", "media", "p50", "p95", "p99" y "max"
+    """
+    if not valores:
+        return {"n": 0}
+    array = np.asarray(valores, dtype=np.float64)
+    estadisticas = {"n": int(array.size), "media": round(float(array.mean()), 3)}
+    for p in PERCENTILES:
+        estadisticas[f"p{p}"] = round(float(np.percentile(array, p)), 3)
+    estadisticas["max"] = round(float(array.max()), 3)
+    return estadisticas
+
+
+def ejecutar(cliente, corpus, peticiones, concurrencia, calentamiento):
+    """
+    Envía `peticiones` imágenes (recorriendo el corpus en orden) con `concurrencia` hilos.
+
+    :return: Diccionario con los resultados agregados
+    """
+    for i in range(calentamiento):
+        cliente.enviar(corpus[i % len(corpus)])
+
+    muestras = []
+    lock = threading.Lock()
+    siguiente = iter(range(peticiones))
+
+    def trabajador():
+        while True:
+            with lock:
+                i = next(siguiente, None)
+            if i is None:
+                return
+            elemento = corpus[i % len(corpus)]
+            inicio = time.perf_counter()
+            try:
+                codigo, tamano, etapas = cliente.enviar(elemento)
+            except Exception as e:
+                codigo, tamano, etapas = None, 0, {}
+                error = str(e)
+            else:
+                error = None
+            muestra = {
+                "total_ms": (time.perf_counter() - inicio) * 1000.0, "codigo": codigo, "bytes": tamano,
+                "etapas": etapas, "resolucion": elemento["resolucion"], "caras": elemento["caras"], "error": error,
+            }
+            with lock:
+                muestras.append(muestra)
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+        for _ in range(concurrencia):
+            ejecutor.submit(trabajador)
+    duracion = time.perf_counter() - inicio
+
+    correctas = [m for m in muestras if m["codigo"] == 200]
+    etapas = sorted({etapa for m in correctas for etapa in m["etapas"]})
+    grupos = {}
+    for m in correctas:
+        grupos.setdefault(f"{m['resolucion']}/{m['caras']}caras", []).append(m["total_ms"])
+
+    errores = {}
+    for m in muestras:
+        if m["codigo"] != 200:
+            clave = str(m["codigo"]) if m["codigo"] is not None else "excepcion"
+            errores[clave] = errores.get(clave, 0) + 1
+
+    return {
+        "peticiones": len(muestras),
+        "correctas": len(correctas),
+        "errores": errores,
+        "duracion_s": round(duracion, 3),
+        "imagenes_por_segundo": round(len(correctas) / duracion, 3) if duracion > 0 else 0.0,
+        "extremo_a_extremo_ms": resumen([m["total_ms"] for m in correctas]),
+        "etapas_ms": {etapa: resumen([m["etapas"][etapa] for m in correctas if etapa in m["etapas"]]) for etapa in etapas},
+        "por_grupo_ms": {grupo: resumen(valores) for grupo, valores in sorted(grupos.items())},
+    }
+
+
+def comparar(base, nuevo):
+    """
+    Imprime la variación de las métricas principales respecto a una ejecución anterior.
+    """
+    def fila(nombre, a, b, mayor_es_mejor=False):
+        if a is None or b is None:
+            return
+        cambio = (b - a) / a * 100.0 if a else float("inf")
+        mejora = cambio > 0 if mayor_es_mejor else cambio < 0
+        print(f"  {nombre:<32} {a:10.2f} -> {b:10.2f}  {cambio:+7.1f}% {'(mejor)' if mejora and abs(cambio) >= 1 else ''}")
+
+    print("Comparación con la ejecución base:")
+    fila("imagenes_por_segundo", base.get("imagenes_por_segundo"), nuevo.get("imagenes_por_segundo"), True)
+    for p in ("p50", "p95", "p99"):
+        fila(f"extremo_a_extremo {p}", base["extremo_a_extremo_ms"].get(p), nuevo["extremo_a_extremo_ms"].get(p))
+    for etapa, estadisticas in nuevo["etapas_ms"].items():
+        anterior = base.get("etapas_ms", {}).get(etapa, {})
+        for p in ("p50", "p95"):
+            fila(f"{etapa} {p}", anterior.get(p), estadisticas.get(p))
+
+
+def imprimir(resultado):
+    e2e = resultado["extremo_a_extremo_ms"]
+    print(f"{resultado['correctas']}/{resultado['peticiones']} correctas en {resultado['duracion_s']} s "
+          f"({resultado['imagenes_por_segundo']} imágenes/s), errores: {resultado['errores'] or 'ninguno'}")
+    print(f"  {'etapa':<24} {'n':>6} {'media':>9} {'p50':>9} {'p95':>9} {'p99':>9}  (ms)")
+    for nombre, s in [("extremo_a_extremo", e2e)] + list(resultado["etapas_ms"].items()) + \
+            [(f"  {g}", s) for g, s in resultado["por_grupo_ms"].items()]:
+        if s.get("n"):
+            print(f"  {nombre:<24} {s['n']:>6} {s['media']:>9.2f} {s['p50']:>9.2f} {s['p95']:>9.2f} {s['p99']:>9.2f}")
+
+
+def resolucion(texto):
+    ancho, alto = texto.lower().split("x")
+    return int(ancho), int(alto)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Endpoint del contenedor (sin indicar: motor en proceso con stubs)")
+    parser.add_argument("--campo", default=None, help="Campo del archivo (imagen para el motor, file para el gateway)")
+    parser.add_argument("--corpus", help="Directorio de imágenes (sin indicar: corpus sintético)")
+    parser.add_argument("--resoluciones", nargs="+", type=resolucion, default=[(640, 480), (1920, 1080), (4000, 3000)])
+    parser.add_argument("--lados", nargs="+", type=int, default=None, help="Lados largos a los que reescalar el corpus")
+    parser.add_argument("--caras", nargs="+", type=int, default=[0, 1, 5, 20])
+    parser.add_argument("--calidad", type=int, default=90, help="Calidad JPEG del corpus")
+    parser.add_argument("--peticiones", type=int, default=200)
+    parser.add_argument("--concurrencia", type=int, default=8)
+    parser.add_argument("--calentamiento", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--latencia-deteccion", type=float, default=0.05, help="Segundos simulados por detección")
+    parser.add_argument("--latencia-clasificacion", type=float, default=0.005, help="Segundos simulados por lote")
+    parser.add_argument("--latencia-cara", type=float, default=0.001, help="Segundos simulados por cara")
+    parser.add_argument("--modo-pixelado", choices=("parches", "imagen"), default="parches",
+                        help="MODO_PIXELADO del motor en proceso")
+    parser.add_argument("--salida", help="Archivo JSON en el que guardar el resultado")
+    parser.add_argument("--comparar", help="JSON de una ejecución anterior con la que comparar")
+    args = parser.parse_args()
+
+    if args.corpus:
+        corpus = corpus_directorio(args.corpus, args.lados, args.caras, args.calidad, args.semilla)
+    else:
+        corpus = corpus_sintetico(args.resoluciones, args.caras, args.calidad, args.semilla)
+    if not corpus:
+        parser.error("El corpus está vacío")
+
+    if args.url:
+        campo = args.campo or ("imagen" if args.url.rstrip("/").endswith("/procesar") else "file")
+        cliente = ClienteHTTP(args.url, campo, args.timeout)
+    else:
+        cliente = ClienteEnProceso(
+            corpus, args.latencia_deteccion, args.latencia_cara, args.latencia_clasificacion, args.modo_pixelado
+        )
+
+    resultado = ejecutar(cliente, corpus, args.peticiones, args.concurrencia, args.calentamiento)
+    resultado["configuracion"] = {
+        "modo": "contenedores" if args.url else "en_proceso",
+        "url": args.url,
+        "corpus": args.corpus or "sintetico",
+        "elementos_corpus": len(corpus),
+        "resoluciones": sorted({e["resolucion"] for e in corpus}),
+        "caras": args.caras,
+        "concurrencia": args.concurrencia,
+        "modo_pixelado": None if args.url else args.modo_pixelado,
+        "calentamiento": args.calentamiento,
+        "latencias_simuladas_s": None if args.url else {
+            "deteccion": args.latencia_deteccion, "clasificacion": args.latencia_clasificacion, "cara": args.latencia_cara,
+        },
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "maquina": {"sistema": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+    }
+
+    imprimir(resultado)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"Resultado guardado en {args.salida}")
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            comparar(json.load(f), resultado)
+
+
+if __name__ == "__main__":
+    main()
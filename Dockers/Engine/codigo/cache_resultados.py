@@ -0,0 +1,349 @@
+"""
+Caché de resultados del pipeline direccionada por contenido.
+
+La clave es un hash SHA-256 de los bytes de la imagen junto con la versión del
+pipeline, de modo que una re-subida de la misma imagen no vuelve a pasar por
+RetinaFace ni por el clasificador. La versión no se escribe a mano: es la
+huella de la configuración efectiva de cada etapa (detector, umbrales,
+reducción, teselas, suma del modelo de edad, pixelado; ver servicio.py), así
+que cambiar cualquiera de ellas invalida la caché. Mientras alguna etapa no
+informa de su versión no se guarda ni se consulta nada. Los valores son bytes
+(el análisis en JSON y, opcionalmente, el JPEG pixelado).
+
+Hay dos backends con la misma interfaz, ambos con expulsión LRU por tamaño
+total en bytes y caducidad (TTL):
+
+* `CacheMemoria`: diccionario ordenado en memoria del proceso.
+* `CacheDisco`: base de datos sqlite en disco que sobrevive a reinicios. El
+  tamaño total se calcula sobre la base de datos en cada escritura, así que
+  el límite se respeta aunque varios procesos compartan el archivo.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Contadores:
+    """
+    Contadores de aciertos, fallos y expulsiones compartidos por los backends.
+    """
+
+    def __init__(self):
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self.caducados = 0
+
+    def como_dict(self):
+        total = self.aciertos + self.fallos
+        return {
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": (self.aciertos / total) if total else 0.0,
+            "expulsiones": self.expulsiones,
+            "caducados": self.caducados,
+        }
+
+
+class CacheMemoria:
+    """
+    Caché LRU en memoria limitada por tamaño total en bytes, con TTL.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        """
+        :param max_bytes: Tamaño máximo total de los valores almacenados
+        :param ttl: Segundos de validez de cada entrada (None para no caducar)
+        """
+        self.max_bytes = int(max_bytes)
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.contadores = _Contadores()
+
+    def obtener(self, clave):
+        """
+        :param clave: Clave de la entrada
+        :return: Bytes almacenados o None si no están o han caducado
+        """
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self.contadores.fallos += 1
+                return None
+            expira, valor = entrada
+            if expira is not None and expira < time.time():
+                self._eliminar(clave)
+                self.contadores.caducados += 1
+                self.contadores.fallos += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.contadores.aciertos += 1
+            return valor
+
+    def guardar(self, clave, valor):
+        """
+        :param clave: Clave de la entrada
+        :param valor: Bytes a almacenar (se ignoran si superan el tamaño máximo)
+        """
+        if len(valor) > self.max_bytes:
+            return
+        expira = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if clave in self._datos:
+                self._eliminar(clave)
+            self._datos[clave] = (expira, valor)
+            self._bytes += len(valor)
+            while self._bytes > self.max_bytes:
+                antigua = next(iter(self._datos))
+                self._eliminar(antigua)
+                self.contadores.expulsiones += 1
+
+    def _eliminar(self, clave):
+        _, valor = self._datos.pop(clave)
+        self._bytes -= len(valor)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "backend": "memoria",
+                "entradas": len(self._datos),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                **self.contadores.como_dict(),
+            }
+
+
+class CacheDisco:
+    """
+    Caché LRU en un archivo sqlite limitada por tamaño total en bytes, con TTL.
+    """
+
+    def __init__(self, ruta, max_bytes, ttl=None):
+        """
+        :param ruta: Ruta del archivo sqlite (se crea si no existe)
+        :param max_bytes: Tamaño máximo total de los valores almacenados
+        :param ttl: Segundos de validez de cada entrada (None para no caducar)
+        """
+        self.max_bytes = int(max_bytes)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.contadores = _Contadores()
+
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA synchronous=NORMAL")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " clave TEXT PRIMARY KEY,"
+            " valor BLOB NOT NULL,"
+            " tamano INTEGER NOT NULL,"
+            " expira REAL,"
+            " acceso REAL NOT NULL)"
+        )
+        self._conexion.execute("CREATE INDEX IF NOT EXISTS cache_acceso ON cache (acceso)")
+
+    def _total(self):
+        return self._conexion.execute("SELECT COALESCE(SUM(tamano), 0) FROM cache").fetchone()[0]
+
+    def obtener(self, clave):
+        """
+        :param clave: Clave de la entrada
+        :return: Bytes almacenados o None si no están o han caducado
+        """
+        ahora = time.time()
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT valor, tamano, expira FROM cache WHERE clave = ?", (clave,)
+            ).fetchone()
+            if fila is None:
+                self.contadores.fallos += 1
+                return None
+            valor, _, expira = fila
+            if expira is not None and expira < ahora:
+                self._conexion.execute("DELETE FROM cache WHERE clave = ?", (clave,))
+                self.contadores.caducados += 1
+                self.contadores.fallos += 1
+                return None
+            self._conexion.execute("UPDATE cache SET acceso = ? WHERE clave = ?", (ahora, clave))
+            self.contadores.aciertos += 1
+            return bytes(valor)
+
+    def guardar(self, clave, valor):
+        """
+        :param clave: Clave de la entrada
+        :param valor: Bytes a almacenar (se ignoran si superan el tamaño máximo)
+        """
+        if len(valor) > self.max_bytes:
+            return
+        ahora = time.time()
+        expira = ahora + self.ttl if self.ttl else None
+        with self._lock:
+            # BEGIN IMMEDIATE: la escritura y la expulsión no se mezclan con las de otro proceso
+            self._conexion.execute("BEGIN IMMEDIATE")
+            try:
+                self._conexion.execute(
+                    "INSERT OR REPLACE INTO cache (clave, valor, tamano, expira, acceso) VALUES (?, ?, ?, ?, ?)",
+                    (clave, sqlite3.Binary(valor), len(valor), expira, ahora)
+                )
+                total = self._total()
+                if total > self.max_bytes:
+                    self._expulsar(ahora, total)
+                self._conexion.execute("COMMIT")
+            except Exception:
+                self._conexion.execute("ROLLBACK")
+                raise
+
+    def _expulsar(self, ahora, total):
+        # Primero las caducadas y después las de acceso más antiguo
+        cursor = self._conexion.execute(
+            "DELETE FROM cache WHERE expira IS NOT NULL AND expira < ?", (ahora,)
+        )
+        if cursor.rowcount > 0:
+            self.contadores.caducados += cursor.rowcount
+            total = self._total()
+
+        while total > self.max_bytes:
+            filas = self._conexion.execute(
+                "SELECT clave, tamano FROM cache ORDER BY acceso LIMIT 64"
+            ).fetchall()
+            if not filas:
+                break
+            for clave, tamano in filas:
+                if total <= self.max_bytes:
+                    break
+                self._conexion.execute("DELETE FROM cache WHERE clave = ?", (clave,))
+                total -= tamano
+                self.contadores.expulsiones += 1
+
+    def estadisticas(self):
+        with self._lock:
+            entradas = self._conexion.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            return {
+                "backend": "disco",
+                "entradas": entradas,
+                "bytes": self._total(),
+                "max_bytes": self.max_bytes,
+                **self.contadores.como_dict(),
+            }
+
+
+class CacheResultados:
+    """
+    Caché del pipeline sobre uno de los backends: calcula las claves y
+    serializa el análisis (detecciones y clasificación) y el JPEG final.
+    """
+
+    def __init__(self, backend, obtener_version, guardar_jpeg=True, refresco_version=30.0):
+        """
+        :param backend: CacheMemoria o CacheDisco
+        :param obtener_version: Función sin argumentos que devuelve la versión del pipeline
+            (None si no se conoce); forma parte de la clave
+        :param guardar_jpeg: Si se guarda también la imagen pixelada final
+        :param refresco_version: Segundos durante los que se reutiliza la última versión obtenida
+        """
+        self.backend = backend
+        self.obtener_version = obtener_version
+        self.guardar_jpeg = guardar_jpeg
+        self.refresco_version = float(refresco_version)
+        self._version = None
+        self._version_hasta = 0.0
+        self._lock_version = threading.Lock()
+
+    def version(self):
+        """
+        :return: Versión actual del pipeline, o None si alguna etapa no la ha informado
+        """
+        with self._lock_version:
+            if time.monotonic() >= self._version_hasta:
+                try:
+                    self._version = self.obtener_version()
+                except Exception:
+                    self._version = None
+                # Sin versión se vuelve a preguntar en la siguiente petición
+                self._version_hasta = time.monotonic() + (self.refresco_version if self._version else 0.0)
+            return self._version
+
+    def clave(self, imagen_bytes):
+        """
+        :param imagen_bytes: Contenido de la imagen
+        :return: Clave de la imagen para la versión actual del pipeline, o None si no se conoce
+        """
+        version = self.version()
+        if version is None:
+            return None
+        h = hashlib.sha256()
+        h.update(version.encode("utf-8"))
+        h.update(b"\0")
+        h.update(imagen_bytes)
+        return h.hexdigest()
+
+    def obtener_analisis(self, clave):
+        """
+        :return: Tupla (detecciones, clasificacion_json) o None si no está en caché
+        """
+        datos = self.backend.obtener(clave + ":analisis")
+        if datos is None:
+            return None
+        analisis = json.loads(datos)
+        return analisis["detecciones"], analisis["clasificacion"]
+
+    def guardar_analisis(self, clave, detecciones, clasificacion_json):
+        datos = json.dumps({"detecciones": detecciones, "clasificacion": clasificacion_json})
+        self.backend.guardar(clave + ":analisis", datos.encode("utf-8"))
+
+    def obtener_jpeg(self, clave):
+        """
+        :return: Bytes del JPEG pixelado o None si no está en caché
+        """
+        if not self.guardar_jpeg:
+            return None
+        return self.backend.obtener(clave + ":jpeg")
+
+    def guardar_jpeg_final(self, clave, jpeg):
+        if self.guardar_jpeg:
+            self.backend.guardar(clave + ":jpeg", jpeg)
+
+    def estadisticas(self):
+        return {"version": self.version(), "guardar_jpeg": self.guardar_jpeg, **self.backend.estadisticas()}
+
+
+def crear_cache_desde_entorno(obtener_version):
+    """
+    Crea la caché según las variables de entorno:
+
+    * `CACHE_BACKEND`: "memoria", "disco" o "ninguno" (por defecto)
+    * `CACHE_MAX_MB`: tamaño máximo en MB (256 por defecto)
+    * `CACHE_TTL_S`: segundos de validez de cada entrada (0 para no caducar)
+    * `CACHE_RUTA`: archivo sqlite del backend de disco
+    * `CACHE_GUARDAR_JPEG`: si se guarda también el JPEG pixelado ("true" por defecto)
+    * `CACHE_REFRESCO_VERSION_S`: segundos entre consultas de la versión del pipeline (30 por defecto)
+
+    :param obtener_version: Función sin argumentos que devuelve la versión del pipeline (o None)
+    :return: CacheResultados o None si la caché está desactivada
+    """
+    backend = os.environ.get("CACHE_BACKEND", "ninguno").lower()
+    max_bytes = int(float(os.environ.get("CACHE_MAX_MB", "256")) * 1024 * 1024)
+    ttl = float(os.environ.get("CACHE_TTL_S", "0")) or None
+
+    if backend == "memoria":
+        almacen = CacheMemoria(max_bytes, ttl)
+    elif backend == "disco":
+        almacen = CacheDisco(os.environ.get("CACHE_RUTA", "/data/cache_resultados.sqlite"), max_bytes, ttl)
+    else:
+        return None
+
+    return CacheResultados(
+        almacen,
+        obtener_version,
+        guardar_jpeg=os.environ.get("CACHE_GUARDAR_JPEG", "true").lower() == "true",
+        refresco_version=float(os.environ.get("CACHE_REFRESCO_VERSION_S", "30")),
+    )
@@ -1,23 +1,181 @@
 from flask import Flask, request, jsonify, Response
-import requests
+from werkzeug.exceptions import RequestEntityTooLarge
+from cliente_http import ClienteServicio, CircuitoAbierto
+import formato_caras
+import formato_parches
+import instrumentacion
+import servicio
+import validacion
+from cache_resultados import crear_cache_desde_entorno
+from cola_trabajos import crear_cola_desde_entorno
+from trabajador_cola import TrabajadorCola
+from pixelado import BLOQUES, agrupar_rectangulos
+import video
 from io import BytesIO
 import cv2
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import itertools
 import json
+import os
+import tempfile
+import threading
 
 
 app = Flask(__name__)
+# En modo monolito /listo espera también a los modelos de detección y clasificación
+servicio.registrar_listo(app)
+# /metrics, X-Request-Id y Server-Timing con las etapas de cada petición
+instrumentacion.registrar(app, "engine")
 
 
 # URLs de los otros contenedores Docker
 URL_BOUNDING = "http://bounding:5001/detectar_caras"
 URL_CLASIFICACION = "http://clasificacion:5002/menores"
 URL_PIXELADO = "http://pixelado:5000/pixelar"
+URL_CLASIFICACION_BINARIO = os.environ.get(
+    "CLASIFICACION_BINARIO_URL", "http://clasificacion:5002/menores_binario"
+)
+
+# Envío de caras al clasificador: "binario" (recortes ya redimensionados a
+# 64x64 y empaquetados en un único cuerpo, sin JPEG) o "jpeg" (un archivo por cara)
+TRANSPORTE_CARAS = os.environ.get("TRANSPORTE_CARAS", "binario").lower()
+TAMANO_CARA = 64
+
+# Pixelado: "parches" (se envían solo las regiones de los menores sin comprimir,
+# se recomponen sobre la imagen ya decodificada y se codifica una sola vez aquí)
+# o "imagen" (se reenvía la imagen original y el servicio devuelve el JPEG final).
+# Si los parches superan PIXELADO_MAX_MB_PARCHES se usa el modo "imagen".
+MODO_PIXELADO = os.environ.get("MODO_PIXELADO", "parches").lower()
+URL_PIXELADO_PARCHES = os.environ.get("PIXELADO_PARCHES_URL", "http://pixelado:5000/pixelar_parches")
+MAX_BYTES_PARCHES = int(float(os.environ.get("PIXELADO_MAX_MB_PARCHES", "16")) * 1024 * 1024)
+
+# Límites de la imagen recibida, comprobados en la cabecera antes de decodificar
+MAX_BYTES_IMAGEN = int(float(os.environ.get("MAX_MB_ARCHIVO", "16")) * 1024 * 1024)
+MAX_PIXELES_IMAGEN = int(float(os.environ.get("MAX_MEGAPIXELES", "100")) * 1_000_000)
+
+# Clientes con pool de conexiones, timeouts, reintentos y cortacircuitos por
+# servicio (configurables con las variables BOUNDING_*, CLASIFICACION_* y PIXELADO_*).
+# Las tres etapas son idempotentes, así que se reintentan ante fallos de conexión.
+cliente_bounding = ClienteServicio.desde_entorno(
+    "BOUNDING", "bounding", URL_BOUNDING,
+    pool=10, timeout_conexion=2, timeout_lectura=20, reintentos=2
+)
+cliente_clasificacion = ClienteServicio.desde_entorno(
+    "CLASIFICACION", "clasificacion", URL_CLASIFICACION,
+    pool=10, timeout_conexion=2, timeout_lectura=10, reintentos=2
+)
+cliente_pixelado = ClienteServicio.desde_entorno(
+    "PIXELADO", "pixelado", URL_PIXELADO,
+    pool=10, timeout_conexion=2, timeout_lectura=10, reintentos=2
+)
+
+# Réplicas del clasificador: URLs base separadas por comas (p. ej.
+# "http://clasificacion:5002,http://clasificacion2:5002"). Sin definir se usa
+# solo el cliente anterior. Los trozos de caras se reparten entre ellas por turno.
+URLS_REPLICAS = [u.strip().rstrip("/") for u in os.environ.get("CLASIFICACION_REPLICAS", "").split(",") if u.strip()]
+
+
+def crear_replica(i, base):
+    replica = ClienteServicio.desde_entorno(
+        "CLASIFICACION", f"clasificacion[{i}]", base + "/menores",
+        pool=10, timeout_conexion=2, timeout_lectura=10, reintentos=2
+    )
+    # La URL de la réplica prevalece sobre CLASIFICACION_URL
+    replica.url = base + "/menores"
+    return replica, base + "/menores_binario"
+
+
+if URLS_REPLICAS:
+    replicas_clasificacion = [crear_replica(i, base) for i, base in enumerate(URLS_REPLICAS)]
+else:
+    replicas_clasificacion = [(cliente_clasificacion, URL_CLASIFICACION_BINARIO)]
+turno_replicas = itertools.count()
+lock_replicas = threading.Lock()
+
+# Hilos compartidos por las peticiones para solapar etapas: la detección se
+# lanza mientras se decodifica la imagen y los trozos de caras (de
+# CARAS_POR_TROZO caras como máximo) se clasifican en paralelo
+HILOS_ETAPAS = int(os.environ.get("HILOS_ETAPAS", "32"))
+CARAS_POR_TROZO = max(int(os.environ.get("CLASIFICACION_CARAS_POR_TROZO", "32")), 1)
+ejecutor_etapas = ThreadPoolExecutor(max_workers=HILOS_ETAPAS, thread_name_prefix="etapas")
+
+# Topología del pipeline: "microservicios" (por defecto, una petición HTTP por
+# etapa) o "monolito" (las etapas se ejecutan en este mismo proceso)
+MODO_PIPELINE = os.environ.get("MODO_PIPELINE", "microservicios").lower()
+
+if MODO_PIPELINE == "monolito":
+    import pipeline_local
+
+# Configuración de este proceso que cambia el resultado (en modo monolito, API_bounding y
+# API_clasificacion registran además la suya al cargar sus modelos)
+servicio.fijar_version("engine", {"modo": MODO_PIPELINE, "pixelado": MODO_PIXELADO, "bloques": BLOQUES})
+
+
+def version_pipeline():
+    """
+    Versión de los resultados del pipeline para la clave de la caché: la huella de
+    la configuración de este proceso y de cada etapa (GET /listo de cada servicio,
+    incluidas todas las réplicas del clasificador).
+
+    :return: Huella hexadecimal, o None si alguna etapa no está lista o no responde
+    """
+    if MODO_PIPELINE == "monolito":
+        return None if servicio.pendientes() else servicio.version()
+    clientes = [cliente_bounding, *(cliente for cliente, _ in replicas_clasificacion), cliente_pixelado]
+    versiones = [cliente.version() for cliente in clientes]
+    if None in versiones:
+        return None
+    return hashlib.sha256("|".join([servicio.version(), *versiones]).encode("utf-8")).hexdigest()
+
+
+# Caché de resultados por hash de la imagen (desactivada salvo que se defina CACHE_BACKEND)
+cache = crear_cache_desde_entorno(version_pipeline)
+
+# Trabajadores de la cola de trabajos compartida con el gateway: trabajos
+# simultáneos por proceso y huecos como máximo para el carril de lotes
+TRABAJOS_ACTIVADOS = os.environ.get("TRABAJOS_ACTIVADOS", "true").lower() == "true"
+TRABAJOS_HILOS = int(os.environ.get("TRABAJOS_HILOS", "4"))
+TRABAJOS_MAX_BAJA = int(os.environ.get("TRABAJOS_MAX_BAJA", "3"))
+
+# Vídeo: fotogramas entre detecciones, umbral de cambio de escena (0-255),
+# margen de las cajas seguidas, tamaño máximo del archivo y códec de salida
+VIDEO_INTERVALO = int(os.environ.get("VIDEO_INTERVALO", "10"))
+VIDEO_UMBRAL_ESCENA = float(os.environ.get("VIDEO_UMBRAL_ESCENA", "30"))
+VIDEO_MARGEN = float(os.environ.get("VIDEO_MARGEN", "0.1"))
+VIDEO_MAX_BYTES = int(float(os.environ.get("VIDEO_MAX_MB", "512")) * 1024 * 1024)
+VIDEO_FOURCC = os.environ.get("VIDEO_FOURCC", "mp4v")
+
+
+class ErrorEtapa(Exception):
+    """
+    Error devuelto por una de las etapas del pipeline.
+    """
+
+    def __init__(self, mensaje, detalle):
+        super().__init__(mensaje)
+        self.mensaje = mensaje
+        self.detalle = detalle
 
 
 @app.route("/", methods=["GET"])
 def inicio():
-    return jsonify({"message": "API Engine operativa"}), 200
+    return jsonify({"message": "API Engine operativa", "modo": MODO_PIPELINE}), 200
+
+
+@app.route("/cache", methods=["GET"])
+def estado_cache():
+    if cache is None:
+        return jsonify({"activada": False}), 200
+    return jsonify({"activada": True, **cache.estadisticas()}), 200
+
+
+@app.route("/trabajos", methods=["GET"])
+def estado_trabajos():
+    if trabajador is None:
+        return jsonify({"activados": False}), 200
+    return jsonify({"activados": True, **trabajador.metricas(), "cola": trabajador.cola.estadisticas()}), 200
 
 
 def dibujar_debug_image(imagen_np, detecciones, predicciones_detalle):
@@ -62,6 +220,284 @@ def dibujar_debug_image(imagen_np, detecciones, predicciones_detalle):
     return imagen_debug
 
 
+def detectar_remoto(nombre, tipo, imagen_bytes):
+    """
+    Envía la imagen al servicio Bounding.
+
+    :param nombre: Nombre del archivo recibido
+    :param tipo: Tipo MIME del archivo recibido
+    :param imagen_bytes: Contenido de la imagen
+    :return: Lista de detecciones
+    :raises ErrorEtapa: Si el servicio responde con error
+    """
+    res_bounding = cliente_bounding.post(
+        files={'imagen': (nombre, BytesIO(imagen_bytes), tipo)}
+    )
+    if res_bounding.status_code != 200:
+        raise ErrorEtapa("Error en bounding box", res_bounding.text)
+
+    return res_bounding.json().get("detecciones", [])
+
+
+def clasificar_remoto(imagen_np, detecciones, debug_mode):
+    """
+    Envía las caras detectadas al servicio ClasificacionEdad. Si hay más de
+    CARAS_POR_TROZO caras se dividen en trozos que se clasifican en paralelo,
+    repartidos entre las réplicas del clasificador.
+
+    :param imagen_np: Imagen BGR decodificada
+    :param detecciones: Lista de detecciones con "bbox"
+    :param debug_mode: Si es True se pide la salida detallada
+    :return: Respuesta JSON del servicio (la misma estructura con uno o varios trozos)
+    :raises ErrorEtapa: Si el servicio responde con error
+    """
+    if len(detecciones) <= CARAS_POR_TROZO:
+        return clasificar_trozo(imagen_np, detecciones, debug_mode)
+
+    inicios = range(0, len(detecciones), CARAS_POR_TROZO)
+    futuros = [
+        ejecutor_etapas.submit(
+            instrumentacion.en_traza(clasificar_trozo), imagen_np, detecciones[i:i + CARAS_POR_TROZO], debug_mode
+        )
+        for i in inicios
+    ]
+    respuestas = [futuro.result() for futuro in futuros]
+
+    if not debug_mode:
+        return [r for respuesta in respuestas for r in respuesta]
+
+    resultados, detalle = [], []
+    for inicio, respuesta in zip(inicios, respuestas):
+        resultados.extend(respuesta["resultados"])
+        # "imagen_id" es relativo al trozo: se pasa a la posición en la petición completa
+        detalle.extend({**d, "imagen_id": d["imagen_id"] + inicio} for d in respuesta["detalle"])
+    return {
+        "resultados": resultados,
+        "detalle": detalle,
+        "debug": True,
+        "total_imagenes": len(resultados),
+        "menores_detectados": sum(resultados)
+    }
+
+
+def clasificar_trozo(imagen_np, detecciones, debug_mode):
+    """
+    Clasifica un grupo de caras en la siguiente réplica disponible del clasificador.
+
+    :param imagen_np: Imagen BGR decodificada
+    :param detecciones: Lista de detecciones con "bbox"
+    :param debug_mode: Si es True se pide la salida detallada
+    :return: Respuesta JSON del servicio
+    :raises ErrorEtapa: Si el servicio responde con error
+    """
+    # Las cajas que quedan fuera de la imagen o sin área no se envían: su recorte estaría vacío
+    validas = [i for i, d in enumerate(detecciones) if recorte_valido(imagen_np, d["bbox"])]
+    if not validas:
+        return completar_respuesta(None, validas, len(detecciones), debug_mode)
+
+    cliente, url_binario = siguiente_replica()
+    enviadas = [detecciones[i] for i in validas]
+    if TRANSPORTE_CARAS == "binario":
+        res_clasificacion = clasificar_remoto_binario(imagen_np, enviadas, debug_mode, cliente, url_binario)
+    else:
+        res_clasificacion = clasificar_remoto_jpeg(imagen_np, enviadas, debug_mode, cliente)
+
+    if res_clasificacion.status_code != 200:
+        raise ErrorEtapa("Error en clasificación", res_clasificacion.text)
+
+    if len(validas) == len(detecciones):
+        return res_clasificacion.json()
+    return completar_respuesta(res_clasificacion.json(), validas, len(detecciones), debug_mode)
+
+
+def recorte_valido(imagen_np, bbox):
+    """
+    :param imagen_np: Imagen BGR decodificada
+    :param bbox: Caja [x1, y1, x2, y2]
+    :return: True si el recorte de la caja dentro de la imagen tiene área
+    """
+    alto, ancho = imagen_np.shape[:2]
+    x1, y1, x2, y2 = bbox
+    return min(x2, ancho) > max(x1, 0) and min(y2, alto) > max(y1, 0)
+
+
+def completar_respuesta(respuesta, validas, total, debug_mode):
+    """
+    Recoloca la respuesta del clasificador, que solo contiene las caras enviadas,
+    en las posiciones originales y marca el resto con un error por cara, como
+    hace el propio clasificador con las imágenes que no puede decodificar.
+
+    :param respuesta: Respuesta JSON del clasificador para las caras enviadas (None si no se envió ninguna)
+    :param validas: Posición original de cada cara enviada
+    :param total: Número total de caras
+    :param debug_mode: Si es True la respuesta tiene el formato detallado
+    :return: Respuesta con la misma estructura para todas las caras
+    """
+    resultados = [0] * total
+    detalle = [
+        {"imagen_id": i, "probabilidad": 0.0, "es_menor": False, "error": "Recorte de la cara vacío"}
+        for i in range(total)
+    ]
+    if respuesta is not None:
+        for i, resultado in zip(validas, respuesta["resultados"] if debug_mode else respuesta):
+            resultados[i] = resultado
+        if debug_mode:
+            for i, d in zip(validas, respuesta["detalle"]):
+                detalle[i] = {**d, "imagen_id": i}
+    if not debug_mode:
+        return resultados
+    return {
+        "resultados": resultados,
+        "detalle": detalle,
+        "debug": True,
+        "total_imagenes": total,
+        "menores_detectados": sum(resultados)
+    }
+
+
+def siguiente_replica():
+    """
+    Elige la réplica del clasificador por turno rotatorio, saltando las que
+    tienen el circuito abierto mientras quede alguna disponible.
+
+    :return: Tupla (ClienteServicio, URL del endpoint binario)
+    """
+    with lock_replicas:
+        for _ in range(len(replicas_clasificacion)):
+            replica = replicas_clasificacion[next(turno_replicas) % len(replicas_clasificacion)]
+            if replica[0].cortacircuitos.estado != "abierto":
+                return replica
+    return replica
+
+
+def clasificar_remoto_binario(imagen_np, detecciones, debug_mode, cliente=None, url_binario=None):
+    """
+    Redimensiona cada cara a 64x64 y envía todas en un único cuerpo binario sin comprimir.
+
+    :param imagen_np: Imagen BGR decodificada
+    :param detecciones: Lista de detecciones con "bbox"
+    :param debug_mode: Si es True se pide la salida detallada
+    :param cliente: Réplica del clasificador (por defecto, la configurada)
+    :param url_binario: Endpoint binario de esa réplica
+    :return: requests.Response del servicio
+    """
+    with instrumentacion.medir("recorte"):
+        lote = np.empty((len(detecciones), TAMANO_CARA, TAMANO_CARA, 3), dtype=np.uint8)
+        for i, face in enumerate(detecciones):
+            x1, y1, x2, y2 = face["bbox"]
+            cropped = imagen_np[max(y1, 0):y2, max(x1, 0):x2]
+            lote[i] = cv2.resize(cropped, (TAMANO_CARA, TAMANO_CARA))
+
+    return (cliente or cliente_clasificacion).post(
+        url=url_binario or URL_CLASIFICACION_BINARIO,
+        data=formato_caras.empaquetar(lote),
+        params={'debug': 'true' if debug_mode else 'false'},
+        headers={'Content-Type': formato_caras.TIPO_CONTENIDO}
+    )
+
+
+def clasificar_remoto_jpeg(imagen_np, detecciones, debug_mode, cliente=None):
+    """
+    Recorta cada cara, la codifica a JPEG y las envía como archivos multipart.
+
+    :param imagen_np: Imagen BGR decodificada
+    :param detecciones: Lista de detecciones con "bbox"
+    :param debug_mode: Si es True se pide la salida detallada
+    :param cliente: Réplica del clasificador (por defecto, la configurada)
+    :return: requests.Response del servicio
+    """
+    imagenes_caras = []
+    with instrumentacion.medir("recorte"):
+        for i, face in enumerate(detecciones):
+            x1, y1, x2, y2 = face["bbox"]
+            cropped = imagen_np[max(y1, 0):y2, max(x1, 0):x2]
+            _, buffer = cv2.imencode('.jpg', cropped)
+            face_bytes = BytesIO(buffer.tobytes())
+            face_bytes.name = f"cara_{i}.jpg"
+            imagenes_caras.append(('imagenes', (face_bytes.name, face_bytes, 'image/jpeg')))
+
+    clasificacion_data = {'debug': 'true' if debug_mode else 'false'}
+
+    return (cliente or cliente_clasificacion).post(
+        files=imagenes_caras,
+        data=clasificacion_data
+    )
+
+
+def pixelar_remoto(nombre, tipo, imagen_bytes, menores_bboxes):
+    """
+    Envía la imagen original y los rectángulos a pixelar al servicio Pixelado.
+
+    :param nombre: Nombre del archivo recibido
+    :param tipo: Tipo MIME del archivo recibido
+    :param imagen_bytes: Contenido de la imagen
+    :param menores_bboxes: Lista de rectángulos (x, y, w, h)
+    :return: Bytes de la imagen JPEG pixelada
+    :raises ErrorEtapa: Si el servicio responde con error
+    """
+    res_pixelado = cliente_pixelado.post(
+        files={'imagen': (nombre, BytesIO(imagen_bytes), tipo)},
+        data={'rectangulos': json.dumps(menores_bboxes)}
+    )
+    if res_pixelado.status_code != 200:
+        raise ErrorEtapa("Error en pixelado", res_pixelado.text)
+
+    return res_pixelado.content
+
+
+def pixelar_parches_remoto(imagen_np, menores_bboxes):
+    """
+    Envía al servicio Pixelado solo las regiones de la imagen que hay que pixelar
+    y las recompone sobre la imagen decodificada. Los rectángulos que se solapan
+    viajan en el mismo parche, así que el resultado es el mismo que pixelando la
+    imagen completa.
+
+    :param imagen_np: Imagen BGR decodificada (se modifica en el sitio)
+    :param menores_bboxes: Lista de rectángulos (x, y, w, h)
+    :return: La misma imagen, con las regiones pixeladas
+    :raises ErrorEtapa: Si el servicio responde con error
+    """
+    alto, ancho = imagen_np.shape[:2]
+    grupos = agrupar_rectangulos(menores_bboxes, alto, ancho)
+    if not grupos:
+        return imagen_np
+
+    cuerpo = formato_parches.empaquetar(
+        [imagen_np[y1:y2, x1:x2] for (x1, y1, x2, y2), _ in grupos],
+        [rects for _, rects in grupos]
+    )
+    res_pixelado = cliente_pixelado.post(
+        url=URL_PIXELADO_PARCHES,
+        data=cuerpo,
+        headers={'Content-Type': formato_parches.TIPO_CONTENIDO}
+    )
+    if res_pixelado.status_code != 200:
+        raise ErrorEtapa("Error en pixelado", res_pixelado.text)
+
+    try:
+        parches, _ = formato_parches.desempaquetar(res_pixelado.content, max_parches=len(grupos))
+    except ValueError as e:
+        raise ErrorEtapa("Error en pixelado", f"Respuesta no válida: {e}")
+    for ((x1, y1, x2, y2), _), parche in zip(grupos, parches):
+        if parche.shape[:2] != (y2 - y1, x2 - x1):
+            raise ErrorEtapa("Error en pixelado", "El servicio devolvió un parche de otro tamaño")
+        imagen_np[y1:y2, x1:x2] = parche
+    return imagen_np
+
+
+def bytes_parches(imagen_np, menores_bboxes):
+    """
+    :return: Bytes de píxeles que ocuparían los parches de `menores_bboxes`
+    """
+    alto, ancho = imagen_np.shape[:2]
+    canales = imagen_np.shape[2] if imagen_np.ndim == 3 else 1
+    return sum((x2 - x1) * (y2 - y1) * canales for (x1, y1, x2, y2), _ in agrupar_rectangulos(menores_bboxes, alto, ancho))
+
+
+def _json(codigo, cuerpo):
+    return codigo, 'application/json', json.dumps(cuerpo).encode('utf-8')
+
+
 @app.route("/procesar", methods=["POST"])
 def procesar():
     if 'imagen' not in request.files:
@@ -69,25 +505,89 @@ def procesar():
 
     imagen = request.files['imagen']
     imagen_bytes = imagen.read()  # Leer toda la imagen una sola vez
-    imagen_np = cv2.imdecode(np.frombuffer(imagen_bytes, np.uint8), cv2.IMREAD_COLOR)
-
-    if imagen_np is None:
-        return jsonify({"error": "No se pudo procesar la imagen"}), 400
 
     # Verificar si está activado el modo debug
     debug_mode = request.form.get('debug', 'false').lower() == 'true'
 
+    codigo, tipo, contenido = ejecutar_pipeline(imagen.filename, imagen.mimetype, imagen_bytes, debug_mode)
+    return Response(contenido, status=codigo, content_type=tipo)
+
+
+def ejecutar_pipeline(nombre, tipo, imagen_bytes, debug_mode=False):
+    """
+    Ejecuta el pipeline completo sobre una imagen. Lo usan tanto el endpoint
+    `/procesar` como los trabajadores de la cola de trabajos.
+
+    :param nombre: Nombre del archivo recibido
+    :param tipo: Tipo MIME del archivo recibido
+    :param imagen_bytes: Contenido de la imagen
+    :param debug_mode: Si se devuelve la imagen anotada en lugar de la pixelada
+    :return: Tupla (código HTTP, tipo MIME, bytes de la respuesta)
+    """
+    with instrumentacion.medir("total"):
+        return _ejecutar_pipeline(nombre, tipo, imagen_bytes, debug_mode)
+
+
+def _ejecutar_pipeline(nombre, tipo, imagen_bytes, debug_mode):
+    # Si la misma imagen ya se procesó, se devuelve el resultado sin decodificarla
+    clave = cache.clave(imagen_bytes) if cache is not None else None
+    if clave is not None and not debug_mode:
+        jpeg_cacheado = cache.obtener_jpeg(clave)
+        if jpeg_cacheado is not None:
+            return 200, 'image/jpeg', jpeg_cacheado
+
+    # Validación de la cabecera antes de enviar la imagen a ningún servicio
     try:
-        # Paso 1: Bounding box
-        res_bounding = requests.post(
-            URL_BOUNDING,
-            files={'imagen': (imagen.filename, BytesIO(imagen_bytes), imagen.mimetype)}
-        )
-        if res_bounding.status_code != 200:
-            return jsonify({"error": "Error en bounding box", "detalle": res_bounding.text}), 500
+        validacion.validar(imagen_bytes, max_bytes=MAX_BYTES_IMAGEN, max_pixeles=MAX_PIXELES_IMAGEN)
+    except ValueError as e:
+        return _json(400, {"error": "No se pudo procesar la imagen", "detalle": str(e)})
 
-        bounding_json = res_bounding.json()
-        detecciones = bounding_json.get("detecciones", [])
+    try:
+        analisis = cache.obtener_analisis(clave) if clave is not None else None
+
+        # Paso 1: Bounding box. En modo microservicios solo necesita los bytes, así
+        # que se lanza antes de decodificar y la decodificación se hace mientras tanto.
+        futuro_deteccion = None
+        if analisis is None and MODO_PIPELINE != "monolito":
+            def detectar_medido():
+                with instrumentacion.medir("deteccion"):
+                    return detectar_remoto(nombre, tipo, imagen_bytes)
+            futuro_deteccion = ejecutor_etapas.submit(instrumentacion.en_traza(detectar_medido))
+
+        try:
+            with instrumentacion.medir("decodificacion"):
+                imagen_np = validacion.decodificar(
+                    imagen_bytes, max_bytes=MAX_BYTES_IMAGEN, max_pixeles=MAX_PIXELES_IMAGEN
+                )
+        except ValueError as e:
+            return _json(400, {"error": "No se pudo procesar la imagen", "detalle": str(e)})
+
+        if analisis is not None:
+            detecciones, clasificacion_json = analisis
+        else:
+            if futuro_deteccion is not None:
+                detecciones = futuro_deteccion.result()
+            else:
+                with instrumentacion.medir("deteccion"):
+                    detecciones = pipeline_local.detectar(imagen_np)
+
+            # Paso 2: Recorte de cada bounding box y clasificación. Con caché se pide
+            # siempre el detalle para poder servir después peticiones con y sin debug.
+            clasificacion_json = None
+            if detecciones:
+                detalle = debug_mode or clave is not None
+                with instrumentacion.medir("clasificacion"):
+                    if MODO_PIPELINE == "monolito":
+                        clasificacion_json = pipeline_local.clasificar(imagen_np, detecciones, detalle)
+                    else:
+                        clasificacion_json = clasificar_remoto(imagen_np, detecciones, detalle)
+
+            # Una cara sin clasificar cuenta como adulta en "resultados": ese análisis (y su
+            # JPEG) no se guarda, para no servir la cara sin pixelar desde la caché
+            if clave is not None and clasificacion_completa(clasificacion_json):
+                cache.guardar_analisis(clave, detecciones, clasificacion_json)
+            else:
+                clave = None
 
         # Si no hay detecciones, devolver imagen original
         if not detecciones:
@@ -96,42 +596,20 @@ def procesar():
                 imagen_debug = imagen_np.copy()
                 cv2.putText(imagen_debug, "No faces detected", (50, 50), 
                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                _, buffer = cv2.imencode('.jpg', imagen_debug)
-                return Response(buffer.tobytes(), content_type='image/jpeg')
+                with instrumentacion.medir("codificacion"):
+                    _, buffer = cv2.imencode('.jpg', imagen_debug)
+                return 200, 'image/jpeg', buffer.tobytes()
             else:
-                return Response(imagen_bytes, content_type='image/jpeg')
+                return 200, 'image/jpeg', imagen_bytes
 
-        # Paso 2: Recortar cada bounding box y convertir a imagen
-        imagenes_caras = []
-        for i, face in enumerate(detecciones):
-            x1, y1, x2, y2 = face["bbox"]
-            cropped = imagen_np[y1:y2, x1:x2]
-            _, buffer = cv2.imencode('.jpg', cropped)
-            face_bytes = BytesIO(buffer.tobytes())
-            face_bytes.name = f"cara_{i}.jpg"
-            imagenes_caras.append(('imagenes', (face_bytes.name, face_bytes, 'image/jpeg')))
-
-        # Paso 2: Clasificación (con información detallada si es debug)
-        clasificacion_data = {'debug': 'true' if debug_mode else 'false'}
-        
-        res_clasificacion = requests.post(
-            URL_CLASIFICACION,
-            files=imagenes_caras,
-            data=clasificacion_data
-        )
-        
-        if res_clasificacion.status_code != 200:
-            return jsonify({"error": "Error en clasificación", "detalle": res_clasificacion.text}), 500
-
-        clasificacion_json = res_clasificacion.json()
-        
         # Si es modo debug, devolver imagen con bounding boxes anotados
         if debug_mode:
             if isinstance(clasificacion_json, dict) and 'detalle' in clasificacion_json:
                 predicciones_detalle = clasificacion_json['detalle']
                 imagen_debug = dibujar_debug_image(imagen_np, detecciones, predicciones_detalle)
-                _, buffer = cv2.imencode('.jpg', imagen_debug)
-                return Response(buffer.tobytes(), content_type='image/jpeg')
+                with instrumentacion.medir("codificacion"):
+                    _, buffer = cv2.imencode('.jpg', imagen_debug)
+                return 200, 'image/jpeg', buffer.tobytes()
             else:
                 # Fallback si la API de clasificación no soporta modo debug
                 menores = clasificacion_json if isinstance(clasificacion_json, list) else []
@@ -142,8 +620,9 @@ def procesar():
                         "es_menor": bool(es_menor)
                     })
                 imagen_debug = dibujar_debug_image(imagen_np, detecciones, predicciones_detalle)
-                _, buffer = cv2.imencode('.jpg', imagen_debug)
-                return Response(buffer.tobytes(), content_type='image/jpeg')
+                with instrumentacion.medir("codificacion"):
+                    _, buffer = cv2.imencode('.jpg', imagen_debug)
+                return 200, 'image/jpeg', buffer.tobytes()
 
         # Modo normal: proceder con pixelado
         menores = clasificacion_json if isinstance(clasificacion_json, list) else clasificacion_json.get('resultados', [])
@@ -160,18 +639,161 @@ def procesar():
                 menores_bboxes.append([x, y, w, h])
 
         # Paso 3: Pixelado
-        res_pixelado = requests.post(
-            URL_PIXELADO,
-            files={'imagen': (imagen.filename, BytesIO(imagen_bytes), imagen.mimetype)},
-            data={'rectangulos': json.dumps(menores_bboxes)}
-        )
-        if res_pixelado.status_code != 200:
-            return jsonify({"error": "Error en pixelado", "detalle": res_pixelado.text}), 500
+        if MODO_PIPELINE == "monolito":
+            with instrumentacion.medir("pixelado"):
+                imagen_pixelada = pipeline_local.pixelar(imagen_np, menores_bboxes)
+        elif MODO_PIXELADO == "parches" and bytes_parches(imagen_np, menores_bboxes) <= MAX_BYTES_PARCHES:
+            # La imagen decodificada ya no se usa para nada más: los parches se recomponen sobre ella
+            with instrumentacion.medir("pixelado"):
+                pixelar_parches_remoto(imagen_np, menores_bboxes)
+            with instrumentacion.medir("codificacion"):
+                _, buffer = cv2.imencode('.jpg', imagen_np)
+            imagen_pixelada = buffer.tobytes()
+        else:
+            with instrumentacion.medir("pixelado"):
+                imagen_pixelada = pixelar_remoto(nombre, tipo, imagen_bytes, menores_bboxes)
+
+        if clave is not None:
+            cache.guardar_jpeg_final(clave, imagen_pixelada)
 
-        return Response(res_pixelado.content, content_type='image/jpeg')
+        return 200, 'image/jpeg', imagen_pixelada
 
+    except ErrorEtapa as e:
+        return _json(500, {"error": e.mensaje, "detalle": e.detalle})
+    except CircuitoAbierto as e:
+        return _json(503, {"error": "Servicio interno no disponible", "detalle": str(e)})
     except Exception as e:
+        return _json(500, {"error": "Error inesperado", "detalle": str(e)})
+
+
+def clasificacion_completa(clasificacion_json):
+    """
+    :param clasificacion_json: Respuesta del clasificador (None si no había caras)
+    :return: True si todas las caras tienen clasificación (ninguna entrada de "detalle" con "error")
+    """
+    if not isinstance(clasificacion_json, dict):
+        return clasificacion_json is None
+    return not any("error" in d for d in clasificacion_json.get("detalle", []))
+
+
+def detectar_fotograma(fotograma):
+    """
+    Detecta las caras de un fotograma de vídeo con la etapa de detección del pipeline.
+
+    :param fotograma: Fotograma BGR
+    :return: Lista de detecciones con "bbox"
+    """
+    if MODO_PIPELINE == "monolito":
+        return pipeline_local.detectar(fotograma)
+    _, buffer = cv2.imencode('.jpg', fotograma)
+    return detectar_remoto("fotograma.jpg", "image/jpeg", buffer.tobytes())
+
+
+def clasificar_fotograma(fotograma, detecciones):
+    """
+    Clasifica las caras de un fotograma de vídeo.
+
+    :param fotograma: Fotograma BGR
+    :param detecciones: Lista de detecciones con "bbox"
+    :return: Lista con el detalle del clasificador por detección
+    """
+    if MODO_PIPELINE == "monolito":
+        return pipeline_local.clasificar(fotograma, detecciones, True)["detalle"]
+    return clasificar_remoto(fotograma, detecciones, True)["detalle"]
+
+
+@app.route("/procesar_video", methods=["POST"])
+def procesar_video():
+    """
+    Pixela las caras de menores de un vídeo. La detección solo se ejecuta en
+    los fotogramas clave y las caras se siguen entre ellos (ver video.py). El
+    vídeo resultante se devuelve en streaming y las estadísticas (fotogramas,
+    fotogramas clave y fotogramas por segundo) en las cabeceras X-Video-*.
+    """
+    # El límite se comprueba antes de acceder a request.files, que guarda el cuerpo completo en disco
+    demasiado_grande = jsonify({"error": f"El vídeo excede el límite de {VIDEO_MAX_BYTES / (1024 * 1024):g}MB"}), 413
+    if request.content_length is not None and request.content_length > VIDEO_MAX_BYTES:
+        return demasiado_grande
+    # Sin Content-Length (subida por trozos) el propio parser corta al superar el límite
+    request.max_content_length = VIDEO_MAX_BYTES
+    try:
+        if 'video' not in request.files:
+            return jsonify({"error": "No se ha enviado ningún vídeo"}), 400
+    except RequestEntityTooLarge:
+        return demasiado_grande
+
+    try:
+        intervalo = int(request.form.get('intervalo', VIDEO_INTERVALO))
+    except ValueError:
+        return jsonify({"error": "El intervalo debe ser un entero"}), 400
+
+    archivo = request.files['video']
+    sufijo = os.path.splitext(archivo.filename or "")[1] or ".mp4"
+    # OpenCV lee y escribe vídeo desde rutas, así que entrada y salida van a archivos temporales
+    entrada = tempfile.NamedTemporaryFile(suffix=sufijo, delete=False)
+    salida = tempfile.NamedTemporaryFile(suffix=".mp4", delete=False)
+    entrada.close()
+    salida.close()
+
+    def borrar():
+        for ruta in (entrada.name, salida.name):
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+    try:
+        archivo.save(entrada.name)
+        anonimizador = video.AnonimizadorVideo(
+            detectar_fotograma, clasificar_fotograma,
+            intervalo=intervalo, umbral_escena=VIDEO_UMBRAL_ESCENA, margen=VIDEO_MARGEN
+        )
+        estadisticas = video.procesar_video(entrada.name, salida.name, anonimizador, VIDEO_FOURCC)
+    except ValueError as e:
+        borrar()
+        return jsonify({"error": "No se pudo procesar el vídeo", "detalle": str(e)}), 400
+    except ErrorEtapa as e:
+        borrar()
+        return jsonify({"error": e.mensaje, "detalle": e.detalle}), 500
+    except CircuitoAbierto as e:
+        borrar()
+        return jsonify({"error": "Servicio interno no disponible", "detalle": str(e)}), 503
+    except Exception as e:
+        borrar()
         return jsonify({"error": "Error inesperado", "detalle": str(e)}), 500
 
+    def enviar():
+        try:
+            with open(salida.name, "rb") as f:
+                while True:
+                    bloque = f.read(1024 * 1024)
+                    if not bloque:
+                        break
+                    yield bloque
+        finally:
+            borrar()
+
+    return Response(enviar(), content_type='video/mp4', headers={
+        'Content-Length': str(os.path.getsize(salida.name)),
+        'X-Video-Fotogramas': str(estadisticas["fotogramas"]),
+        'X-Video-Fotogramas-Clave': str(estadisticas["fotogramas_clave"]),
+        'X-Video-FPS': str(estadisticas["fps"]),
+        'X-Video-Estadisticas': json.dumps(estadisticas),
+    })
+
+
+# Los trabajadores arrancan al importar el módulo, una vez definido el pipeline
+trabajador = None
+if TRABAJOS_ACTIVADOS:
+    trabajador = TrabajadorCola(
+        crear_cola_desde_entorno(), ejecutar_pipeline, hilos=TRABAJOS_HILOS, max_baja=TRABAJOS_MAX_BAJA
+    )
+    trabajador.iniciar()
+    # Al detener el worker se dejan de reclamar trabajos y se terminan los que están en curso
+    servicio.registrar_cierre(
+        lambda: trabajador.detener(timeout=float(os.environ.get("TRABAJOS_TIMEOUT_CIERRE_S", "25")))
+    )
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5003)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5003, threaded=True)
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+Pipeline en proceso (modo "monolito").
+
+Usa directamente la lógica de los servicios Bounding, ClasificacionEdad y
+Pixelado como funciones de librería: la imagen se decodifica una sola vez en
+el Engine y las etapas se pasan arrays de NumPy, sin peticiones HTTP ni
+codificaciones JPEG intermedias. Requiere que API_bounding.py,
+API_clasificacion.py, backends_modelo.py, planificador_lotes.py, pixelado.py y
+el modelo de edad estén junto a engine_api.py (ver Dockerfile.monolito).
+"""
+import cv2
+
+import API_bounding
+import API_clasificacion
+from pixelado import pixelar_rectangulos
+
+
+def detectar(imagen_np):
+    """
+    Detecta las caras de la imagen.
+
+    :param imagen_np: Imagen BGR decodificada
+    :return: Lista de detecciones con "bbox", "confidence" e "id"
+    """
+    return API_bounding.detectar(imagen_np)
+
+
+def recortar_caras(imagen_np, detecciones):
+    """
+    Recorta cada detección de la imagen (sin copiar ni codificar).
+
+    :param imagen_np: Imagen BGR decodificada
+    :param detecciones: Lista de detecciones con "bbox"
+    :return: Lista de vistas de la imagen, una por detección
+    """
+    caras = []
+    for face in detecciones:
+        x1, y1, x2, y2 = face["bbox"]
+        caras.append(imagen_np[max(y1, 0):y2, max(x1, 0):x2])
+    return caras
+
+
+def clasificar(imagen_np, detecciones, debug_mode):
+    """
+    Clasifica las caras detectadas.
+
+    :param imagen_np: Imagen BGR decodificada
+    :param detecciones: Lista de detecciones con "bbox"
+    :param debug_mode: Si es True se devuelve la salida detallada
+    :return: Misma estructura que devuelve el endpoint /menores
+    """
+    return API_clasificacion.clasificar_caras(recortar_caras(imagen_np, detecciones), debug_mode)
+
+
+def pixelar(imagen_np, rectangulos):
+    """
+    Pixela los rectángulos indicados y codifica el resultado a JPEG.
+
+    :param imagen_np: Imagen BGR decodificada (no se modifica)
+    :param rectangulos: Lista de rectángulos (x, y, w, h)
+    :return: Bytes de la imagen JPEG resultante
+    """
+    imagen = pixelar_rectangulos(imagen_np.copy(), rectangulos)
+    _, buffer = cv2.imencode('.jpg', imagen)
+    return buffer.tobytes()
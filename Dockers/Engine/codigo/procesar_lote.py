@@ -0,0 +1,588 @@
+"""
+Procesamiento por lotes sin conexión de un árbol de imágenes en disco.
+
+Aplica a cada imagen el mismo pipeline que el Engine en modo monolito
+(`pipeline_local`: detección, clasificación y pixelado como funciones) sin
+pasar por HTTP, y escribe el resultado en `destino` con la misma ruta
+relativa que en `origen`:
+
+* Un hilo lector recorre el manifiesto y lee por adelantado los archivos
+  pendientes (`--prefetch`), de modo que la lectura del disco se solapa con el
+  cálculo.
+* Un pool de procesos (`--procesos`, arrancados con `spawn` porque TensorFlow
+  no es seguro tras un fork) carga y calienta los modelos una vez por proceso
+  y procesa una imagen cada vez. Cada proceso usa `--hilos` hilos de cálculo
+  para no sobresuscribir la CPU.
+* Un hilo escritor guarda los resultados (escritura atómica con un temporal)
+  y los anota en el manifiesto; su cola está acotada (`--cola-escritura`), así
+  que si el disco de destino no da abasto se frena la lectura.
+
+Las imágenes sin menores se copian sin modificar. Las caras que el
+clasificador no ha podido clasificar se pixelan como si fueran de menores,
+para que un fallo nunca deje una cara sin proteger en un archivo anotado como
+`hecho`. Los JPEG se pixelan sobre
+los coeficientes DCT si `pixelado_dct` y libturbojpeg están disponibles (los
+píxeles fuera de las caras no cambian); cada resultado DCT se decodifica y se
+compara con el original fuera de las caras, y si no coincide se usa el
+pixelado por píxeles. El resto se vuelve a codificar en su formato original.
+
+El manifiesto es una base de datos sqlite (por defecto
+`<destino>/manifiesto.sqlite`) con el estado de cada archivo (`pendiente`,
+`hecho` o `error`, con el motivo). Si la ejecución se interrumpe, repetir la
+misma orden continúa con los archivos que quedaban; `--reintentar-errores`
+vuelve a procesar los que fallaron. Las imágenes pueden venir de recorrer
+`origen` o de una lista (`--lista`, una ruta por línea relativa a `origen`).
+
+Se ejecuta en la imagen del Engine monolito, que contiene los modelos y el
+código de los servicios:
+
+    docker run --rm -v /fotos:/origen:ro -v /anonimizadas:/destino engine-monolito \\
+        python procesar_lote.py /origen /destino --procesos 4
+
+Uso:
+    python procesar_lote.py fotos/ anonimizadas/ --procesos 4 --informe informe.json
+    python procesar_lote.py fotos/ anonimizadas/ --lista pendientes.txt --reintentar-errores
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import numpy as np
+
+import validacion
+from pixelado import pixelar_rectangulos
+
+EXTENSIONES_IMAGEN = {".png", ".jpg", ".jpeg", ".bmp", ".webp"}
+PENDIENTE, HECHO, ERROR = "pendiente", "hecho", "error"
+
+# Filas del manifiesto por transacción al inventariar y al anotar resultados
+FILAS_POR_TRANSACCION = 5000
+SEGUNDOS_ENTRE_COMMITS = 2.0
+
+
+class Manifiesto:
+    """
+    Estado de cada archivo del lote en una base de datos sqlite.
+
+    Cada hilo abre su propia conexión: el lector consulta los pendientes
+    mientras el escritor anota los resultados (modo WAL).
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        conexion = self.conectar()
+        conexion.executescript("""
+            CREATE TABLE IF NOT EXISTS archivos (
+                id INTEGER PRIMARY KEY,
+                ruta TEXT NOT NULL UNIQUE,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                caras INTEGER,
+                menores INTEGER,
+                camino TEXT,
+                error TEXT,
+                segundos REAL,
+                actualizado REAL
+            );
+            CREATE INDEX IF NOT EXISTS archivos_estado ON archivos (estado, id);
+            CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);
+        """)
+        conexion.close()
+
+    def conectar(self):
+        conexion = sqlite3.connect(self.ruta, timeout=30)
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("PRAGMA synchronous=NORMAL")
+        return conexion
+
+    def meta(self, conexion, clave):
+        fila = conexion.execute("SELECT valor FROM meta WHERE clave = ?", (clave,)).fetchone()
+        return fila[0] if fila else None
+
+    def fijar_meta(self, conexion, clave, valor):
+        conexion.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES (?, ?)", (clave, str(valor)))
+
+    def inventariar(self, rutas, completo=False):
+        """
+        Añade al manifiesto las rutas que aún no estaban (como pendientes).
+
+        :param rutas: Iterable de rutas relativas a `origen`
+        :param completo: Si las rutas son todo el origen (no hará falta volver a recorrerlo)
+        :return: Número de rutas nuevas
+        """
+        conexion = self.conectar()
+        nuevas = 0
+        try:
+            bloque = []
+            for ruta in rutas:
+                bloque.append((ruta,))
+                if len(bloque) >= FILAS_POR_TRANSACCION:
+                    nuevas += self._insertar(conexion, bloque)
+                    bloque = []
+            nuevas += self._insertar(conexion, bloque)
+            if completo:
+                self.fijar_meta(conexion, "inventario", "completo")
+                conexion.commit()
+        finally:
+            conexion.close()
+        return nuevas
+
+    def _insertar(self, conexion, bloque):
+        antes = conexion.total_changes
+        conexion.executemany("INSERT OR IGNORE INTO archivos (ruta) VALUES (?)", bloque)
+        conexion.commit()
+        return conexion.total_changes - antes
+
+    def recuento(self):
+        """
+        :return: Diccionario estado -> número de archivos
+        """
+        conexion = self.conectar()
+        try:
+            return dict(conexion.execute("SELECT estado, COUNT(*) FROM archivos GROUP BY estado").fetchall())
+        finally:
+            conexion.close()
+
+    def reintentar_errores(self):
+        conexion = self.conectar()
+        try:
+            cursor = conexion.execute("UPDATE archivos SET estado = ?, error = NULL WHERE estado = ?", (PENDIENTE, ERROR))
+            conexion.commit()
+            return cursor.rowcount
+        finally:
+            conexion.close()
+
+    def pendientes(self, parar, tamano_bloque=1000):
+        """
+        Genera (id, ruta) de los archivos pendientes en orden, por bloques.
+
+        :param parar: threading.Event que detiene la consulta
+        """
+        conexion = self.conectar()
+        try:
+            ultimo = 0
+            while not parar.is_set():
+                filas = conexion.execute(
+                    "SELECT id, ruta FROM archivos WHERE estado = ? AND id > ? ORDER BY id LIMIT ?",
+                    (PENDIENTE, ultimo, tamano_bloque),
+                ).fetchall()
+                if not filas:
+                    return
+                yield from filas
+                ultimo = filas[-1][0]
+        finally:
+            conexion.close()
+
+
+def recorrer(origen, excluir=None):
+    """
+    Recorre `origen` y genera las rutas relativas de las imágenes, en orden.
+
+    :param origen: Directorio raíz
+    :param excluir: Directorio que no se recorre (el destino, si está dentro del origen)
+    """
+    excluir = os.path.realpath(excluir) if excluir else None
+    for raiz, directorios, archivos in os.walk(origen):
+        directorios[:] = sorted(d for d in directorios if os.path.realpath(os.path.join(raiz, d)) != excluir)
+        for nombre in sorted(archivos):
+            if os.path.splitext(nombre)[1].lower() in EXTENSIONES_IMAGEN:
+                yield os.path.relpath(os.path.join(raiz, nombre), origen)
+
+
+def leer_lista(ruta_lista, origen):
+    """
+    Genera las rutas de un archivo de lista (una por línea), relativas a `origen`.
+    Las rutas absolutas deben estar dentro de `origen`.
+    """
+    with open(ruta_lista, encoding="utf-8") as f:
+        for linea in f:
+            ruta = linea.strip()
+            if not ruta:
+                continue
+            if os.path.isabs(ruta):
+                ruta = os.path.relpath(ruta, origen)
+            ruta = os.path.normpath(ruta)
+            if ruta.startswith(".."):
+                print(f"Se omite {linea.strip()}: está fuera de {origen}", file=sys.stderr)
+                continue
+            yield ruta
+
+
+# --- Procesos del pool ---------------------------------------------------------
+
+_pipeline = None
+_pixelado_dct = None
+_max_pixeles = None
+
+
+def iniciar_proceso(hilos, max_pixeles, jpeg_dct):
+    """
+    Inicializa un proceso del pool: limita sus hilos de cálculo y carga y
+    calienta los modelos (al importar `pipeline_local`).
+    """
+    global _pipeline, _pixelado_dct, _max_pixeles
+    # El proceso principal decide cuándo parar (Ctrl+C)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for variable in ("OMP_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "MODELO_HILOS"):
+        os.environ[variable] = str(hilos)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    # Cada proceso clasifica una imagen cada vez: no hay peticiones que agrupar
+    os.environ.setdefault("LOTE_ACTIVADO", "false")
+
+    cv2.setNumThreads(hilos)
+    import pipeline_local
+    _pipeline = pipeline_local
+    _max_pixeles = max_pixeles
+    if jpeg_dct:
+        try:
+            import pixelado_dct
+            if pixelado_dct.disponible():
+                _pixelado_dct = pixelado_dct
+        except ImportError:
+            pass
+
+
+def dct_correcto(salida, original, rectangulos, margen=32):
+    """
+    Comprueba el resultado del pixelado DCT antes de darlo por bueno: tiene que
+    decodificarse con las mismas dimensiones y, lejos de las caras (el margen
+    cubre la ampliación a MCU y el suavizado del croma), con los mismos píxeles
+    que el original. Un error aquí quedaría anotado como `hecho` en el
+    manifiesto y no se repetiría al reanudar.
+
+    :param salida: Bytes del JPEG pixelado
+    :param original: Imagen original decodificada (aún sin pixelar)
+    :param rectangulos: Rectángulos (x, y, w, h) pixelados
+    :return: True si el resultado es correcto
+    """
+    decodificada = cv2.imdecode(np.frombuffer(salida, np.uint8), cv2.IMREAD_COLOR)
+    if decodificada is None or decodificada.shape != original.shape:
+        return False
+    mascara = np.ones(original.shape[:2], dtype=bool)
+    for x, y, w, h in rectangulos:
+        mascara[max(y - margen, 0):y + h + margen, max(x - margen, 0):x + w + margen] = False
+    return bool(np.array_equal(decodificada[mascara], original[mascara]))
+
+
+def procesar_imagen(datos, extension):
+    """
+    Detecta, clasifica y pixela una imagen en un proceso del pool.
+
+    :param datos: Bytes del archivo
+    :param extension: Extensión del archivo (formato en el que se escribe el resultado)
+    :return: Diccionario con "estado", "caras", "menores", "camino" ("copia", "dct" o
+             "pixeles"), "datos" (None si no hay que modificar la imagen), "error" y "segundos"
+    """
+    inicio = time.perf_counter()
+    try:
+        formato, _, _ = validacion.validar(datos, max_bytes=len(datos), max_pixeles=_max_pixeles)
+        imagen = validacion.decodificar(datos, max_bytes=len(datos), max_pixeles=_max_pixeles)
+        detecciones = _pipeline.detectar(imagen)
+        # Con el detalle se distinguen las caras sin clasificar (entradas con "error"), que también se pixelan
+        detalle = _pipeline.clasificar(imagen, detecciones, True)["detalle"] if detecciones else []
+        rectangulos = []
+        for deteccion, prediccion in zip(detecciones, detalle):
+            if prediccion["es_menor"] or "error" in prediccion:
+                x1, y1, x2, y2 = deteccion["bbox"]
+                rectangulos.append([x1, y1, x2 - x1, y2 - y1])
+
+        salida, camino = None, "copia"
+        if rectangulos and formato == "jpeg" and _pixelado_dct is not None:
+            salida = _pixelado_dct.pixelar_jpeg(datos, rectangulos)
+            if salida is not None and not dct_correcto(salida, imagen, rectangulos):
+                salida = None
+            camino = "dct"
+        if rectangulos and salida is None:
+            ok, buffer = cv2.imencode(extension, pixelar_rectangulos(imagen, rectangulos))
+            if not ok:
+                raise ValueError(f"No se pudo codificar la imagen como {extension}")
+            salida, camino = buffer.tobytes(), "pixeles"
+        return {
+            "estado": HECHO, "caras": len(detecciones), "menores": len(rectangulos), "camino": camino,
+            "datos": salida, "error": None, "segundos": time.perf_counter() - inicio,
+        }
+    except Exception as e:
+        return {
+            "estado": ERROR, "caras": None, "menores": None, "camino": None,
+            "datos": None, "error": f"{type(e).__name__}: {e}", "segundos": time.perf_counter() - inicio,
+        }
+
+
+# --- Proceso principal ---------------------------------------------------------
+
+class Progreso:
+    """
+    Contadores de la ejecución, actualizados por el hilo escritor.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.hechas = 0
+        self.errores = 0
+        self.caras = 0
+        self.menores = 0
+        self.caminos = {}
+        self.segundos_proceso = 0.0
+        self.inicio = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def anotar(self, resultado):
+        with self._lock:
+            if resultado["estado"] == HECHO:
+                self.hechas += 1
+                self.caras += resultado["caras"]
+                self.menores += resultado["menores"]
+                self.caminos[resultado["camino"]] = self.caminos.get(resultado["camino"], 0) + 1
+            else:
+                self.errores += 1
+            self.segundos_proceso += resultado["segundos"] or 0.0
+
+    def resumen(self):
+        with self._lock:
+            transcurrido = time.perf_counter() - self.inicio
+            terminadas = self.hechas + self.errores
+            return {
+                "total": self.total,
+                "hechas": self.hechas,
+                "errores": self.errores,
+                "caras": self.caras,
+                "menores": self.menores,
+                "caminos": dict(self.caminos),
+                "segundos": round(transcurrido, 2),
+                "imagenes_por_segundo": round(terminadas / transcurrido, 2) if transcurrido > 0 else None,
+                "segundos_por_imagen_y_proceso": round(self.segundos_proceso / terminadas, 4) if terminadas else None,
+            }
+
+
+def hilo_lector(manifiesto, origen, cola_lectura, parar):
+    # Lee por adelantado los archivos pendientes; None marca el final
+    try:
+        for id_archivo, ruta in manifiesto.pendientes(parar):
+            try:
+                with open(os.path.join(origen, ruta), "rb") as f:
+                    elemento = (id_archivo, ruta, f.read(), None)
+            except OSError as e:
+                elemento = (id_archivo, ruta, None, f"No se pudo leer: {e}")
+            while not parar.is_set():
+                try:
+                    cola_lectura.put(elemento, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+            if parar.is_set():
+                return
+    finally:
+        cola_lectura.put(None)
+
+
+def escribir_atomico(ruta, datos):
+    os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+    temporal = f"{ruta}.tmp{os.getpid()}"
+    with open(temporal, "wb") as f:
+        f.write(datos)
+    os.replace(temporal, ruta)
+
+
+def hilo_escritor(manifiesto, destino, cola_escritura, progreso):
+    # Escribe los resultados y los anota en el manifiesto; None marca el final
+    conexion = manifiesto.conectar()
+    sin_confirmar = 0
+    ultimo_commit = time.monotonic()
+    try:
+        while True:
+            elemento = cola_escritura.get()
+            if elemento is None:
+                break
+            id_archivo, ruta, original, resultado = elemento
+            if resultado["estado"] == HECHO:
+                try:
+                    escribir_atomico(os.path.join(destino, ruta), resultado["datos"] or original)
+                except OSError as e:
+                    resultado = dict(resultado, estado=ERROR, error=f"No se pudo escribir: {e}")
+            conexion.execute(
+                "UPDATE archivos SET estado = ?, caras = ?, menores = ?, camino = ?, error = ?, segundos = ?, "
+                "actualizado = ? WHERE id = ?",
+                (resultado["estado"], resultado["caras"], resultado["menores"], resultado["camino"],
+                 resultado["error"], resultado["segundos"], time.time(), id_archivo),
+            )
+            progreso.anotar(resultado)
+            sin_confirmar += 1
+            if sin_confirmar >= FILAS_POR_TRANSACCION or time.monotonic() - ultimo_commit >= SEGUNDOS_ENTRE_COMMITS:
+                conexion.commit()
+                sin_confirmar, ultimo_commit = 0, time.monotonic()
+    finally:
+        conexion.commit()
+        conexion.close()
+
+
+def imprimir_progreso(progreso, anterior):
+    resumen = progreso.resumen()
+    terminadas = resumen["hechas"] + resumen["errores"]
+    ahora = time.perf_counter()
+    recientes = (terminadas - anterior[0]) / max(ahora - anterior[1], 1e-9)
+    restantes = progreso.total - terminadas
+    eta = f"{restantes / recientes / 60:.1f} min" if recientes > 0 else "-"
+    print(f"{terminadas}/{progreso.total} ({resumen['errores']} errores) | {recientes:.1f} img/s "
+          f"(media {resumen['imagenes_por_segundo'] or 0:.1f}) | menores {resumen['menores']} | quedan {eta}",
+          flush=True)
+    return terminadas, ahora
+
+
+def procesar(args, manifiesto, total):
+    """
+    Procesa los archivos pendientes del manifiesto con el pool de procesos.
+
+    :return: Tupla (Progreso, True si se ha terminado o False si se ha interrumpido)
+    """
+    progreso = Progreso(total)
+    parar = threading.Event()
+    cola_lectura = queue.Queue(maxsize=args.prefetch)
+    cola_escritura = queue.Queue(maxsize=args.cola_escritura)
+    lector = threading.Thread(target=hilo_lector, args=(manifiesto, args.origen, cola_lectura, parar), daemon=True)
+    escritor = threading.Thread(target=hilo_escritor, args=(manifiesto, args.destino, cola_escritura, progreso))
+
+    contexto = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(
+        max_workers=args.procesos, mp_context=contexto, initializer=iniciar_proceso,
+        initargs=(args.hilos, int(args.max_megapixeles * 1_000_000), args.jpeg == "dct"),
+    )
+    # Imágenes enviadas al pool y aún sin resultado: suficientes para que ningún proceso espere
+    ventana = args.procesos * 2
+    en_vuelo = {}
+    terminado = False
+    lector.start()
+    escritor.start()
+    anterior = (0, time.perf_counter())
+    siguiente_informe = time.monotonic() + args.intervalo
+    try:
+        agotado = False
+        while True:
+            while not agotado and len(en_vuelo) < ventana:
+                try:
+                    # Sin nada en vuelo se espera al lector; si no, solo se toma lo ya leído
+                    elemento = cola_lectura.get_nowait() if en_vuelo else cola_lectura.get()
+                except queue.Empty:
+                    break
+                if elemento is None:
+                    agotado = True
+                    break
+                id_archivo, ruta, datos, error = elemento
+                if error is not None:
+                    cola_escritura.put((id_archivo, ruta, None, {
+                        "estado": ERROR, "caras": None, "menores": None, "camino": None,
+                        "datos": None, "error": error, "segundos": 0.0,
+                    }))
+                    continue
+                extension = os.path.splitext(ruta)[1].lower()
+                en_vuelo[pool.submit(procesar_imagen, datos, extension)] = (id_archivo, ruta, datos)
+
+            if not en_vuelo:
+                if agotado:
+                    terminado = True
+                    break
+                continue
+            hechos, _ = wait(list(en_vuelo), timeout=1.0, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                id_archivo, ruta, datos = en_vuelo.pop(futuro)
+                cola_escritura.put((id_archivo, ruta, datos, futuro.result()))
+
+            if time.monotonic() >= siguiente_informe:
+                anterior = imprimir_progreso(progreso, anterior)
+                siguiente_informe = time.monotonic() + args.intervalo
+    except KeyboardInterrupt:
+        print("\nInterrumpido: los archivos pendientes se procesarán al repetir la orden", file=sys.stderr)
+    except BrokenProcessPool as e:
+        print(f"\nUn proceso del pool ha terminado de forma inesperada ({e}); "
+              "los archivos pendientes se procesarán al repetir la orden", file=sys.stderr)
+    finally:
+        parar.set()
+        # Lo que quedaba en vuelo sigue pendiente en el manifiesto
+        pool.shutdown(wait=False, cancel_futures=True)
+        cola_escritura.put(None)
+        escritor.join()
+    return progreso, terminado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("origen", help="Directorio con las imágenes originales")
+    parser.add_argument("destino", help="Directorio en el que se escriben las imágenes procesadas")
+    parser.add_argument("--lista", help="Archivo con las rutas a procesar, una por línea (relativas a origen)")
+    parser.add_argument("--manifiesto", help="Base de datos sqlite del progreso (por defecto, destino/manifiesto.sqlite)")
+    parser.add_argument("--reintentar-errores", action="store_true", help="Vuelve a procesar los archivos con error")
+    parser.add_argument("--procesos", type=int, default=max((os.cpu_count() or 2) // 2, 1))
+    parser.add_argument("--hilos", type=int, default=None, help="Hilos de cálculo por proceso (por defecto, CPUs / procesos)")
+    parser.add_argument("--prefetch", type=int, default=32, help="Imágenes leídas por adelantado")
+    parser.add_argument("--cola-escritura", type=int, default=32, help="Resultados pendientes de escribir como máximo")
+    parser.add_argument("--jpeg", choices=("dct", "pixeles"), default="dct",
+                        help="Pixelado de los JPEG: sobre los coeficientes DCT (si hay libturbojpeg) o recodificando")
+    parser.add_argument("--max-megapixeles", type=float, default=100.0)
+    parser.add_argument("--intervalo", type=float, default=10.0, help="Segundos entre líneas de progreso")
+    parser.add_argument("--informe", help="Archivo JSON en el que guardar el resumen")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.origen):
+        parser.error(f"No existe el directorio {args.origen}")
+    if os.path.realpath(args.origen) == os.path.realpath(args.destino):
+        parser.error("El destino no puede ser el mismo directorio que el origen")
+    args.procesos = max(args.procesos, 1)
+    args.hilos = args.hilos or max((os.cpu_count() or 1) // args.procesos, 1)
+    os.makedirs(args.destino, exist_ok=True)
+    manifiesto = Manifiesto(args.manifiesto or os.path.join(args.destino, "manifiesto.sqlite"))
+
+    # Un manifiesto solo sirve para el origen y el destino con los que se creó
+    conexion = manifiesto.conectar()
+    try:
+        for clave, valor in (("origen", args.origen), ("destino", args.destino)):
+            guardado = manifiesto.meta(conexion, clave)
+            if guardado is not None and os.path.realpath(guardado) != os.path.realpath(valor):
+                parser.error(f"El manifiesto es de otra ejecución ({clave} {guardado})")
+            manifiesto.fijar_meta(conexion, clave, valor)
+        conexion.commit()
+        inventariado = manifiesto.meta(conexion, "inventario") == "completo"
+    finally:
+        conexion.close()
+
+    # El inventario se hace una vez; al reanudar solo se añaden las rutas de una lista nueva
+    if args.lista:
+        nuevas = manifiesto.inventariar(leer_lista(args.lista, args.origen))
+        print(f"Lista: {nuevas} archivos nuevos en el manifiesto")
+    elif not inventariado:
+        inicio = time.perf_counter()
+        nuevas = manifiesto.inventariar(recorrer(args.origen, excluir=args.destino), completo=True)
+        print(f"Inventario: {nuevas} imágenes en {time.perf_counter() - inicio:.1f} s")
+    if args.reintentar_errores:
+        print(f"Se reintentan {manifiesto.reintentar_errores()} archivos con error")
+
+    recuento = manifiesto.recuento()
+    total = recuento.get(PENDIENTE, 0)
+    print(f"Pendientes: {total} (hechos {recuento.get(HECHO, 0)}, con error {recuento.get(ERROR, 0)}) | "
+          f"{args.procesos} procesos x {args.hilos} hilos", flush=True)
+    if total == 0:
+        return
+
+    progreso, terminado = procesar(args, manifiesto, total)
+    resumen = progreso.resumen()
+    resumen.update({"procesos": args.procesos, "hilos": args.hilos, "terminado": terminado})
+    print(f"\n{resumen['hechas']} imágenes procesadas y {resumen['errores']} con error en {resumen['segundos']:.1f} s "
+          f"({resumen['imagenes_por_segundo'] or 0:.2f} img/s); {resumen['caras']} caras, {resumen['menores']} menores")
+    print(f"Caminos: {resumen['caminos']}")
+    if args.informe:
+        with open(args.informe, "w", encoding="utf-8") as f:
+            json.dump(resumen, f, indent=2, ensure_ascii=False)
+        print(f"Resumen guardado en {args.informe}")
+    if not terminado:
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Trabajador del motor que consume la cola de trabajos persistente.
+
+Un hilo de sondeo reclama trabajos de la cola solo cuando hay un hueco libre
+y los entrega a un pool de `hilos` hilos, de modo que cada proceso del motor
+tiene como mucho `hilos` trabajos en curso. El carril de prioridad baja
+(lotes) puede limitarse a `max_baja` huecos para que siempre queden huecos
+para las peticiones interactivas.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentacion
+from cola_trabajos import PRIORIDADES
+
+
+class TrabajadorCola:
+    """
+    Consume trabajos de una ColaTrabajos con concurrencia acotada.
+    """
+
+    def __init__(self, cola, procesar, hilos=4, max_baja=None, sondeo=0.02, intervalo_mantenimiento=30.0):
+        """
+        :param cola: ColaTrabajos de la que se reclaman los trabajos
+        :param procesar: Función (nombre, tipo, datos, debug) -> (código HTTP, tipo MIME, bytes)
+        :param hilos: Trabajos simultáneos como máximo en este proceso
+        :param max_baja: Huecos como máximo para el carril de prioridad baja (None para no limitar)
+        :param sondeo: Segundos de espera cuando la cola está vacía
+        :param intervalo_mantenimiento: Segundos entre pasadas de mantenimiento de la cola
+        """
+        self.cola = cola
+        self.procesar = procesar
+        self.hilos = max(int(hilos), 1)
+        self.max_baja = self.hilos if max_baja is None else min(max(int(max_baja), 0), self.hilos)
+        self.sondeo = float(sondeo)
+        self.intervalo_mantenimiento = float(intervalo_mantenimiento)
+        self.identificador = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._huecos = threading.Semaphore(self.hilos)
+        self._lock = threading.Lock()
+        self._en_curso_baja = 0
+        self._completados = 0
+        self._errores = 0
+        self._hilo = None
+        self._parar = threading.Event()
+
+    def iniciar(self):
+        """
+        Arranca el hilo de sondeo (una sola vez).
+        """
+        with self._lock:
+            if self._hilo is not None:
+                return
+            self._hilo = threading.Thread(target=self._bucle, name="trabajador-cola", daemon=True)
+            self._hilo.start()
+
+    def detener(self, timeout=None):
+        """
+        Deja de reclamar trabajos y espera a que terminen los que están en curso.
+
+        :param timeout: Segundos máximos de espera (None para esperar sin límite)
+        """
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout)
+
+    def _bucle(self):
+        ejecutor = ThreadPoolExecutor(max_workers=self.hilos)
+        try:
+            self._sondear(ejecutor)
+        finally:
+            ejecutor.shutdown(wait=True)
+
+    def _sondear(self, ejecutor):
+        ultimo_mantenimiento = 0.0
+        while not self._parar.is_set():
+            if time.monotonic() - ultimo_mantenimiento > self.intervalo_mantenimiento:
+                ultimo_mantenimiento = time.monotonic()
+                try:
+                    self.cola.mantenimiento()
+                except Exception:
+                    pass
+
+            if not self._huecos.acquire(timeout=0.5):
+                continue
+            with self._lock:
+                baja_disponible = self._en_curso_baja < self.max_baja
+            max_prioridad = None if baja_disponible else PRIORIDADES["baja"] - 1
+            try:
+                trabajo = self.cola.reclamar(self.identificador, max_prioridad)
+            except Exception:
+                trabajo = None
+            if trabajo is None:
+                self._huecos.release()
+                self._parar.wait(self.sondeo)
+                continue
+
+            if trabajo["prioridad"] >= PRIORIDADES["baja"]:
+                with self._lock:
+                    self._en_curso_baja += 1
+            ejecutor.submit(self._ejecutar, trabajo)
+
+    def _ejecutar(self, trabajo):
+        # El trabajo continúa la traza de la petición que lo encoló (o la del propio trabajo)
+        with instrumentacion.nueva_traza(trabajo.get("traza") or trabajo["id"]) as traza:
+            try:
+                codigo, tipo, contenido = self.procesar(
+                    trabajo["nombre"], trabajo["tipo"], trabajo["datos"], trabajo["debug"]
+                )
+            except Exception as e:
+                codigo, tipo = 500, "application/json"
+                contenido = json.dumps({"error": "Error inesperado", "detalle": str(e)}).encode("utf-8")
+            duracion = instrumentacion.finalizar(traza, "cola", "cola", codigo)
+        # Las etapas del motor viajan con el resultado para que el gateway las devuelva en Server-Timing
+        tramos = traza.copia_tramos()
+        tramos["engine_total"] = duracion
+        try:
+            self.cola.completar(trabajo["id"], codigo, tipo, contenido, instrumentacion.server_timing(tramos))
+        finally:
+            with self._lock:
+                if trabajo["prioridad"] >= PRIORIDADES["baja"]:
+                    self._en_curso_baja -= 1
+                self._completados += 1
+                if codigo >= 500:
+                    self._errores += 1
+            self._huecos.release()
+
+    def metricas(self):
+        with self._lock:
+            return {
+                "trabajador": self.identificador,
+                "hilos": self.hilos,
+                "max_baja": self.max_baja,
+                "en_curso_baja": self._en_curso_baja,
+                "completados": self._completados,
+                "errores": self._errores,
+            }
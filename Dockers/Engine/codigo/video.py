@@ -0,0 +1,352 @@
+"""
+Anonimización de vídeo fotograma a fotograma.
+
+Ejecutar RetinaFace y el clasificador en cada fotograma es demasiado lento,
+así que la detección solo se hace en los fotogramas clave: cada `intervalo`
+fotogramas o cuando hay un cambio de escena. Entre fotogramas clave las cajas
+se siguen con flujo óptico (Lucas-Kanade sobre puntos de cada cara), que
+cuesta una fracción de una detección.
+
+Cada cara seguida es una pista. La decisión menor/adulto se guarda en la
+pista y solo se clasifican las caras nuevas: en un fotograma clave las
+detecciones se asocian por IoU con las pistas existentes y heredan su
+decisión. En un cambio de escena se descartan todas las pistas. Una pista
+cuya clasificación ha fallado se pixela como si fuera de un menor y se vuelve
+a clasificar en el siguiente fotograma clave.
+
+Las caras de menores se pixelan con el mismo núcleo que el servicio Pixelado
+(`pixelado.pixelar_rectangulos`) y cada fotograma se escribe en el vídeo de
+salida en cuanto se procesa, sin acumular fotogramas en memoria.
+
+Uso como línea de comandos (con la configuración del Engine):
+
+    python video.py entrada.mp4 salida.mp4 --intervalo 10
+"""
+import time
+
+import cv2
+import numpy as np
+
+from pixelado import BLOQUES, pixelar_rectangulos
+
+# Lado de la miniatura en escala de grises usada para detectar cambios de escena
+LADO_MINIATURA = 64
+
+
+class Pista:
+    """
+    Cara seguida entre fotogramas con su decisión menor/adulto.
+    """
+
+    def __init__(self, identificador, caja):
+        self.id = identificador
+        self.caja = [float(v) for v in caja]
+        self.es_menor = None  # Sin clasificar (o la clasificación falló): se pixela por si acaso
+        self.probabilidad = None
+
+
+def iou(a, b):
+    """
+    :param a: Caja (x1, y1, x2, y2)
+    :param b: Caja (x1, y1, x2, y2)
+    :return: Intersección sobre unión de las dos cajas
+    """
+    ix = max(min(a[2], b[2]) - max(a[0], b[0]), 0)
+    iy = max(min(a[3], b[3]) - max(a[1], b[1]), 0)
+    interseccion = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - interseccion
+    return interseccion / union if union > 0 else 0.0
+
+
+def asociar(pistas, cajas, umbral_iou=0.3):
+    """
+    Asocia las cajas detectadas con las pistas existentes de forma voraz por IoU.
+
+    :param pistas: Lista de Pista
+    :param cajas: Lista de cajas detectadas (x1, y1, x2, y2)
+    :param umbral_iou: IoU mínima para considerar que son la misma cara
+    :return: Tupla (lista de pares (pista, índice de caja), índices de cajas sin pista)
+    """
+    candidatos = sorted(
+        ((iou(p.caja, c), i, j) for i, p in enumerate(pistas) for j, c in enumerate(cajas)),
+        reverse=True
+    )
+    pistas_usadas, cajas_usadas, pares = set(), set(), []
+    for valor, i, j in candidatos:
+        if valor < umbral_iou:
+            break
+        if i in pistas_usadas or j in cajas_usadas:
+            continue
+        pistas_usadas.add(i)
+        cajas_usadas.add(j)
+        pares.append((pistas[i], j))
+    return pares, [j for j in range(len(cajas)) if j not in cajas_usadas]
+
+
+def seguir(gris_anterior, gris, pistas, max_puntos=30):
+    """
+    Desplaza y escala las cajas de las pistas según el flujo óptico entre dos
+    fotogramas (mediana del movimiento de los puntos de cada caja). Todas las
+    pistas se siguen con una sola llamada a Lucas-Kanade.
+
+    :param gris_anterior: Fotograma anterior en escala de grises
+    :param gris: Fotograma actual en escala de grises
+    :param pistas: Lista de Pista (se actualizan en el sitio)
+    :param max_puntos: Puntos por caja como máximo
+    """
+    alto, ancho = gris.shape[:2]
+    puntos, duenos = [], []
+    for k, pista in enumerate(pistas):
+        x1, y1, x2, y2 = pista.caja
+        x1, y1 = max(int(x1), 0), max(int(y1), 0)
+        x2, y2 = min(int(np.ceil(x2)), ancho), min(int(np.ceil(y2)), alto)
+        if x2 - x1 < 4 or y2 - y1 < 4:
+            continue
+        esquinas = cv2.goodFeaturesToTrack(
+            gris_anterior[y1:y2, x1:x2], maxCorners=max_puntos, qualityLevel=0.01, minDistance=3
+        )
+        if esquinas is None:
+            continue
+        esquinas = esquinas.reshape(-1, 2) + np.array([x1, y1], dtype=np.float32)
+        puntos.append(esquinas)
+        duenos.extend([k] * len(esquinas))
+    if not puntos:
+        return
+
+    origen = np.concatenate(puntos).astype(np.float32).reshape(-1, 1, 2)
+    destino, estado, _ = cv2.calcOpticalFlowPyrLK(
+        gris_anterior, gris, origen, None, winSize=(15, 15), maxLevel=2
+    )
+    origen = origen.reshape(-1, 2)
+    destino = destino.reshape(-1, 2)
+    validos = estado.reshape(-1) == 1
+    duenos = np.array(duenos)
+
+    for k, pista in enumerate(pistas):
+        seleccion = validos & (duenos == k)
+        if seleccion.sum() < 3:
+            # Sin puntos suficientes la caja se queda donde estaba hasta el siguiente fotograma clave
+            continue
+        p, q = origen[seleccion], destino[seleccion]
+        dx, dy = np.median(q - p, axis=0)
+        # Cambio de escala: mediana del cociente de distancias al centroide
+        dp = np.linalg.norm(p - p.mean(axis=0), axis=1)
+        dq = np.linalg.norm(q - q.mean(axis=0), axis=1)
+        utiles = dp > 1.0
+        escala = float(np.median(dq[utiles] / dp[utiles])) if utiles.sum() >= 3 else 1.0
+        escala = min(max(escala, 0.8), 1.25)
+
+        x1, y1, x2, y2 = pista.caja
+        cx, cy = (x1 + x2) / 2.0 + dx, (y1 + y2) / 2.0 + dy
+        mitad_w, mitad_h = (x2 - x1) * escala / 2.0, (y2 - y1) * escala / 2.0
+        pista.caja = [cx - mitad_w, cy - mitad_h, cx + mitad_w, cy + mitad_h]
+
+
+def miniatura(gris):
+    return cv2.resize(gris, (LADO_MINIATURA, LADO_MINIATURA), interpolation=cv2.INTER_AREA)
+
+
+class AnonimizadorVideo:
+    """
+    Procesa los fotogramas de un vídeo en orden: detección en los fotogramas
+    clave, seguimiento entre ellos y pixelado de las pistas de menores.
+    """
+
+    def __init__(self, detectar, clasificar, intervalo=10, umbral_escena=30.0, margen=0.1,
+                 umbral_iou=0.3, bloques=BLOQUES):
+        """
+        :param detectar: Función fotograma BGR -> lista de detecciones con "bbox"
+        :param clasificar: Función (fotograma BGR, detecciones) -> lista con el "detalle"
+            del clasificador ({"probabilidad", "es_menor"} o con "error") por detección
+        :param intervalo: Fotogramas entre detecciones (1 para detectar en todos)
+        :param umbral_escena: Diferencia media de las miniaturas (0-255) que se considera un cambio de escena
+        :param margen: Fracción del lado que se añade a cada caja al pixelar, para cubrir el error del seguimiento
+        :param umbral_iou: IoU mínima para asociar una detección a una pista
+        :param bloques: Número de bloques por lado del pixelado
+        """
+        self.detectar = detectar
+        self.clasificar = clasificar
+        self.intervalo = max(int(intervalo), 1)
+        self.umbral_escena = float(umbral_escena)
+        self.margen = float(margen)
+        self.umbral_iou = float(umbral_iou)
+        self.bloques = bloques
+
+        self.pistas = []
+        self._siguiente_id = 1
+        self._gris_anterior = None
+        self._miniatura_anterior = None
+        self._desde_clave = 0
+
+        self.fotogramas = 0
+        self.fotogramas_clave = 0
+        self.cambios_escena = 0
+        self.caras_clasificadas = 0
+        self.tiempos = {"deteccion": 0.0, "clasificacion": 0.0, "seguimiento": 0.0, "pixelado": 0.0}
+
+    def procesar(self, fotograma):
+        """
+        Anonimiza un fotograma. Debe llamarse con los fotogramas en orden.
+
+        :param fotograma: Fotograma BGR (se modifica en el sitio)
+        :return: El mismo fotograma con las caras de menores pixeladas
+        """
+        gris = cv2.cvtColor(fotograma, cv2.COLOR_BGR2GRAY)
+        mini = miniatura(gris)
+
+        cambio_escena = (
+            self._miniatura_anterior is not None
+            and float(np.mean(cv2.absdiff(mini, self._miniatura_anterior))) > self.umbral_escena
+        )
+        if cambio_escena:
+            self.cambios_escena += 1
+            self.pistas = []
+
+        if self._gris_anterior is None or cambio_escena or self._desde_clave >= self.intervalo:
+            self._fotograma_clave(fotograma)
+        else:
+            inicio = time.perf_counter()
+            seguir(self._gris_anterior, gris, self.pistas)
+            self.tiempos["seguimiento"] += time.perf_counter() - inicio
+            self._desde_clave += 1
+
+        inicio = time.perf_counter()
+        # Solo se dejan sin pixelar las caras clasificadas como adultas
+        rectangulos = [self._rectangulo(p) for p in self.pistas if p.es_menor is not False]
+        if rectangulos:
+            pixelar_rectangulos(fotograma, rectangulos, self.bloques)
+        self.tiempos["pixelado"] += time.perf_counter() - inicio
+
+        self._gris_anterior = gris
+        self._miniatura_anterior = mini
+        self.fotogramas += 1
+        return fotograma
+
+    def _fotograma_clave(self, fotograma):
+        self.fotogramas_clave += 1
+        self._desde_clave = 1
+
+        inicio = time.perf_counter()
+        detecciones = self.detectar(fotograma)
+        self.tiempos["deteccion"] += time.perf_counter() - inicio
+
+        cajas = [d["bbox"] for d in detecciones]
+        pares, nuevas = asociar(self.pistas, cajas, self.umbral_iou)
+        pistas = []
+        for pista, j in pares:
+            pista.caja = [float(v) for v in cajas[j]]
+            pistas.append(pista)
+        for j in nuevas:
+            pistas.append(Pista(self._siguiente_id, cajas[j]))
+            self._siguiente_id += 1
+        # Las pistas sin detección en este fotograma clave se descartan
+        self.pistas = pistas
+
+        # Solo se clasifican las pistas que aún no tienen decisión
+        pendientes = [(p, {"bbox": [int(v) for v in p.caja]}) for p in pistas if p.es_menor is None]
+        if not pendientes:
+            return
+        inicio = time.perf_counter()
+        detalle = self.clasificar(fotograma, [d for _, d in pendientes])
+        self.tiempos["clasificacion"] += time.perf_counter() - inicio
+        self.caras_clasificadas += len(pendientes)
+        for (pista, _), resultado in zip(pendientes, detalle):
+            if "error" in resultado:
+                continue
+            pista.es_menor = bool(resultado["es_menor"])
+            pista.probabilidad = float(resultado["probabilidad"])
+
+    def _rectangulo(self, pista):
+        x1, y1, x2, y2 = pista.caja
+        mx, my = (x2 - x1) * self.margen / 2.0, (y2 - y1) * self.margen / 2.0
+        return [x1 - mx, y1 - my, (x2 - x1) + 2 * mx, (y2 - y1) + 2 * my]
+
+    def estadisticas(self, segundos):
+        """
+        :param segundos: Tiempo total de procesamiento (incluida la decodificación y la codificación)
+        :return: Diccionario con los contadores, los tiempos por etapa y los fotogramas por segundo
+        """
+        return {
+            "fotogramas": self.fotogramas,
+            "fotogramas_clave": self.fotogramas_clave,
+            "cambios_escena": self.cambios_escena,
+            "caras_clasificadas": self.caras_clasificadas,
+            "pistas": self._siguiente_id - 1,
+            "segundos": round(segundos, 3),
+            "fps": round(self.fotogramas / segundos, 2) if segundos > 0 else 0.0,
+            "tiempos": {k: round(v, 3) for k, v in self.tiempos.items()},
+        }
+
+
+def procesar_video(ruta_entrada, ruta_salida, anonimizador, fourcc="mp4v"):
+    """
+    Lee un vídeo, anonimiza cada fotograma y lo escribe en el vídeo de salida
+    con la misma resolución y cadencia.
+
+    :param ruta_entrada: Ruta del vídeo de entrada
+    :param ruta_salida: Ruta del vídeo de salida
+    :param anonimizador: AnonimizadorVideo
+    :param fourcc: Códec de salida (código FOURCC de OpenCV)
+    :return: Estadísticas del procesamiento (ver AnonimizadorVideo.estadisticas)
+    :raises ValueError: Si el vídeo no se puede abrir
+    """
+    captura = cv2.VideoCapture(ruta_entrada)
+    if not captura.isOpened():
+        raise ValueError("No se puede abrir el vídeo")
+
+    escritor = None
+    inicio = time.perf_counter()
+    try:
+        fps_video = captura.get(cv2.CAP_PROP_FPS) or 25.0
+        while True:
+            leido, fotograma = captura.read()
+            if not leido:
+                break
+            if escritor is None:
+                alto, ancho = fotograma.shape[:2]
+                escritor = cv2.VideoWriter(ruta_salida, cv2.VideoWriter_fourcc(*fourcc), fps_video, (ancho, alto))
+                if not escritor.isOpened():
+                    raise ValueError(f"No se puede crear el vídeo de salida con el códec {fourcc}")
+            escritor.write(anonimizador.procesar(fotograma))
+    finally:
+        captura.release()
+        if escritor is not None:
+            escritor.release()
+
+    if anonimizador.fotogramas == 0:
+        raise ValueError("El vídeo no contiene fotogramas legibles")
+
+    estadisticas = anonimizador.estadisticas(time.perf_counter() - inicio)
+    estadisticas["fps_video"] = round(float(fps_video), 2)
+    return estadisticas
+
+
+def main():
+    import argparse
+    import json
+    import os
+
+    parser = argparse.ArgumentParser(description="Pixela las caras de menores de un vídeo")
+    parser.add_argument("entrada", help="Vídeo de entrada")
+    parser.add_argument("salida", help="Vídeo de salida")
+    parser.add_argument("--intervalo", type=int, default=10, help="Fotogramas entre detecciones")
+    parser.add_argument("--umbral-escena", type=float, default=30.0, help="Umbral de cambio de escena (0-255)")
+    parser.add_argument("--margen", type=float, default=0.1, help="Margen añadido a cada caja al pixelar")
+    parser.add_argument("--fourcc", default="mp4v", help="Códec del vídeo de salida")
+    args = parser.parse_args()
+
+    # Se reutilizan las etapas del Engine (microservicios o monolito según MODO_PIPELINE)
+    # sin arrancar los trabajadores de la cola
+    os.environ.setdefault("TRABAJOS_ACTIVADOS", "false")
+    import engine_api
+
+    anonimizador = AnonimizadorVideo(
+        engine_api.detectar_fotograma, engine_api.clasificar_fotograma,
+        intervalo=args.intervalo, umbral_escena=args.umbral_escena, margen=args.margen
+    )
+    estadisticas = procesar_video(args.entrada, args.salida, anonimizador, args.fourcc)
+    print(json.dumps(estadisticas, indent=2))
+
+
+if __name__ == "__main__":
+    main()
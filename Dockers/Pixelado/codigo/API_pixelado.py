@@ -1,14 +1,32 @@
 from flask import Flask, jsonify, request
-import numpy as np
 import cv2
 import json
+import os
+import formato_parches
+import instrumentacion
+import pixelado_dct
+import servicio
+import validacion
+from pixelado import pixelar_rectangulos, BLOQUES
 
 # Create the Flask application
 app = Flask(__name__)
+servicio.registrar_listo(app)
+instrumentacion.registrar(app, "pixelado")
 
 # Allowed image file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+# Límites de la imagen: tamaño de archivo y píxeles (comprobados antes de decodificar)
+MAX_BYTES_IMAGEN = int(float(os.environ.get("MAX_MB_ARCHIVO", "16")) * 1024 * 1024)
+MAX_PIXELES_IMAGEN = int(float(os.environ.get("MAX_MEGAPIXELES", "100")) * 1_000_000)
+# Parches por petición en /pixelar_parches
+MAX_PARCHES = int(os.environ.get("MAX_PARCHES", "1000"))
+# Pixelado de los JPEG en /pixelar: "dct" (sobre los coeficientes, ver pixelado_dct.py) o "pixeles"
+PIXELADO_JPEG = os.environ.get("PIXELADO_JPEG", "dct").lower()
+# Lo que cambia la imagen pixelada forma parte de la versión del servicio (caché del Engine)
+servicio.fijar_version("pixelado", {"bloques": BLOQUES, "jpeg": PIXELADO_JPEG})
+
 def allowed_file(filename):
     """
     Comprueba que el archivo subido sea compatible para la detección de caras (que sea imagen).
@@ -19,33 +37,16 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def validate_image(file):
+def leer_imagen(datos):
     """
-    Valida la imagen antes de la detección de caras.
+    Valida la imagen subida a partir de su cabecera (tamaño, bytes mágicos
+    y número de píxeles) y la decodifica una sola vez.
     
-    :param file: Archivo de imagen a validar
+    :param datos: Bytes de la imagen
+    :return: Imagen BGR decodificada
     :raises ValueError: Si la imagen no es válida
     """
-    # Verificar tamaño máximo (por ejemplo, 10MB)
-    file.seek(0, 2)  # Mover al final del archivo
-    file_size = file.tell()
-    file.seek(0)  # Reiniciar puntero de archivo
-    
-    if file_size > 10 * 1024 * 1024:  # 10MB
-        raise ValueError("El tamaño del archivo excede el límite de 10MB")
-    
-    # Intentar abrir la imagen para validarla
-    try:
-        # Use OpenCV to read and validate the image
-        img_bytes = file.read()
-        file.seek(0)  # Reset file pointer
-        img_np = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
-        
-        if img_np is None or img_np.size == 0:
-            raise ValueError("No se puede leer la imagen")
-        
-    except Exception as e:
-        raise ValueError(f"Archivo de imagen no válido: {str(e)}")
+    return validacion.decodificar(datos, max_bytes=MAX_BYTES_IMAGEN, max_pixeles=MAX_PIXELES_IMAGEN)
 
 @app.route("/pixelar", methods=["POST"])
 def detectar_caras():
@@ -71,12 +72,12 @@ def detectar_caras():
                 "error": "Tipo de archivo no permitido. Use PNG, JPG, JPEG, GIF, BMP o WEBP."
             }), 400
 
-        # Leer la imagen en formato numpy array
-        file_bytes = np.frombuffer(file.read(), np.uint8)
-        image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-
-        if image is None:
-            return jsonify({"error": "No se pudo leer la imagen"}), 400
+        # Validar la cabecera antes de leer los rectángulos (la imagen se decodifica después si hace falta)
+        datos = file.read()
+        try:
+            formato, _, _ = validacion.validar(datos, max_bytes=MAX_BYTES_IMAGEN, max_pixeles=MAX_PIXELES_IMAGEN)
+        except ValueError as e:
+            return jsonify({"error": "No se pudo leer la imagen", "detalle": str(e)}), 400
 
         if "rectangulos" not in request.form:
             return jsonify({"error": "Debe proporcionar los rectángulos en el campo 'rectangulos'"}), 400
@@ -94,36 +95,62 @@ def detectar_caras():
         for sub_array in data:
             if not isinstance(sub_array, list) or not all(isinstance(i, (int, float)) for i in sub_array):
                 return jsonify({"error": "Cada elemento del array debe ser una lista de números"}), 400
-        
+            if len(sub_array) != 4:
+                return jsonify({"error": "Cada rectángulo debe tener el formato [x, y, w, h]"}), 400
 
-        # Número de bloques para pixelar
-        blocks = 6
+        # JPEG: pixelado sobre los coeficientes DCT, sin decodificar ni volver a codificar la imagen
+        if formato == "jpeg" and PIXELADO_JPEG == "dct":
+            with instrumentacion.medir("pixelado_dct"):
+                resultado = pixelado_dct.pixelar_jpeg(datos, data, BLOQUES)
+            if resultado is not None:
+                return resultado, 200, {'Content-Type': 'image/jpeg', 'X-Pixelado': 'dct'}
 
-        # Dimensiones de la imagen
-        h, w = image.shape[:2]
-        x_steps = w // blocks
-        y_steps = h // blocks
+        # Resto de formatos (o JPEG que no admite el camino DCT): leer la imagen en formato numpy array
+        try:
+            with instrumentacion.medir("decodificacion"):
+                image = leer_imagen(datos)
+        except ValueError as e:
+            return jsonify({"error": "No se pudo leer la imagen", "detalle": str(e)}), 400
 
-        # Aplicar pixelado en las regiones específicas
-        for (x, y, w, h) in data:
-            roi = image[y:y + h, x:x + w]
-            # Tamaño del bloque basado en el tamaño del ROI
-            x_steps = max(w // blocks, 1)
-            y_steps = max(h // blocks, 1)
+        # Aplicar pixelado en las regiones específicas (recortadas a los límites de la imagen)
+        with instrumentacion.medir("pixelado"):
+            pixelar_rectangulos(image, data, BLOQUES)
 
-            for y_roi in range(0, h, y_steps):
-                for x_roi in range(0, w, x_steps):
-                    # Asegurar que los límites no se excedan
-                    end_x = min(x_roi + x_steps, w)
-                    end_y = min(y_roi + y_steps, h)
+        # Convertir la imagen procesada a formato JPEG
+        with instrumentacion.medir("codificacion"):
+            _, buffer = cv2.imencode('.jpg', image)
+        return buffer.tobytes(), 200, {'Content-Type': 'image/jpeg', 'X-Pixelado': 'pixeles'}
 
-                    sub_roi = roi[y_roi:end_y, x_roi:end_x]
-                    color = sub_roi.mean(axis=(0, 1)).astype(int)
-                    roi[y_roi:end_y, x_roi:end_x] = color
+    except Exception as e:
+        return jsonify({
+            "error": "Error interno del servidor.",
+            "detalle": str(e)
+        }), 500
 
-        # Convertir la imagen procesada a formato JPEG
-        _, buffer = cv2.imencode('.jpg', image)
-        return buffer.tobytes(), 200, {'Content-Type': 'image/jpeg'}
+@app.route("/pixelar_parches", methods=["POST"])
+def pixelar_parches():
+    """
+    Endpoint para pixelar solo las regiones de la imagen que contienen caras.
+    El cuerpo sigue el formato de `formato_parches` (parches sin comprimir con
+    sus rectángulos) y la respuesta es el mismo cuerpo con los parches pixelados,
+    así que no hay que decodificar ni codificar ninguna imagen.
+
+    :return: Respuesta binaria con los parches pixelados
+    """
+    try:
+        # bytearray: los parches se pixelan en el sitio sobre el cuerpo recibido
+        cuerpo = bytearray(request.get_data(cache=False))
+        try:
+            with instrumentacion.medir("decodificacion"):
+                parches, rectangulos = formato_parches.desempaquetar(cuerpo, MAX_PARCHES, MAX_PIXELES_IMAGEN)
+        except ValueError as e:
+            return jsonify({"error": f"Parches no válidos: {str(e)}"}), 400
+
+        with instrumentacion.medir("pixelado"):
+            for parche, rects in zip(parches, rectangulos):
+                pixelar_rectangulos(parche, rects, BLOQUES)
+
+        return bytes(cuerpo), 200, {'Content-Type': formato_parches.TIPO_CONTENIDO}
 
     except Exception as e:
         return jsonify({
@@ -140,6 +167,7 @@ def inicio():
     """
     return jsonify({
         "message": "API de Detección Facial operativa",
+        "pixelado_jpeg": "dct" if PIXELADO_JPEG == "dct" and pixelado_dct.disponible() else "pixeles",
     }), 200
 
 
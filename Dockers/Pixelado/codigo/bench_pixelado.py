@@ -0,0 +1,80 @@
+"""
+Micro-benchmark del pixelado: bucle por bloques original frente a `pixelado.pixelar_rectangulos`.
+
+Uso:
+    python bench_pixelado.py [--ancho 3840] [--alto 2160] [--caras 20] [--lado 400] [--repeticiones 20]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from pixelado import pixelar_rectangulos
+
+
+def pixelar_bucle(image, data, blocks=6):
+    """
+    Implementación original del endpoint /pixelar (un bloque por iteración de Python).
+    """
+    for (x, y, w, h) in data:
+        roi = image[y:y + h, x:x + w]
+        x_steps = max(w // blocks, 1)
+        y_steps = max(h // blocks, 1)
+
+        for y_roi in range(0, h, y_steps):
+            for x_roi in range(0, w, x_steps):
+                end_x = min(x_roi + x_steps, w)
+                end_y = min(y_roi + y_steps, h)
+
+                sub_roi = roi[y_roi:end_y, x_roi:end_x]
+                color = sub_roi.mean(axis=(0, 1)).astype(int)
+                roi[y_roi:end_y, x_roi:end_x] = color
+    return image
+
+
+def medir(funcion, imagen, rectangulos, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        copia = imagen.copy()
+        inicio = time.perf_counter()
+        funcion(copia, rectangulos)
+        tiempos.append(time.perf_counter() - inicio)
+    return float(np.median(tiempos)) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ancho", type=int, default=3840)
+    parser.add_argument("--alto", type=int, default=2160)
+    parser.add_argument("--caras", type=int, default=20)
+    parser.add_argument("--lado", type=int, default=400)
+    parser.add_argument("--repeticiones", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    imagen = rng.integers(0, 256, size=(args.alto, args.ancho, 3), dtype=np.uint8)
+    rectangulos = []
+    for _ in range(args.caras):
+        w = int(rng.integers(args.lado // 2, args.lado + 1))
+        h = int(rng.integers(args.lado // 2, args.lado + 1))
+        x = int(rng.integers(0, args.ancho - w))
+        y = int(rng.integers(0, args.alto - h))
+        rectangulos.append([x, y, w, h])
+
+    # Comprobación de equivalencia con rectángulos dentro de la imagen
+    referencia = pixelar_bucle(imagen.copy(), rectangulos)
+    vectorizado = pixelar_rectangulos(imagen.copy(), rectangulos)
+    diferencia = int(np.abs(referencia.astype(np.int16) - vectorizado.astype(np.int16)).max())
+
+    t_bucle = medir(pixelar_bucle, imagen, rectangulos, args.repeticiones)
+    t_vector = medir(pixelar_rectangulos, imagen, rectangulos, args.repeticiones)
+
+    print(f"Imagen {args.ancho}x{args.alto}, {args.caras} caras de ~{args.lado}px")
+    print(f"Diferencia máxima entre implementaciones: {diferencia}")
+    print(f"Bucle original:  {t_bucle:8.2f} ms (mediana)")
+    print(f"Vectorizado:     {t_vector:8.2f} ms (mediana)")
+    print(f"Aceleración:     {t_bucle / t_vector if t_vector else float('inf'):8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
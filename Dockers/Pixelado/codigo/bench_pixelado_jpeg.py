@@ -0,0 +1,213 @@
+"""
+Benchmark del pixelado de JPEG: camino por píxeles (decodificar, pixelar y
+volver a codificar con `cv2.imencode`) frente al pixelado sobre los
+coeficientes DCT (`pixelado_dct.pixelar_jpeg`).
+
+Para cada imagen se mide la mediana del tiempo de cada camino, el tamaño del
+JPEG resultante y la pérdida fuera de las caras: el PSNR de los píxeles que no
+se pixelan respecto a la imagen original decodificada (infinito si son
+idénticos). Las imágenes son sintéticas (`--lados`, `--calidades`) o los JPEG
+de un directorio (`--corpus`).
+
+Antes se comprueba que una secuencia de JPEG progresivos y secuenciales
+alternados (`--secuencia`, "p" y "b") procesada en el mismo hilo da en cada
+paso un JPEG que se decodifica y no cambia los píxeles fuera de las caras: el
+estado de libjpeg-turbo no debe pasar de una imagen a la siguiente.
+
+Uso:
+    python bench_pixelado_jpeg.py --lados 1280 3840 --calidades 75 90 --caras 5 --lado 200
+    python bench_pixelado_jpeg.py --corpus fotos/ --salida jpeg.json
+    python bench_pixelado_jpeg.py --secuencia pbbpbpbb --lados 1280 --calidades 75
+"""
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+import pixelado_dct
+from pixelado import pixelar_rectangulos
+
+
+def imagen_sintetica(rng, ancho, alto):
+    # Degradados suaves con algo de ruido, más parecidos a una foto que el ruido puro
+    base = rng.integers(0, 256, size=(max(alto // 40, 2), max(ancho // 40, 2), 3), dtype=np.uint8)
+    base = cv2.resize(base, (ancho, alto), interpolation=cv2.INTER_CUBIC).astype(np.int16)
+    return np.clip(base + rng.integers(-6, 7, size=base.shape), 0, 255).astype(np.uint8)
+
+
+def cargar_corpus(args, rng):
+    corpus = []
+    if args.corpus:
+        for nombre in sorted(os.listdir(args.corpus)):
+            if os.path.splitext(nombre)[1].lower() in (".jpg", ".jpeg"):
+                with open(os.path.join(args.corpus, nombre), "rb") as f:
+                    corpus.append((nombre, f.read()))
+        return corpus
+    for lado in args.lados:
+        ancho, alto = lado, lado * 9 // 16
+        imagen = imagen_sintetica(rng, ancho, alto)
+        for calidad in args.calidades:
+            _, buffer = cv2.imencode(".jpg", imagen, [cv2.IMWRITE_JPEG_QUALITY, calidad])
+            corpus.append((f"{ancho}x{alto}_q{calidad}", buffer.tobytes()))
+    return corpus
+
+
+def rectangulos_aleatorios(rng, ancho, alto, caras, lado):
+    rectangulos = []
+    for _ in range(caras):
+        w = int(rng.integers(max(lado // 2, 1), min(lado, ancho) + 1))
+        h = int(rng.integers(max(lado // 2, 1), min(lado, alto) + 1))
+        rectangulos.append([int(rng.integers(0, ancho - w + 1)), int(rng.integers(0, alto - h + 1)), w, h])
+    return rectangulos
+
+
+def pixelar_pixeles(datos, rectangulos):
+    """
+    Camino actual del endpoint /pixelar para cualquier formato.
+    """
+    imagen = cv2.imdecode(np.frombuffer(datos, np.uint8), cv2.IMREAD_COLOR)
+    pixelar_rectangulos(imagen, rectangulos)
+    _, buffer = cv2.imencode(".jpg", imagen)
+    return buffer.tobytes()
+
+
+def medir(funcion, datos, rectangulos, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion(datos, rectangulos)
+        tiempos.append(time.perf_counter() - inicio)
+    return float(np.median(tiempos)) * 1000.0, resultado
+
+
+def psnr_fuera(original, resultado, rectangulos, margen):
+    # PSNR de los píxeles alejados de las caras (el margen cubre la ampliación a MCU y el suavizado del croma)
+    mascara = np.ones(original.shape[:2], dtype=bool)
+    for x, y, w, h in rectangulos:
+        mascara[max(y - margen, 0):y + h + margen, max(x - margen, 0):x + w + margen] = False
+    if not mascara.any():
+        return None
+    error = np.mean((original[mascara].astype(np.float64) - resultado[mascara].astype(np.float64)) ** 2)
+    return float("inf") if error == 0 else float(10 * np.log10(255.0 ** 2 / error))
+
+
+def comprobar_secuencia(rng, secuencia, caras, lado):
+    """
+    Pixela en el mismo hilo una secuencia de JPEG progresivos ("p") y
+    secuenciales ("b") y comprueba cada resultado.
+
+    :return: Lista de fallos (texto); vacía si todo es correcto
+    """
+    imagen = imagen_sintetica(rng, 800, 600)
+    jpeg = {
+        "b": cv2.imencode(".jpg", imagen, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes(),
+        "p": cv2.imencode(".jpg", imagen, [cv2.IMWRITE_JPEG_QUALITY, 80, cv2.IMWRITE_JPEG_PROGRESSIVE, 1])[1].tobytes(),
+    }
+    originales = {tipo: cv2.imdecode(np.frombuffer(datos, np.uint8), cv2.IMREAD_COLOR) for tipo, datos in jpeg.items()}
+    fallos = []
+    for paso, tipo in enumerate(secuencia):
+        rectangulos = rectangulos_aleatorios(rng, 800, 600, caras, lado)
+        salida = pixelado_dct.pixelar_jpeg(jpeg[tipo], rectangulos)
+        if salida is None:
+            # El camino DCT ha rechazado su resultado: el servicio usaría el de píxeles
+            print(f"  {paso} ({tipo}): sin pixelado DCT")
+            continue
+        decodificada = cv2.imdecode(np.frombuffer(salida, np.uint8), cv2.IMREAD_COLOR)
+        if decodificada is None:
+            fallos.append(f"{paso} ({tipo}): no se puede decodificar")
+            continue
+        psnr = psnr_fuera(originales[tipo], decodificada, rectangulos, margen=32)
+        if psnr is not None and psnr != float("inf"):
+            fallos.append(f"{paso} ({tipo}): los píxeles fuera de las caras cambian (PSNR {psnr:.1f})")
+    return fallos
+
+
+def formato(valor):
+    if valor is None:
+        return "-"
+    return "inf" if valor == float("inf") else f"{valor:.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="Directorio con JPEG (por defecto, imágenes sintéticas)")
+    parser.add_argument("--lados", nargs="+", type=int, default=[1280, 3840], help="Anchos de las imágenes sintéticas")
+    parser.add_argument("--calidades", nargs="+", type=int, default=[75, 90], help="Calidades de las imágenes sintéticas")
+    parser.add_argument("--caras", type=int, default=5)
+    parser.add_argument("--lado", type=int, default=200, help="Lado máximo de las caras en píxeles")
+    parser.add_argument("--repeticiones", type=int, default=10)
+    parser.add_argument("--secuencia", default="pbbpbpbb",
+                        help="JPEG progresivos (p) y secuenciales (b) que se comprueban en el mismo hilo")
+    parser.add_argument("--salida", help="Archivo JSON en el que guardar los resultados")
+    args = parser.parse_args()
+
+    if not pixelado_dct.disponible():
+        parser.error("libturbojpeg no está instalado (o indique su ruta con LIBTURBOJPEG)")
+
+    rng = np.random.default_rng(0)
+    if set(args.secuencia) - {"p", "b"}:
+        parser.error("La secuencia solo puede contener 'p' y 'b'")
+    fallos = comprobar_secuencia(rng, args.secuencia, args.caras, args.lado)
+    print(f"Secuencia {args.secuencia}: " + ("correcta" if not fallos else f"{len(fallos)} fallos"))
+    for fallo in fallos:
+        print(f"  {fallo}")
+
+    corpus = cargar_corpus(args, rng)
+    if not corpus:
+        parser.error("No hay imágenes que procesar")
+
+    resultados = []
+    print(f"{'imagen':>16} {'KB':>7} {'píxeles ms':>11} {'dct ms':>8} {'acel.':>6} "
+          f"{'KB píx.':>8} {'KB dct':>8} {'PSNR píx.':>10} {'PSNR dct':>9}")
+    for nombre, datos in corpus:
+        original = cv2.imdecode(np.frombuffer(datos, np.uint8), cv2.IMREAD_COLOR)
+        alto, ancho = original.shape[:2]
+        rectangulos = rectangulos_aleatorios(rng, ancho, alto, args.caras, args.lado)
+
+        t_pixeles, salida_pixeles = medir(pixelar_pixeles, datos, rectangulos, args.repeticiones)
+        t_dct, salida_dct = medir(pixelado_dct.pixelar_jpeg, datos, rectangulos, args.repeticiones)
+        if salida_dct is None:
+            print(f"{nombre:>16} no admite el pixelado DCT")
+            continue
+
+        fila = {
+            "imagen": nombre,
+            "ancho": ancho,
+            "alto": alto,
+            "bytes_entrada": len(datos),
+            "pixeles_ms": round(t_pixeles, 2),
+            "dct_ms": round(t_dct, 2),
+            "aceleracion": round(t_pixeles / t_dct, 2) if t_dct else None,
+            "bytes_pixeles": len(salida_pixeles),
+            "bytes_dct": len(salida_dct),
+        }
+        psnr = {}
+        for camino, salida in (("pixeles", salida_pixeles), ("dct", salida_dct)):
+            decodificada = cv2.imdecode(np.frombuffer(salida, np.uint8), cv2.IMREAD_COLOR)
+            psnr[camino] = psnr_fuera(original, decodificada, rectangulos, margen=32)
+            fila[f"psnr_fuera_{camino}"] = None if psnr[camino] is None else round(psnr[camino], 2)
+        resultados.append(fila)
+        print(f"{nombre:>16} {len(datos) / 1024:>7.0f} {t_pixeles:>11.1f} {t_dct:>8.1f} "
+              f"{formato(fila['aceleracion']):>6} {len(salida_pixeles) / 1024:>8.0f} {len(salida_dct) / 1024:>8.0f} "
+              f"{formato(psnr['pixeles']):>10} {formato(psnr['dct']):>9}")
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump({
+                "caras": args.caras,
+                "lado": args.lado,
+                "repeticiones": args.repeticiones,
+                "secuencia": args.secuencia,
+                "fallos_secuencia": fallos,
+                "resultados": resultados,
+            }, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados guardados en {args.salida}")
+    if fallos:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
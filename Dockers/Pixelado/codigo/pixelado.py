@@ -0,0 +1,126 @@
+import numpy as np
+
+# Número de bloques por lado con el que se pixela cada región
+BLOQUES = 6
+
+
+def recortar_rectangulo(rectangulo, alto, ancho):
+    """
+    Ajusta un rectángulo (x, y, w, h) a los límites de la imagen.
+
+    Las coordenadas pueden ser decimales: el rectángulo se amplía al píxel
+    entero que lo contiene por completo.
+
+    :param rectangulo: Secuencia (x, y, w, h)
+    :param alto: Alto de la imagen en píxeles
+    :param ancho: Ancho de la imagen en píxeles
+    :return: Tupla (x1, y1, x2, y2) en enteros, o None si no queda área visible
+    """
+    x, y, w, h = rectangulo
+    x1 = max(int(np.floor(x)), 0)
+    y1 = max(int(np.floor(y)), 0)
+    x2 = min(int(np.ceil(x + w)), ancho)
+    y2 = min(int(np.ceil(y + h)), alto)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return x1, y1, x2, y2
+
+
+def pixelar_roi(roi, bloques=BLOQUES):
+    """
+    Pixela una región completa de una sola vez, modificándola en el sitio.
+
+    Reproduce el efecto del bucle por bloques original: bloques de
+    `max(lado // bloques, 1)` píxeles empezando en la esquina superior
+    izquierda (con un bloque final más pequeño si el lado no es divisible) y
+    cada bloque relleno con su color medio truncado a entero. Las sumas por
+    bloque se calculan con `np.add.reduceat` en lugar de recorrer los bloques
+    en Python.
+
+    :param roi: Vista (alto x ancho x canales) de la imagen a pixelar
+    :param bloques: Número de bloques por lado
+    :return: La misma región, ya pixelada
+    """
+    alto, ancho = roi.shape[:2]
+    if alto == 0 or ancho == 0:
+        return roi
+
+    paso_y = max(alto // bloques, 1)
+    paso_x = max(ancho // bloques, 1)
+    inicios_y = np.arange(0, alto, paso_y)
+    inicios_x = np.arange(0, ancho, paso_x)
+
+    # Tamaño real de cada bloque (el último puede ser más pequeño)
+    altos = np.diff(np.append(inicios_y, alto))
+    anchos = np.diff(np.append(inicios_x, ancho))
+
+    # Suma de cada bloque en enteros de 64 bits (sin pérdida de precisión)
+    sumas = np.add.reduceat(roi, inicios_y, axis=0, dtype=np.uint64)
+    sumas = np.add.reduceat(sumas, inicios_x, axis=1, dtype=np.uint64)
+
+    forma = (-1,) + (1,) * (roi.ndim - 1)
+    areas = altos.reshape(forma) * anchos.reshape((1,) + forma[:-1])
+    medias = (sumas // areas.astype(np.uint64)).astype(roi.dtype)
+
+    roi[...] = np.repeat(np.repeat(medias, altos, axis=0), anchos, axis=1)
+    return roi
+
+
+def pixelar_rectangulos(imagen, rectangulos, bloques=BLOQUES):
+    """
+    Pixela varias regiones de una imagen, modificándola en el sitio.
+
+    :param imagen: Imagen (numpy array) a modificar
+    :param rectangulos: Lista de rectángulos (x, y, w, h); se recortan a los límites de la imagen
+    :param bloques: Número de bloques por lado
+    :return: La misma imagen, con las regiones pixeladas
+    """
+    alto, ancho = imagen.shape[:2]
+    for rectangulo in rectangulos:
+        limites = recortar_rectangulo(rectangulo, alto, ancho)
+        if limites is None:
+            continue
+        x1, y1, x2, y2 = limites
+        pixelar_roi(imagen[y1:y2, x1:x2], bloques)
+    return imagen
+
+
+def agrupar_rectangulos(rectangulos, alto, ancho):
+    """
+    Agrupa los rectángulos que se solapan en parches independientes.
+
+    Cada parche es la caja que contiene a un grupo de rectángulos solapados y
+    lleva esos rectángulos en coordenadas del parche, en su orden original.
+    Pixelar cada parche por separado con `pixelar_rectangulos` da el mismo
+    resultado que pixelar la imagen completa, porque los parches no se solapan.
+
+    :param rectangulos: Lista de rectángulos (x, y, w, h) en coordenadas de la imagen
+    :param alto: Alto de la imagen
+    :param ancho: Ancho de la imagen
+    :return: Lista de parches ((x1, y1, x2, y2), [(x, y, w, h) relativos al parche])
+    """
+    # Grupos (caja, [(orden, límites)]); al crecer una caja puede tocar otros grupos,
+    # así que se fusiona hasta que ninguna caja se solape con otra
+    grupos = []
+    for orden, rectangulo in enumerate(rectangulos):
+        limites = recortar_rectangulo(rectangulo, alto, ancho)
+        if limites is None:
+            continue
+        caja, miembros = limites, [(orden, limites)]
+        fusionada = True
+        while fusionada:
+            fusionada = False
+            for i, (otra, otros) in enumerate(grupos):
+                if caja[0] < otra[2] and otra[0] < caja[2] and caja[1] < otra[3] and otra[1] < caja[3]:
+                    caja = (min(caja[0], otra[0]), min(caja[1], otra[1]), max(caja[2], otra[2]), max(caja[3], otra[3]))
+                    miembros = otros + miembros
+                    del grupos[i]
+                    fusionada = True
+                    break
+        grupos.append((caja, miembros))
+
+    parches = []
+    for (x1, y1, x2, y2), miembros in grupos:
+        relativos = [(a - x1, b - y1, c - a, d - b) for _, (a, b, c, d) in sorted(miembros)]
+        parches.append(((x1, y1, x2, y2), relativos))
+    return parches
@@ -0,0 +1,322 @@
+"""
+Pixelado de imágenes JPEG sobre los coeficientes DCT, sin decodificarlas.
+
+El pixelado por píxeles decodifica la imagen completa, pixela las regiones y
+la vuelve a codificar: cuesta el IDCT, la conversión de color y el DCT de toda
+la imagen y añade una generación de pérdida a los píxeles que no se tocan.
+Aquí se usa la transformación sin pérdida de libjpeg-turbo (`tjTransform`,
+la misma que `jpegtran`): se leen los coeficientes cuantizados, solo se
+modifican los bloques 8x8 de las regiones a pixelar y se vuelven a escribir
+con codificación de entropía. El resto de bloques se copian tal cual.
+
+Cada región se amplía a la rejilla de MCU (8 o 16 píxeles según el
+submuestreo) y se divide en como mucho `bloques` x `bloques` celdas de MCU
+completos, como `pixelado.pixelar_roi` la divide en celdas de píxeles. Todos
+los bloques 8x8 de una celda se sustituyen por un bloque plano (solo
+coeficiente DC, AC a cero) con el DC medio de la celda, que es su color medio.
+
+Se necesitan dos pasadas sobre los coeficientes (una para sumar los DC de las
+celdas y otra para escribirlos), que se hacen en una sola llamada a
+`tjTransform` con dos transformaciones: la primera sin salida
+(`TJXOPT_NOOUTPUT`) y la segunda con la imagen resultante. Los marcadores
+(EXIF, miniaturas, ICC) no se copian (`TJXOPT_COPYNONE`): la miniatura EXIF
+mostraría las caras sin pixelar, y así el resultado lleva los mismos
+metadatos que el del pixelado por píxeles (ninguno).
+
+El JPEG resultante se comprueba decodificándolo a 1/8 de escala (solo los
+DC, pero recorriendo toda la codificación de entropía): si libjpeg avisa de
+datos corruptos no se devuelve. Cada llamada crea y destruye su propio
+manejador de TurboJPEG: reutilizar el de una transformación progresiva en una
+posterior produce JPEG corruptos.
+
+`pixelar_jpeg` devuelve None cuando la imagen no admite este camino
+(libturbojpeg no instalado, orientación EXIF distinta de 1, CMYK, submuestreo
+no estándar, un JPEG que libjpeg-turbo no transforma sin avisos o un resultado
+que no se decodifica limpiamente), y el servicio usa entonces el pixelado por
+píxeles.
+"""
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+
+import numpy as np
+
+from pixelado import BLOQUES, recortar_rectangulo
+
+# Constantes de turbojpeg.h
+_TJXOPT_NOOUTPUT = 16
+_TJXOPT_PROGRESSIVE = 32
+_TJXOPT_COPYNONE = 64
+_TJCS_YCBCR = 1
+_TJCS_GRAY = 2
+_TJPF_GRAY = 6
+# Tamaño del MCU en píxeles (ancho, alto) por submuestreo: TJSAMP_444, 422, 420, GRAY, 440 y 411
+_TAMANO_MCU = {0: (8, 8), 1: (16, 8), 2: (16, 16), 3: (8, 8), 4: (8, 16), 5: (32, 8)}
+
+
+class _Region(ctypes.Structure):
+    _fields_ = [("x", ctypes.c_int), ("y", ctypes.c_int), ("w", ctypes.c_int), ("h", ctypes.c_int)]
+
+
+class _Transformacion(ctypes.Structure):
+    pass
+
+
+_FILTRO = ctypes.CFUNCTYPE(
+    ctypes.c_int, ctypes.POINTER(ctypes.c_short), _Region, _Region,
+    ctypes.c_int, ctypes.c_int, ctypes.POINTER(_Transformacion),
+)
+_Transformacion._fields_ = [
+    ("r", _Region),
+    ("op", ctypes.c_int),
+    ("options", ctypes.c_int),
+    ("data", ctypes.c_void_p),
+    ("customFilter", _FILTRO),
+]
+
+_bloqueo = threading.Lock()
+_biblioteca = None
+_cargada = False
+
+
+def _cargar():
+    # libturbojpeg se carga la primera vez que se usa; LIBTURBOJPEG permite indicar la ruta
+    global _biblioteca, _cargada
+    with _bloqueo:
+        if _cargada:
+            return _biblioteca
+        _cargada = True
+        ruta = os.environ.get("LIBTURBOJPEG") or ctypes.util.find_library("turbojpeg")
+        if not ruta:
+            return None
+        try:
+            lib = ctypes.CDLL(ruta)
+        except OSError:
+            return None
+        lib.tjInitTransform.restype = ctypes.c_void_p
+        lib.tjDecompressHeader3.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p, ctypes.c_ulong,
+            ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int),
+        ]
+        lib.tjTransform.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_int,
+            ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte)), ctypes.POINTER(ctypes.c_ulong),
+            ctypes.POINTER(_Transformacion), ctypes.c_int,
+        ]
+        lib.tjDecompress2.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_void_p,
+            ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+        ]
+        lib.tjDestroy.argtypes = [ctypes.c_void_p]
+        lib.tjFree.argtypes = [ctypes.c_void_p]
+        _biblioteca = lib
+        return lib
+
+
+def disponible():
+    """
+    :return: True si libturbojpeg está instalado y se puede usar el pixelado DCT
+    """
+    return _cargar() is not None
+
+
+def _decodifica_limpio(lib, manejador, datos, ancho, alto):
+    # Decodificación a 1/8 de escala: recorre toda la codificación de entropía y
+    # tjDecompress2 devuelve -1 ante cualquier aviso de libjpeg (datos corruptos)
+    ancho, alto = (ancho + 7) // 8, (alto + 7) // 8
+    destino = ctypes.create_string_buffer(ancho * alto)
+    return lib.tjDecompress2(manejador, datos, len(datos), destino, ancho, 0, alto, _TJPF_GRAY, 0) == 0
+
+
+def leer_marcadores(datos):
+    """
+    Lee de las cabeceras de un JPEG la orientación EXIF (etiqueta 0x0112) y si es progresivo.
+
+    :param datos: Bytes del JPEG
+    :return: Tupla (orientación de 1 a 8 o None si no hay, True si es progresivo)
+    """
+    orientacion, progresivo = None, False
+    i = 2
+    while i + 4 <= len(datos) and datos[i] == 0xFF:
+        marcador = datos[i + 1]
+        if marcador == 0xFF:
+            i += 1
+            continue
+        if marcador in (0xD9, 0xDA):
+            break
+        longitud = struct.unpack(">H", datos[i + 2:i + 4])[0]
+        segmento = datos[i + 4:i + 2 + longitud]
+        if marcador == 0xE1 and segmento[:6] == b"Exif\x00\x00" and orientacion is None:
+            orientacion = _orientacion_tiff(segmento[6:])
+        elif marcador in (0xC2, 0xC6, 0xCA, 0xCE):
+            progresivo = True
+        i += 2 + longitud
+    return orientacion, progresivo
+
+
+def _orientacion_tiff(tiff):
+    if tiff[:2] not in (b"II", b"MM") or len(tiff) < 8:
+        return None
+    orden = "<" if tiff[:2] == b"II" else ">"
+    ifd = struct.unpack(orden + "I", tiff[4:8])[0]
+    if ifd + 2 > len(tiff):
+        return None
+    entradas = struct.unpack(orden + "H", tiff[ifd:ifd + 2])[0]
+    for k in range(entradas):
+        inicio = ifd + 2 + 12 * k
+        if inicio + 12 > len(tiff):
+            break
+        etiqueta, tipo = struct.unpack(orden + "HH", tiff[inicio:inicio + 4])
+        if etiqueta == 0x0112 and tipo == 3:
+            return struct.unpack(orden + "H", tiff[inicio + 8:inicio + 10])[0]
+    return None
+
+
+class _Celdas:
+    """
+    Celdas de una región en los bloques 8x8 de un componente.
+
+    Las celdas se miden en MCU desde la esquina superior izquierda, con una
+    última celda más pequeña si el lado no es divisible. El paso se redondea
+    hacia arriba (como mucho `bloques` celdas por lado): con MCU de 16 píxeles,
+    redondear hacia abajo dejaría celdas de un MCU en caras de hasta 190
+    píxeles, un pixelado más fino que el de `pixelado.pixelar_roi`.
+    """
+
+    def __init__(self, mcu, factores, bloques_comp, bloques):
+        mx1, my1, mx2, my2 = mcu
+        fh, fv = factores
+        ancho_b, alto_b = bloques_comp
+        paso_x = max(-(-(mx2 - mx1) // bloques), 1) * fh
+        paso_y = max(-(-(my2 - my1) // bloques), 1) * fv
+        self.bx1, self.bx2 = min(mx1 * fh, ancho_b), min(mx2 * fh, ancho_b)
+        self.by1, self.by2 = min(my1 * fv, alto_b), min(my2 * fv, alto_b)
+        self.paso_y = paso_y
+        self.inicios = np.arange(0, self.bx2 - self.bx1, paso_x)
+        self.anchos = np.diff(np.append(self.inicios, self.bx2 - self.bx1))
+        filas = -(-(self.by2 - self.by1) // paso_y) if self.by2 > self.by1 else 0
+        self.sumas = np.zeros((filas, len(self.inicios)), dtype=np.int64)
+        self.cuentas = np.zeros((filas, len(self.inicios)), dtype=np.int64)
+        self.medias = None
+
+    def contiene(self, fila):
+        return self.by1 <= fila < self.by2 and self.bx2 > self.bx1
+
+    def sumar(self, coeficientes, fila):
+        dc = coeficientes[self.bx1:self.bx2, 0].astype(np.int64)
+        celda = (fila - self.by1) // self.paso_y
+        self.sumas[celda] += np.add.reduceat(dc, self.inicios)
+        self.cuentas[celda] += self.anchos
+
+    def escribir(self, coeficientes, fila):
+        if self.medias is None:
+            self.medias = np.rint(self.sumas / np.maximum(self.cuentas, 1)).astype(np.int16)
+        celda = (fila - self.by1) // self.paso_y
+        coeficientes[self.bx1:self.bx2] = 0
+        coeficientes[self.bx1:self.bx2, 0] = np.repeat(self.medias[celda], self.anchos)
+
+
+def _regiones_mcu(rectangulos, alto, ancho, mcu_ancho, mcu_alto):
+    # Rectángulos recortados a la imagen y ampliados a la rejilla de MCU, en unidades de MCU
+    regiones = []
+    for rectangulo in rectangulos:
+        limites = recortar_rectangulo(rectangulo, alto, ancho)
+        if limites is None:
+            continue
+        x1, y1, x2, y2 = limites
+        regiones.append((x1 // mcu_ancho, y1 // mcu_alto, -(-x2 // mcu_ancho), -(-y2 // mcu_alto)))
+    return regiones
+
+
+def pixelar_jpeg(datos, rectangulos, bloques=BLOQUES):
+    """
+    Pixela regiones de un JPEG modificando solo los coeficientes DCT de sus bloques.
+
+    Los rectángulos se pixelan en orden, como en `pixelado.pixelar_rectangulos`,
+    pero las medias de todas las celdas se calculan sobre los coeficientes originales.
+
+    :param datos: Bytes del JPEG (ya validado)
+    :param rectangulos: Lista de rectángulos (x, y, w, h); se recortan a los límites de la imagen
+    :param bloques: Número de celdas por lado de cada región
+    :return: Bytes del JPEG pixelado, o None si la imagen no admite el pixelado DCT
+    """
+    lib = _cargar()
+    if lib is None:
+        return None
+    orientacion, progresivo = leer_marcadores(datos)
+    if orientacion not in (None, 1):
+        # Las cajas vienen en la orientación aplicada al decodificar; los coeficientes no están rotados
+        return None
+
+    # Un manejador nuevo en cada llamada (ver la documentación del módulo)
+    manejador = lib.tjInitTransform()
+    if not manejador:
+        raise RuntimeError("No se pudo inicializar TurboJPEG")
+    try:
+        return _pixelar_jpeg(lib, manejador, bytes(datos), rectangulos, bloques, progresivo)
+    finally:
+        lib.tjDestroy(manejador)
+
+
+def _pixelar_jpeg(lib, manejador, datos, rectangulos, bloques, progresivo):
+    ancho, alto, submuestreo, espacio = (ctypes.c_int() for _ in range(4))
+    if lib.tjDecompressHeader3(manejador, datos, len(datos), ctypes.byref(ancho), ctypes.byref(alto),
+                               ctypes.byref(submuestreo), ctypes.byref(espacio)) != 0:
+        return None
+    if submuestreo.value not in _TAMANO_MCU or espacio.value not in (_TJCS_YCBCR, _TJCS_GRAY):
+        return None
+    mcu_ancho, mcu_alto = _TAMANO_MCU[submuestreo.value]
+    regiones = _regiones_mcu(rectangulos, alto.value, ancho.value, mcu_ancho, mcu_alto)
+
+    # Celdas de cada componente, creadas con la primera fila (ahí se conoce su ancho en bloques)
+    celdas = {}
+    error = []
+
+    def filtro(coeficientes, fila_region, plano, componente, transformacion, _):
+        try:
+            if componente not in celdas:
+                factores = (mcu_ancho // 8, mcu_alto // 8) if componente == 0 else (1, 1)
+                bloques_comp = (plano.w // 8, plano.h // 8)
+                celdas[componente] = [_Celdas(r, factores, bloques_comp, bloques) for r in regiones]
+            fila = fila_region.y // 8
+            activas = [c for c in celdas[componente] if c.contiene(fila)]
+            if activas:
+                vista = np.ctypeslib.as_array(coeficientes, shape=(fila_region.w // 8, 64))
+                for c in activas:
+                    if transformacion == 0:
+                        c.sumar(vista, fila)
+                    else:
+                        c.escribir(vista, fila)
+            return 0
+        except Exception as e:
+            error.append(e)
+            return -1
+
+    funcion = _FILTRO(filtro)
+    transformaciones = (_Transformacion * 2)()
+    transformaciones[0].options = _TJXOPT_NOOUTPUT
+    # Un JPEG progresivo se escribe también progresivo (ocupa menos)
+    transformaciones[1].options = _TJXOPT_COPYNONE | (_TJXOPT_PROGRESSIVE if progresivo else 0)
+    if regiones:
+        transformaciones[0].customFilter = funcion
+        transformaciones[1].customFilter = funcion
+    salidas = (ctypes.POINTER(ctypes.c_ubyte) * 2)()
+    tamanos = (ctypes.c_ulong * 2)()
+    try:
+        resultado = lib.tjTransform(manejador, datos, len(datos), 2, salidas, tamanos, transformaciones, 0)
+        if error:
+            raise error[0]
+        if resultado != 0 or not salidas[1]:
+            # Error o aviso de libjpeg (datos corruptos): el camino por píxeles es más tolerante
+            return None
+        resultado = ctypes.string_at(salidas[1], tamanos[1])
+    finally:
+        for salida in salidas:
+            if salida:
+                lib.tjFree(salida)
+    if not _decodifica_limpio(lib, manejador, resultado, ancho.value, alto.value):
+        return None
+    return resultado
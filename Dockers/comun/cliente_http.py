@@ -0,0 +1,242 @@
+"""
+Cliente HTTP compartido para las llamadas internas entre servicios.
+
+Cada servicio de destino tiene su propia `requests.Session` con un pool de
+conexiones keep-alive, timeouts de conexión y de lectura, reintentos acotados
+con jitter (solo para etapas idempotentes) y un cortacircuitos que falla de
+inmediato mientras el servicio está caído.
+
+La configuración se lee de variables de entorno con el prefijo del servicio,
+por ejemplo para el prefijo `BOUNDING`:
+
+* `BOUNDING_URL`: URL del endpoint
+* `BOUNDING_POOL`: conexiones máximas en el pool
+* `BOUNDING_TIMEOUT_CONEXION` / `BOUNDING_TIMEOUT_LECTURA`: timeouts en segundos
+* `BOUNDING_REINTENTOS`: reintentos adicionales ante fallos de conexión o 502/503/504
+* `BOUNDING_CB_FALLOS`: fallos consecutivos que abren el circuito
+* `BOUNDING_CB_REAPERTURA`: segundos que el circuito permanece abierto
+
+Cada petición lleva el identificador de la traza en curso (`X-Request-Id`) y
+su tiempo de espera se anota en el histograma de red de `instrumentacion`.
+"""
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import instrumentacion
+
+# Códigos que indican que el servicio no está disponible (no un error de la petición)
+CODIGOS_REINTENTABLES = {502, 503, 504}
+
+
+class CircuitoAbierto(requests.exceptions.ConnectionError):
+    """
+    El servicio de destino ha fallado repetidamente y no se le envían peticiones.
+    """
+
+
+class Cortacircuitos:
+    """
+    Cortacircuitos clásico de tres estados (cerrado, abierto y semiabierto).
+
+    Tras `umbral_fallos` fallos consecutivos el circuito se abre y todas las
+    peticiones fallan de inmediato durante `tiempo_reapertura` segundos. Pasado
+    ese tiempo se deja pasar una petición de prueba: si tiene éxito el circuito
+    se cierra y si falla vuelve a abrirse.
+    """
+
+    def __init__(self, umbral_fallos=5, tiempo_reapertura=30.0):
+        self.umbral_fallos = max(int(umbral_fallos), 1)
+        self.tiempo_reapertura = float(tiempo_reapertura)
+        self._fallos = 0
+        self._abierto_hasta = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    @property
+    def estado(self):
+        with self._lock:
+            if self._fallos < self.umbral_fallos:
+                return "cerrado"
+            if time.monotonic() < self._abierto_hasta:
+                return "abierto"
+            return "semiabierto"
+
+    def permitir(self):
+        """
+        :return: True si la petición puede enviarse
+        """
+        with self._lock:
+            if self._fallos < self.umbral_fallos:
+                return True
+            if time.monotonic() < self._abierto_hasta or self._prueba_en_curso:
+                return False
+            self._prueba_en_curso = True
+            return True
+
+    def exito(self):
+        with self._lock:
+            self._fallos = 0
+            self._prueba_en_curso = False
+
+    def liberar(self):
+        """
+        La petición permitida no llegó a completarse por un motivo ajeno al
+        servicio (p. ej. el cuerpo enviado en streaming se cortó): no cuenta
+        como éxito ni como fallo.
+        """
+        with self._lock:
+            self._prueba_en_curso = False
+
+    def fallo(self):
+        with self._lock:
+            self._fallos += 1
+            self._prueba_en_curso = False
+            if self._fallos >= self.umbral_fallos:
+                self._abierto_hasta = time.monotonic() + self.tiempo_reapertura
+
+
+def _rebobinar(files):
+    # Los archivos ya leídos en un intento anterior se vuelven a poner al principio
+    if not files:
+        return
+    valores = files.values() if isinstance(files, dict) else [v for _, v in files]
+    for valor in valores:
+        contenido = valor[1] if isinstance(valor, tuple) else valor
+        if hasattr(contenido, "seek"):
+            contenido.seek(0)
+
+
+class ClienteServicio:
+    """
+    Cliente de un servicio interno con pool de conexiones, timeouts, reintentos y cortacircuitos.
+    """
+
+    def __init__(self, nombre, url, pool=10, timeout_conexion=2.0, timeout_lectura=30.0,
+                 reintentos=0, backoff=0.2, idempotente=True, umbral_fallos=5, tiempo_reapertura=30.0):
+        """
+        :param nombre: Nombre del servicio (para los mensajes de error)
+        :param url: URL del endpoint
+        :param pool: Número máximo de conexiones abiertas con el servicio
+        :param timeout_conexion: Segundos máximos para establecer la conexión
+        :param timeout_lectura: Segundos máximos de espera de la respuesta
+        :param reintentos: Reintentos adicionales (solo si `idempotente`)
+        :param backoff: Espera base (s) entre reintentos; se duplica en cada intento y se aplica jitter
+        :param idempotente: Si la etapa puede repetirse sin efectos secundarios
+        :param umbral_fallos: Fallos consecutivos que abren el circuito
+        :param tiempo_reapertura: Segundos que el circuito permanece abierto
+        """
+        self.nombre = nombre
+        self.url = url
+        self.timeout = (float(timeout_conexion), float(timeout_lectura))
+        self.reintentos = max(int(reintentos), 0) if idempotente else 0
+        self.backoff = float(backoff)
+        self.cortacircuitos = Cortacircuitos(umbral_fallos, tiempo_reapertura)
+
+        self.sesion = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=max(int(pool), 1), max_retries=0)
+        self.sesion.mount("http://", adaptador)
+        self.sesion.mount("https://", adaptador)
+
+    @classmethod
+    def desde_entorno(cls, prefijo, nombre, url, **defectos):
+        """
+        Crea un cliente leyendo su configuración de variables de entorno.
+
+        :param prefijo: Prefijo de las variables (p. ej. "BOUNDING")
+        :param nombre: Nombre del servicio
+        :param url: URL por defecto si no se define `<PREFIJO>_URL`
+        :param defectos: Valores por defecto del resto de parámetros del constructor
+        :return: Instancia de ClienteServicio
+        """
+        def leer(clave, parametro, tipo):
+            valor = os.environ.get(f"{prefijo}_{clave}")
+            if valor is None:
+                return defectos.get(parametro)
+            return tipo(valor)
+
+        configuracion = {
+            "pool": leer("POOL", "pool", int),
+            "timeout_conexion": leer("TIMEOUT_CONEXION", "timeout_conexion", float),
+            "timeout_lectura": leer("TIMEOUT_LECTURA", "timeout_lectura", float),
+            "reintentos": leer("REINTENTOS", "reintentos", int),
+            "backoff": leer("BACKOFF", "backoff", float),
+            "umbral_fallos": leer("CB_FALLOS", "umbral_fallos", int),
+            "tiempo_reapertura": leer("CB_REAPERTURA", "tiempo_reapertura", float),
+        }
+        if "idempotente" in defectos:
+            configuracion["idempotente"] = defectos["idempotente"]
+        configuracion = {k: v for k, v in configuracion.items() if v is not None}
+        return cls(nombre, os.environ.get(f"{prefijo}_URL", url), **configuracion)
+
+    def version(self):
+        """
+        Pide al servicio la huella de su configuración (`GET /listo`, ver servicio.py).
+        No pasa por el cortacircuitos ni se reintenta.
+
+        :return: Huella de la versión, o None si el servicio no está listo o no responde
+        """
+        partes = urlsplit(self.url)
+        try:
+            respuesta = self.sesion.get(f"{partes.scheme}://{partes.netloc}/listo", timeout=self.timeout)
+            if respuesta.status_code != 200:
+                return None
+            return respuesta.json().get("version")
+        except (requests.RequestException, ValueError):
+            return None
+
+    def post(self, url=None, reintentar=True, **kwargs):
+        """
+        Envía un POST al servicio.
+
+        :param url: Endpoint alternativo del mismo servicio (por defecto, el configurado)
+        :param reintentar: False si el cuerpo no puede volver a enviarse (un generador en streaming)
+        :param kwargs: Argumentos de `requests.Session.post` (files, data, stream, ...)
+        :return: requests.Response (incluidas respuestas con código de error)
+        :raises CircuitoAbierto: Si el circuito está abierto
+        :raises requests.RequestException: Si fallan todos los intentos
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs["headers"] = instrumentacion.cabeceras_traza(kwargs.get("headers"))
+        reintentos = self.reintentos if reintentar else 0
+        intento = 0
+        while True:
+            if not self.cortacircuitos.permitir():
+                raise CircuitoAbierto(f"Servicio {self.nombre} no disponible (circuito abierto)")
+
+            _rebobinar(kwargs.get("files"))
+            inicio = time.perf_counter()
+            try:
+                respuesta = self.sesion.post(url or self.url, **kwargs)
+            except requests.exceptions.ConnectionError:
+                # Incluye ConnectTimeout: la petición no llegó al servicio
+                instrumentacion.observar_red(self.nombre, "error", time.perf_counter() - inicio)
+                self.cortacircuitos.fallo()
+                if intento >= reintentos:
+                    raise
+            except requests.exceptions.Timeout:
+                # Un timeout de lectura no se reintenta para no duplicar carga en un servicio atascado
+                instrumentacion.observar_red(self.nombre, "timeout", time.perf_counter() - inicio)
+                self.cortacircuitos.fallo()
+                raise
+            except Exception:
+                # Error al generar el cuerpo de la petición, no del servicio
+                self.cortacircuitos.liberar()
+                raise
+            else:
+                instrumentacion.observar_red(self.nombre, respuesta.status_code, time.perf_counter() - inicio)
+                if respuesta.status_code not in CODIGOS_REINTENTABLES:
+                    self.cortacircuitos.exito()
+                    return respuesta
+                self.cortacircuitos.fallo()
+                if intento >= reintentos:
+                    return respuesta
+
+            # Espera exponencial con jitter completo antes del siguiente intento
+            time.sleep(random.uniform(0, self.backoff * (2 ** intento)))
+            intento += 1
@@ -0,0 +1,335 @@
+"""
+Cola de trabajos persistente compartida por el gateway y el motor.
+
+La cola es una base de datos sqlite en un volumen común: el gateway inserta
+los trabajos (la imagen y sus opciones) y los trabajadores del motor los
+reclaman de uno en uno, los procesan y guardan el resultado. Los clientes
+consultan el estado o esperan al resultado (long-polling) sin mantener una
+conexión abierta con el motor.
+
+* Carriles de prioridad: "alta" (peticiones síncronas), "normal" (trabajos
+  asíncronos) y "baja" (lotes). Siempre se reclama primero el trabajo más
+  antiguo de la prioridad más alta.
+* Los trabajos que llevan demasiado tiempo en curso (el trabajador murió) se
+  vuelven a poner en cola hasta `max_intentos` veces.
+* Los resultados caducan `ttl_resultados` segundos después de terminar.
+* Cada trabajo tiene un plazo para empezar (por defecto `max_espera`): si nadie
+  lo reclama antes, no se procesa, se borra la imagen y se da por terminado
+  con un 504. Las peticiones síncronas usan como plazo su propio timeout.
+* Con `max_pendientes` se limita el número de trabajos en espera: al llegar
+  al límite `encolar` lanza ColaLlena.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+PRIORIDADES = {"alta": 0, "normal": 1, "baja": 2}
+
+PENDIENTE = "pendiente"
+EN_CURSO = "en_curso"
+TERMINADO = "terminado"
+
+
+class ColaLlena(Exception):
+    """
+    La cola ya tiene el número máximo de trabajos pendientes.
+    """
+
+
+class ColaTrabajos:
+    """
+    Cola de trabajos sobre un archivo sqlite, segura entre hilos y entre procesos.
+    """
+
+    def __init__(self, ruta, ttl_resultados=3600.0, timeout_trabajo=300.0, max_intentos=3,
+                 max_espera=3600.0, max_pendientes=None):
+        """
+        :param ruta: Ruta del archivo sqlite (se crea si no existe)
+        :param ttl_resultados: Segundos que se conserva un resultado tras terminar
+        :param timeout_trabajo: Segundos en curso tras los que un trabajo se da por abandonado
+        :param max_intentos: Veces que se reclama un trabajo antes de darlo por fallido
+        :param max_espera: Segundos que puede esperar un trabajo a ser reclamado si no se indica otro plazo
+        :param max_pendientes: Número máximo de trabajos pendientes (None para no limitarlo)
+        """
+        self.ttl_resultados = float(ttl_resultados)
+        self.timeout_trabajo = float(timeout_trabajo)
+        self.max_intentos = max(int(max_intentos), 1)
+        self.max_espera = float(max_espera)
+        self.max_pendientes = None if max_pendientes is None else max(int(max_pendientes), 1)
+        self._lock = threading.Lock()
+
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA synchronous=NORMAL")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS trabajos ("
+            " id TEXT PRIMARY KEY,"
+            " prioridad INTEGER NOT NULL,"
+            " estado TEXT NOT NULL,"
+            " nombre TEXT,"
+            " tipo TEXT,"
+            " debug INTEGER NOT NULL,"
+            " datos BLOB,"
+            " creado REAL NOT NULL,"
+            " inicio REAL,"
+            " fin REAL,"
+            " intentos INTEGER NOT NULL DEFAULT 0,"
+            " trabajador TEXT,"
+            " codigo INTEGER,"
+            " tipo_resultado TEXT,"
+            " resultado BLOB,"
+            " expira REAL,"
+            " traza TEXT,"
+            " server_timing TEXT,"
+            " vence REAL)"
+        )
+        # Colas creadas por versiones anteriores, sin las columnas de la traza, los tiempos y el plazo
+        columnas = {fila[1] for fila in self._conexion.execute("PRAGMA table_info(trabajos)")}
+        for columna, tipo in (("traza", "TEXT"), ("server_timing", "TEXT"), ("vence", "REAL")):
+            if columna not in columnas:
+                self._conexion.execute(f"ALTER TABLE trabajos ADD COLUMN {columna} {tipo}")
+        self._conexion.execute("CREATE INDEX IF NOT EXISTS trabajos_cola ON trabajos (estado, prioridad, creado)")
+        self._conexion.execute("CREATE INDEX IF NOT EXISTS trabajos_expira ON trabajos (expira)")
+
+    def encolar(self, nombre, tipo, datos, debug=False, prioridad=PRIORIDADES["normal"], traza=None, plazo=None):
+        """
+        :param nombre: Nombre del archivo
+        :param tipo: Tipo MIME de la imagen
+        :param datos: Bytes de la imagen
+        :param debug: Si se pide la imagen de depuración
+        :param prioridad: Valor de PRIORIDADES (menor es más prioritario)
+        :param traza: Identificador de la traza de la petición que crea el trabajo
+        :param plazo: Segundos que puede esperar a ser reclamado (por defecto `max_espera`)
+        :return: Identificador del trabajo
+        :raises ColaLlena: Si ya hay `max_pendientes` trabajos pendientes
+        """
+        id_trabajo = uuid.uuid4().hex
+        ahora = time.time()
+        vence = ahora + (self.max_espera if plazo is None else max(float(plazo), 0.0))
+        with self._lock:
+            # El recuento y la inserción van en la misma transacción para que el límite valga entre procesos
+            self._conexion.execute("BEGIN IMMEDIATE")
+            try:
+                if self.max_pendientes is not None:
+                    pendientes = self._conexion.execute(
+                        "SELECT COUNT(*) FROM trabajos WHERE estado = ?", (PENDIENTE,)
+                    ).fetchone()[0]
+                    if pendientes >= self.max_pendientes:
+                        raise ColaLlena(f"La cola tiene {pendientes} trabajos pendientes")
+                self._conexion.execute(
+                    "INSERT INTO trabajos (id, prioridad, estado, nombre, tipo, debug, datos, creado, traza, vence)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (id_trabajo, int(prioridad), PENDIENTE, nombre, tipo, int(bool(debug)),
+                     sqlite3.Binary(datos), ahora, traza, vence)
+                )
+                self._conexion.execute("COMMIT")
+            except Exception:
+                self._conexion.execute("ROLLBACK")
+                raise
+        return id_trabajo
+
+    def cancelar(self, id_trabajo):
+        """
+        Borra un trabajo (y su imagen) si todavía no lo ha reclamado nadie.
+
+        :param id_trabajo: Identificador del trabajo
+        :return: True si se ha borrado, False si ya estaba en curso, terminado o no existe
+        """
+        with self._lock:
+            borrados = self._conexion.execute(
+                "DELETE FROM trabajos WHERE id = ? AND estado = ?", (id_trabajo, PENDIENTE)
+            ).rowcount
+        return borrados > 0
+
+    def reclamar(self, trabajador, max_prioridad=None):
+        """
+        Marca como en curso el trabajo pendiente más prioritario y lo devuelve.
+
+        :param trabajador: Identificador de quien lo reclama
+        :param max_prioridad: Si se indica, solo se reclaman trabajos con prioridad <= este valor
+        :return: Diccionario con "id", "nombre", "tipo", "debug", "datos", "prioridad" y "traza", o None
+        """
+        limite = max(PRIORIDADES.values()) if max_prioridad is None else max_prioridad
+        with self._lock:
+            # BEGIN IMMEDIATE toma el bloqueo de escritura: dos procesos no pueden reclamar el mismo trabajo
+            self._conexion.execute("BEGIN IMMEDIATE")
+            try:
+                # Los trabajos fuera de plazo no se reclaman: los cierra `mantenimiento`
+                fila = self._conexion.execute(
+                    "SELECT id, nombre, tipo, debug, datos, prioridad, traza FROM trabajos"
+                    " WHERE estado = ? AND prioridad <= ? AND (vence IS NULL OR vence >= ?)"
+                    " ORDER BY prioridad, creado LIMIT 1",
+                    (PENDIENTE, limite, time.time())
+                ).fetchone()
+                if fila is not None:
+                    self._conexion.execute(
+                        "UPDATE trabajos SET estado = ?, inicio = ?, intentos = intentos + 1, trabajador = ?"
+                        " WHERE id = ?",
+                        (EN_CURSO, time.time(), trabajador, fila[0])
+                    )
+                self._conexion.execute("COMMIT")
+            except Exception:
+                self._conexion.execute("ROLLBACK")
+                raise
+        if fila is None:
+            return None
+        return {
+            "id": fila[0], "nombre": fila[1], "tipo": fila[2],
+            "debug": bool(fila[3]), "datos": bytes(fila[4]), "prioridad": fila[5], "traza": fila[6],
+        }
+
+    def completar(self, id_trabajo, codigo, tipo_resultado, resultado, server_timing=None):
+        """
+        Guarda el resultado de un trabajo y libera la imagen de entrada.
+
+        :param id_trabajo: Identificador del trabajo
+        :param codigo: Código HTTP del resultado
+        :param tipo_resultado: Tipo MIME del resultado
+        :param resultado: Bytes del resultado
+        :param server_timing: Tiempos por etapa del trabajo (valor de la cabecera Server-Timing)
+        """
+        ahora = time.time()
+        with self._lock:
+            self._conexion.execute(
+                "UPDATE trabajos SET estado = ?, datos = NULL, fin = ?, codigo = ?, tipo_resultado = ?,"
+                " resultado = ?, expira = ?, server_timing = ? WHERE id = ? AND estado = ?",
+                (TERMINADO, ahora, int(codigo), tipo_resultado, sqlite3.Binary(resultado),
+                 ahora + self.ttl_resultados, server_timing, id_trabajo, EN_CURSO)
+            )
+
+    def obtener(self, id_trabajo):
+        """
+        :param id_trabajo: Identificador del trabajo
+        :return: Diccionario con "id", "estado", "prioridad", "posicion" (si está pendiente) y,
+            si ha terminado, "codigo", "tipo", "resultado" y "server_timing"; None si no existe o ha caducado
+        """
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT estado, prioridad, creado, codigo, tipo_resultado, resultado, expira, server_timing"
+                " FROM trabajos WHERE id = ?", (id_trabajo,)
+            ).fetchone()
+            if fila is None:
+                return None
+            estado, prioridad, creado, codigo, tipo, resultado, expira, tiempos = fila
+            if expira is not None and expira < time.time():
+                return None
+            trabajo = {"id": id_trabajo, "estado": estado, "prioridad": prioridad}
+            if estado == PENDIENTE:
+                # Trabajos que se reclamarán antes que este
+                trabajo["posicion"] = self._conexion.execute(
+                    "SELECT COUNT(*) FROM trabajos WHERE estado = ?"
+                    " AND (prioridad < ? OR (prioridad = ? AND creado < ?))",
+                    (PENDIENTE, prioridad, prioridad, creado)
+                ).fetchone()[0]
+            elif estado == TERMINADO:
+                trabajo.update({
+                    "codigo": codigo, "tipo": tipo, "resultado": bytes(resultado), "server_timing": tiempos
+                })
+        return trabajo
+
+    def esperar(self, id_trabajo, timeout, intervalo_max=0.1):
+        """
+        Espera a que el trabajo termine consultando la cola con una espera creciente.
+
+        :param id_trabajo: Identificador del trabajo
+        :param timeout: Segundos máximos de espera
+        :param intervalo_max: Espera máxima entre consultas
+        :return: El trabajo (como en `obtener`), terminado o no, o None si no existe
+        """
+        limite = time.monotonic() + max(float(timeout), 0.0)
+        intervalo = 0.005
+        while True:
+            trabajo = self.obtener(id_trabajo)
+            if trabajo is None or trabajo["estado"] == TERMINADO:
+                return trabajo
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return trabajo
+            time.sleep(min(intervalo, restante))
+            intervalo = min(intervalo * 2, intervalo_max)
+
+    def mantenimiento(self):
+        """
+        Devuelve a la cola los trabajos abandonados, da por fallidos los que
+        agotaron sus intentos, cierra (borrando la imagen) los pendientes que
+        han superado su plazo y borra los resultados caducados.
+
+        :return: Diccionario con "reencolados", "fallidos", "vencidos" y "caducados"
+        """
+        ahora = time.time()
+        abandonado = ahora - self.timeout_trabajo
+        with self._lock:
+            reencolados = self._conexion.execute(
+                "UPDATE trabajos SET estado = ?, inicio = NULL, trabajador = NULL"
+                " WHERE estado = ? AND inicio < ? AND intentos < ?",
+                (PENDIENTE, EN_CURSO, abandonado, self.max_intentos)
+            ).rowcount
+            fallidos = self._conexion.execute(
+                "UPDATE trabajos SET estado = ?, datos = NULL, fin = ?, codigo = 500,"
+                " tipo_resultado = 'application/json', resultado = ?, expira = ?"
+                " WHERE estado = ? AND inicio < ?",
+                (TERMINADO, ahora, b'{"error": "El trabajo ha agotado sus intentos"}',
+                 ahora + self.ttl_resultados, EN_CURSO, abandonado)
+            ).rowcount
+            # Los trabajos de colas anteriores no tienen plazo: se cuenta `max_espera` desde su creación
+            vencidos = self._conexion.execute(
+                "UPDATE trabajos SET estado = ?, datos = NULL, fin = ?, codigo = 504,"
+                " tipo_resultado = 'application/json', resultado = ?, expira = ?"
+                " WHERE estado = ? AND COALESCE(vence, creado + ?) < ?",
+                (TERMINADO, ahora, b'{"error": "El trabajo no se ha empezado a tiempo"}',
+                 ahora + self.ttl_resultados, PENDIENTE, self.max_espera, ahora)
+            ).rowcount
+            caducados = self._conexion.execute(
+                "DELETE FROM trabajos WHERE expira IS NOT NULL AND expira < ?", (ahora,)
+            ).rowcount
+        return {
+            "reencolados": max(reencolados, 0), "fallidos": max(fallidos, 0),
+            "vencidos": max(vencidos, 0), "caducados": max(caducados, 0),
+        }
+
+    def estadisticas(self):
+        """
+        :return: Número de trabajos por estado y, para los pendientes, por carril de prioridad
+        """
+        nombres = {v: k for k, v in PRIORIDADES.items()}
+        with self._lock:
+            filas = self._conexion.execute(
+                "SELECT estado, prioridad, COUNT(*) FROM trabajos GROUP BY estado, prioridad"
+            ).fetchall()
+        estados = {PENDIENTE: 0, EN_CURSO: 0, TERMINADO: 0}
+        pendientes = {nombre: 0 for nombre in PRIORIDADES}
+        for estado, prioridad, total in filas:
+            estados[estado] = estados.get(estado, 0) + total
+            if estado == PENDIENTE:
+                pendientes[nombres.get(prioridad, str(prioridad))] = total
+        return {**estados, "pendientes_por_prioridad": pendientes}
+
+
+def crear_cola_desde_entorno():
+    """
+    Crea la cola según las variables de entorno:
+
+    * `COLA_RUTA`: archivo sqlite de la cola (en un volumen compartido)
+    * `TRABAJOS_TTL_S`: segundos que se conserva cada resultado (3600 por defecto)
+    * `TRABAJOS_TIMEOUT_S`: segundos en curso tras los que un trabajo se reintenta (300 por defecto)
+    * `TRABAJOS_MAX_INTENTOS`: intentos por trabajo (3 por defecto)
+    * `TRABAJOS_MAX_ESPERA_COLA_S`: segundos que un trabajo asíncrono puede esperar a
+      ser reclamado antes de descartarse (3600 por defecto)
+    * `TRABAJOS_MAX_PENDIENTES`: trabajos pendientes como máximo (1000 por defecto, 0 sin límite)
+
+    :return: ColaTrabajos
+    """
+    max_pendientes = int(os.environ.get("TRABAJOS_MAX_PENDIENTES", "1000"))
+    return ColaTrabajos(
+        os.environ.get("COLA_RUTA", "/cola/trabajos.sqlite"),
+        ttl_resultados=float(os.environ.get("TRABAJOS_TTL_S", "3600")),
+        timeout_trabajo=float(os.environ.get("TRABAJOS_TIMEOUT_S", "300")),
+        max_intentos=int(os.environ.get("TRABAJOS_MAX_INTENTOS", "3")),
+        max_espera=float(os.environ.get("TRABAJOS_MAX_ESPERA_COLA_S", "3600")),
+        max_pendientes=max_pendientes if max_pendientes > 0 else None,
+    )
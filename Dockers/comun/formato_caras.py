@@ -0,0 +1,53 @@
+"""
+Formato binario para enviar lotes de caras sin comprimir entre servicios.
+
+El cuerpo es una cabecera fija seguida de los píxeles de las N caras como un
+único array uint8 de NxAltoxAnchoxCanales en orden C (BGR, como OpenCV):
+
+    magia (4 bytes, b"CAR1") | n (uint32) | alto (uint16) | ancho (uint16) | canales (uint8)
+
+Todos los enteros van en little-endian.
+"""
+import struct
+
+import numpy as np
+
+MAGIA = b"CAR1"
+CABECERA = struct.Struct("<4sIHHB")
+TIPO_CONTENIDO = "application/x-caras-uint8"
+
+
+def empaquetar(caras):
+    """
+    Empaqueta un lote de caras del mismo tamaño.
+
+    :param caras: Array uint8 de NxAltoxAnchoxCanales (o lista de arrays del mismo tamaño)
+    :return: Bytes con la cabecera y los píxeles
+    """
+    lote = np.ascontiguousarray(caras, dtype=np.uint8)
+    if lote.ndim != 4:
+        raise ValueError("El lote de caras debe tener forma NxAltoxAnchoxCanales")
+    n, alto, ancho, canales = lote.shape
+    return CABECERA.pack(MAGIA, n, alto, ancho, canales) + lote.tobytes()
+
+
+def desempaquetar(datos, max_caras=None):
+    """
+    Recupera el lote de caras de un cuerpo binario, sin copiar los píxeles.
+
+    :param datos: Bytes recibidos
+    :param max_caras: Número máximo de caras admitido (opcional)
+    :return: Array uint8 de solo lectura con forma NxAltoxAnchoxCanales
+    :raises ValueError: Si la cabecera o el tamaño no son válidos
+    """
+    if len(datos) < CABECERA.size:
+        raise ValueError("Cuerpo demasiado corto para contener la cabecera")
+    magia, n, alto, ancho, canales = CABECERA.unpack_from(datos)
+    if magia != MAGIA:
+        raise ValueError("Cabecera no válida")
+    if max_caras is not None and n > max_caras:
+        raise ValueError(f"Se admiten como máximo {max_caras} caras por petición")
+    esperado = CABECERA.size + n * alto * ancho * canales
+    if len(datos) != esperado:
+        raise ValueError(f"Tamaño incorrecto: se esperaban {esperado} bytes y se recibieron {len(datos)}")
+    return np.frombuffer(datos, dtype=np.uint8, offset=CABECERA.size).reshape(n, alto, ancho, canales)
@@ -0,0 +1,94 @@
+"""
+Formato binario para enviar regiones de una imagen (parches) sin comprimir entre servicios.
+
+Cada parche es un recorte rectangular de la imagen con los rectángulos que
+hay que pixelar dentro de él (en coordenadas del parche). El cuerpo es:
+
+    magia (4 bytes, b"PAR1") | n parches (uint32) | canales (uint8)
+    por cada parche:        alto (uint32) | ancho (uint32) | rectángulos (uint16)
+    por cada rectángulo:    x (int32) | y (int32) | w (int32) | h (int32)
+    píxeles de todos los parches, uno tras otro (uint8, orden C, BGR como OpenCV)
+
+Todos los enteros van en little-endian. La respuesta tiene exactamente el
+mismo formato y tamaño, con los píxeles ya procesados, así que el servicio
+puede modificar el cuerpo recibido en el sitio y devolverlo.
+"""
+import struct
+
+import numpy as np
+
+MAGIA = b"PAR1"
+CABECERA = struct.Struct("<4sIB")
+PARCHE = struct.Struct("<IIH")
+RECTANGULO = struct.Struct("<iiii")
+TIPO_CONTENIDO = "application/x-parches-uint8"
+
+
+def empaquetar(parches, rectangulos):
+    """
+    :param parches: Lista de arrays uint8 de AltoxAnchoxCanales (todos con los mismos canales)
+    :param rectangulos: Lista, por parche, de rectángulos (x, y, w, h) relativos al parche
+    :return: Bytes con las cabeceras y los píxeles
+    """
+    if len(parches) != len(rectangulos):
+        raise ValueError("Debe haber una lista de rectángulos por parche")
+    canales = parches[0].shape[2] if parches else 3
+    partes = [CABECERA.pack(MAGIA, len(parches), canales)]
+    for parche, rects in zip(parches, rectangulos):
+        if parche.ndim != 3 or parche.shape[2] != canales:
+            raise ValueError("Todos los parches deben tener forma AltoxAnchoxCanales con los mismos canales")
+        partes.append(PARCHE.pack(parche.shape[0], parche.shape[1], len(rects)))
+    for rects in rectangulos:
+        partes.extend(RECTANGULO.pack(*(int(v) for v in r)) for r in rects)
+    partes.extend(np.ascontiguousarray(parche, dtype=np.uint8).tobytes() for parche in parches)
+    return b"".join(partes)
+
+
+def desempaquetar(datos, max_parches=None, max_pixeles=None):
+    """
+    Recupera los parches de un cuerpo binario sin copiar los píxeles. Si `datos`
+    es un `bytearray`, los parches se pueden modificar en el sitio.
+
+    :param datos: Bytes recibidos
+    :param max_parches: Número máximo de parches admitido (opcional)
+    :param max_pixeles: Número máximo de píxeles entre todos los parches (opcional)
+    :return: Tupla (lista de arrays AltoxAnchoxCanales, lista de listas de rectángulos)
+    :raises ValueError: Si las cabeceras o el tamaño no son válidos
+    """
+    if len(datos) < CABECERA.size:
+        raise ValueError("Cuerpo demasiado corto para contener la cabecera")
+    magia, n, canales = CABECERA.unpack_from(datos)
+    if magia != MAGIA:
+        raise ValueError("Cabecera no válida")
+    if max_parches is not None and n > max_parches:
+        raise ValueError(f"Se admiten como máximo {max_parches} parches por petición")
+
+    desplazamiento = CABECERA.size
+    if len(datos) < desplazamiento + n * PARCHE.size:
+        raise ValueError("Cuerpo demasiado corto para contener las cabeceras de los parches")
+    formas = []
+    for _ in range(n):
+        alto, ancho, n_rects = PARCHE.unpack_from(datos, desplazamiento)
+        formas.append((alto, ancho, n_rects))
+        desplazamiento += PARCHE.size
+
+    pixeles = sum(alto * ancho for alto, ancho, _ in formas)
+    if max_pixeles is not None and pixeles > max_pixeles:
+        raise ValueError(f"Los parches superan el máximo de {max_pixeles} píxeles")
+    esperado = desplazamiento + sum(r for _, _, r in formas) * RECTANGULO.size + pixeles * canales
+    if len(datos) != esperado:
+        raise ValueError(f"Tamaño incorrecto: se esperaban {esperado} bytes y se recibieron {len(datos)}")
+
+    rectangulos = []
+    for _, _, n_rects in formas:
+        rectangulos.append([RECTANGULO.unpack_from(datos, desplazamiento + i * RECTANGULO.size) for i in range(n_rects)])
+        desplazamiento += n_rects * RECTANGULO.size
+
+    parches = []
+    for alto, ancho, _ in formas:
+        tamano = alto * ancho * canales
+        parches.append(
+            np.frombuffer(datos, dtype=np.uint8, count=tamano, offset=desplazamiento).reshape(alto, ancho, canales)
+        )
+        desplazamiento += tamano
+    return parches, rectangulos
@@ -0,0 +1,44 @@
+"""
+Configuración de gunicorn común a todos los servicios.
+
+Se copia como /app/gunicorn.conf.py en cada imagen y se ajusta con variables
+de entorno:
+
+* `PUERTO`: puerto en el que escucha el servicio
+* `GUNICORN_WORKERS`: procesos worker
+* `GUNICORN_THREADS`: hilos por worker (con más de uno se usa el worker "gthread")
+* `GUNICORN_PRELOAD`: si la aplicación (y sus modelos) se carga en el proceso
+  maestro antes de crear los workers, que la comparten copia-en-escritura.
+  TensorFlow no es seguro tras un fork, así que los servicios con modelos de
+  TensorFlow lo dejan desactivado y cargan el modelo en cada worker.
+* `GUNICORN_TIMEOUT`: segundos sin respuesta tras los que se reinicia un worker
+* `GUNICORN_GRACEFUL_TIMEOUT`: segundos para terminar las peticiones en curso al detenerse
+* `METRICAS_DIR`: directorio en el que los workers vuelcan sus métricas (ver instrumentacion.py)
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PUERTO', '8000')}"
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+worker_class = "gthread" if threads > 1 else "sync"
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    # Las métricas volcadas por los workers de una ejecución anterior no se suman a las nuevas
+    directorio = os.environ.get("METRICAS_DIR")
+    if directorio and os.path.isdir(directorio):
+        for nombre in os.listdir(directorio):
+            if nombre.endswith(".json"):
+                os.remove(os.path.join(directorio, nombre))
+
+
+def worker_exit(server, worker):
+    # Cierre ordenado de la aplicación (p. ej. los trabajadores de la cola del Engine)
+    import servicio
+    servicio.cerrar()
@@ -0,0 +1,520 @@
+"""
+Instrumentación compartida por los servicios: histogramas de tiempo por etapa,
+endpoint Prometheus, identificador de traza propagado entre servicios y
+perfilado de peticiones por muestreo.
+
+* `registrar(app, nombre)` añade `GET /metrics` (formato de texto de
+  Prometheus) y mide cada petición: histograma por ruta y código, cabecera
+  `X-Request-Id` y cabecera `Server-Timing` con las etapas de la petición.
+* `medir("etapa")` mide un bloque: lo suma al histograma de etapas del
+  proceso y a la traza de la petición en curso.
+* El identificador de traza llega en la cabecera `X-Request-Id` (si no, se
+  genera) y `cliente_http` lo reenvía en todas las llamadas internas, junto
+  con el tiempo de espera de red de cada una. Así todas las líneas de log de
+  una imagen comparten el mismo identificador en todos los servicios.
+* Las tareas que se lanzan en otros hilos deben envolverse con `en_traza`
+  para que sigan anotando en la traza de la petición.
+
+Variables de entorno:
+
+* `METRICAS_DIR`: directorio en el que cada worker de gunicorn vuelca sus
+  métricas para que `/metrics` devuelva la suma de todos (sin definir, cada
+  worker publica solo las suyas)
+* `METRICAS_INTERVALO_S`: segundos entre volcados (5 por defecto)
+* `TRAZAS_LOG`: `todas`, `lentas` (por defecto) o `ninguna`; escribe una línea
+  JSON por petición con su traza y sus etapas
+* `TRAZAS_UMBRAL_LENTO_MS`: duración a partir de la cual una petición es lenta (1000)
+* `PERFILADO_MUESTREO`: fracción de peticiones que se perfilan con cProfile (0 por defecto)
+* `PERFILADO_CABECERA`: si la cabecera `X-Perfilar: 1` fuerza el perfilado (false)
+* `PERFILADO_DIR`: directorio de los archivos `.prof` (/tmp/perfiles)
+"""
+import bisect
+import contextvars
+import cProfile
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+import servicio
+
+CABECERA_TRAZA = "X-Request-Id"
+
+# Límites superiores (segundos) de los cubos de los histogramas
+CUBOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRICAS_DIR = os.environ.get("METRICAS_DIR", "")
+METRICAS_INTERVALO_S = float(os.environ.get("METRICAS_INTERVALO_S", "5"))
+TRAZAS_LOG = os.environ.get("TRAZAS_LOG", "lentas").lower()
+TRAZAS_UMBRAL_LENTO_MS = float(os.environ.get("TRAZAS_UMBRAL_LENTO_MS", "1000"))
+PERFILADO_MUESTREO = float(os.environ.get("PERFILADO_MUESTREO", "0"))
+PERFILADO_CABECERA = os.environ.get("PERFILADO_CABECERA", "false").lower() == "true"
+PERFILADO_DIR = os.environ.get("PERFILADO_DIR", "/tmp/perfiles")
+
+# Rutas que no se escriben en el log de trazas
+RUTAS_SILENCIOSAS = {"/metrics", "/listo", "/"}
+
+_ID_VALIDO = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+_NO_TOKEN = re.compile(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]")
+
+_histogramas = []
+_indicadores = {}
+_nombre_servicio = os.environ.get("SERVICIO", "")
+_lock = threading.Lock()
+
+
+class Histograma:
+    """
+    Familia de histogramas acumulativos con las mismas etiquetas (como un Histogram de Prometheus).
+    """
+
+    def __init__(self, nombre, descripcion, etiquetas=(), cubos=CUBOS):
+        """
+        :param nombre: Nombre de la métrica
+        :param descripcion: Texto de ayuda
+        :param etiquetas: Nombres de las etiquetas de cada serie
+        :param cubos: Límites superiores de los cubos (segundos)
+        """
+        self.nombre = nombre
+        self.descripcion = descripcion
+        self.etiquetas = tuple(etiquetas)
+        self.cubos = tuple(cubos)
+        # valores de las etiquetas -> [cuentas por cubo (el último es +Inf), suma]
+        self._series = {}
+        self._lock = threading.Lock()
+        with _lock:
+            _histogramas.append(self)
+
+    def observar(self, valor, *valores_etiquetas):
+        """
+        :param valor: Valor observado (segundos)
+        :param valores_etiquetas: Valores de las etiquetas, en el orden de `etiquetas`
+        """
+        indice = bisect.bisect_left(self.cubos, valor)
+        clave = tuple(str(v) for v in valores_etiquetas)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [[0] * (len(self.cubos) + 1), 0.0]
+            serie[0][indice] += 1
+            serie[1] += valor
+
+    def series(self):
+        """
+        :return: Lista de tuplas (valores de etiquetas, cuentas por cubo, suma)
+        """
+        with self._lock:
+            return [(clave, list(cuentas), suma) for clave, (cuentas, suma) in self._series.items()]
+
+
+ETAPAS = Histograma("pixelar_etapa_segundos", "Duración de cada etapa del procesamiento", ("etapa",))
+RED = Histograma("pixelar_espera_red_segundos", "Espera de las llamadas a otros servicios", ("destino", "codigo"))
+PETICIONES = Histograma("pixelar_peticion_segundos", "Duración de las peticiones atendidas", ("ruta", "metodo", "codigo"))
+
+
+def registrar_indicador(nombre, descripcion, funcion):
+    """
+    Publica en /metrics un valor instantáneo (gauge) que se calcula al consultarlo.
+
+    :param nombre: Nombre de la métrica
+    :param descripcion: Texto de ayuda
+    :param funcion: Función sin argumentos que devuelve un número
+    """
+    with _lock:
+        _indicadores[nombre] = (descripcion, funcion)
+
+
+class Traza:
+    """
+    Identificador y tiempos por etapa de una petición (o de un trabajo de la cola).
+    """
+
+    def __init__(self, id_traza=None):
+        self.id = id_traza if id_traza and _ID_VALIDO.match(id_traza) else uuid.uuid4().hex
+        self.inicio = time.perf_counter()
+        self.tramos = {}
+        self._lock = threading.Lock()
+
+    def anotar(self, etapa, segundos):
+        with self._lock:
+            self.tramos[etapa] = self.tramos.get(etapa, 0.0) + segundos
+
+    def copia_tramos(self):
+        with self._lock:
+            return dict(self.tramos)
+
+
+_traza = contextvars.ContextVar("traza", default=None)
+
+
+def traza_actual():
+    """
+    :return: Traza en curso en este contexto, o None
+    """
+    return _traza.get()
+
+
+def id_traza():
+    """
+    :return: Identificador de la traza en curso, o None
+    """
+    traza = _traza.get()
+    return traza.id if traza is not None else None
+
+
+@contextmanager
+def nueva_traza(id_traza=None):
+    """
+    Abre una traza para el bloque (p. ej. un trabajo de la cola, fuera de una petición HTTP).
+
+    :param id_traza: Identificador recibido (si no es válido se genera uno)
+    :return: La Traza
+    """
+    traza = Traza(id_traza)
+    token = _traza.set(traza)
+    try:
+        yield traza
+    finally:
+        _traza.reset(token)
+
+
+def en_traza(funcion):
+    """
+    Envuelve una función para ejecutarla en otro hilo dentro de la traza actual.
+    Cada envoltura se debe ejecutar una sola vez.
+
+    :param funcion: Función a ejecutar
+    :return: Función con el contexto actual capturado
+    """
+    contexto = contextvars.copy_context()
+
+    def envoltura(*args, **kwargs):
+        return contexto.run(funcion, *args, **kwargs)
+    return envoltura
+
+
+def observar(etapa, segundos):
+    """
+    :param etapa: Nombre de la etapa
+    :param segundos: Duración
+    """
+    ETAPAS.observar(segundos, etapa)
+    traza = _traza.get()
+    if traza is not None:
+        traza.anotar(etapa, segundos)
+
+
+@contextmanager
+def medir(etapa):
+    """
+    Mide la duración del bloque como la etapa `etapa`.
+
+    :param etapa: Nombre de la etapa
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar(etapa, time.perf_counter() - inicio)
+
+
+def observar_red(destino, codigo, segundos):
+    """
+    Anota el tiempo de espera de una llamada a otro servicio.
+
+    :param destino: Nombre del servicio llamado
+    :param codigo: Código HTTP de la respuesta o "error"
+    :param segundos: Duración de la llamada
+    """
+    RED.observar(segundos, destino, codigo)
+    traza = _traza.get()
+    if traza is not None:
+        traza.anotar(f"red_{destino}", segundos)
+
+
+def cabeceras_traza(cabeceras=None):
+    """
+    :param cabeceras: Cabeceras de una petición saliente (se copian)
+    :return: Las cabeceras con el identificador de la traza en curso
+    """
+    cabeceras = dict(cabeceras or {})
+    traza = _traza.get()
+    if traza is not None:
+        cabeceras.setdefault(CABECERA_TRAZA, traza.id)
+    return cabeceras
+
+
+def server_timing(tramos):
+    """
+    :param tramos: Diccionario etapa -> segundos
+    :return: Valor de la cabecera Server-Timing (duraciones en milisegundos)
+    """
+    return ", ".join(f"{_NO_TOKEN.sub('_', etapa)};dur={segundos * 1000.0:.2f}" for etapa, segundos in tramos.items())
+
+
+def finalizar(traza, ruta, metodo, codigo):
+    """
+    Cierra una traza: observa la duración total y la escribe en el log si corresponde.
+
+    :param traza: Traza a cerrar
+    :param ruta: Ruta o tipo de trabajo
+    :param metodo: Método HTTP (o "cola")
+    :param codigo: Código HTTP del resultado
+    :return: Duración en segundos
+    """
+    duracion = time.perf_counter() - traza.inicio
+    PETICIONES.observar(duracion, ruta, metodo, codigo)
+    if ruta in RUTAS_SILENCIOSAS or TRAZAS_LOG == "ninguna":
+        return duracion
+    if TRAZAS_LOG == "todas" or duracion * 1000.0 >= TRAZAS_UMBRAL_LENTO_MS:
+        print(json.dumps({
+            "traza": traza.id,
+            "servicio": _nombre_servicio,
+            "ruta": ruta,
+            "codigo": codigo,
+            "duracion_ms": round(duracion * 1000.0, 2),
+            "etapas_ms": {k: round(v * 1000.0, 2) for k, v in traza.copia_tramos().items()},
+        }), flush=True)
+    return duracion
+
+
+# cProfile no admite dos perfiles activos a la vez: como mucho una petición perfilada por proceso
+_lock_perfil = threading.Lock()
+
+
+def _iniciar_perfil():
+    forzado = PERFILADO_CABECERA and request.headers.get("X-Perfilar") == "1"
+    if not forzado and (PERFILADO_MUESTREO <= 0 or random.random() >= PERFILADO_MUESTREO):
+        return None
+    if not _lock_perfil.acquire(blocking=False):
+        return None
+    perfil = cProfile.Profile()
+    try:
+        perfil.enable()
+    except ValueError:
+        # Otra herramienta de perfilado ya está activa
+        _lock_perfil.release()
+        return None
+    return perfil
+
+
+def _terminar_perfil(perfil, traza):
+    try:
+        perfil.disable()
+        os.makedirs(PERFILADO_DIR, exist_ok=True)
+        ruta = os.path.join(PERFILADO_DIR, f"{_nombre_servicio or 'servicio'}-{traza.id}.prof")
+        perfil.dump_stats(ruta)
+        return ruta
+    except Exception as e:
+        print("No se pudo guardar el perfil:", e)
+        return None
+    finally:
+        _lock_perfil.release()
+
+
+_volcado = {"pid": None, "archivo": None}
+
+
+def _instantanea():
+    with _lock:
+        histogramas = list(_histogramas)
+        indicadores = dict(_indicadores)
+    valores = {}
+    for nombre, (_, funcion) in indicadores.items():
+        try:
+            valores[nombre] = float(funcion())
+        except Exception:
+            pass
+    return {
+        "pid": os.getpid(),
+        "histogramas": {h.nombre: [[list(c), cuentas, suma] for c, cuentas, suma in h.series()] for h in histogramas},
+        "indicadores": valores,
+    }
+
+
+def _volcar():
+    # Escritura atómica de las métricas de este proceso en METRICAS_DIR
+    if not METRICAS_DIR or _volcado["archivo"] is None:
+        return
+    temporal = _volcado["archivo"] + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(_instantanea(), f)
+    os.replace(temporal, _volcado["archivo"])
+
+
+def _asegurar_volcado():
+    # Se arranca en la primera petición de cada proceso (también tras un fork de gunicorn)
+    if not METRICAS_DIR or _volcado["pid"] == os.getpid():
+        return
+    with _lock:
+        if _volcado["pid"] == os.getpid():
+            return
+        os.makedirs(METRICAS_DIR, exist_ok=True)
+        _volcado["pid"] = os.getpid()
+        _volcado["archivo"] = os.path.join(METRICAS_DIR, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+
+    def bucle():
+        while True:
+            time.sleep(METRICAS_INTERVALO_S)
+            try:
+                _volcar()
+            except Exception as e:
+                print("No se pudieron volcar las métricas:", e)
+
+    threading.Thread(target=bucle, name="volcado-metricas", daemon=True).start()
+    servicio.registrar_cierre(_volcar)
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _instantaneas():
+    propia = _instantanea()
+    if not METRICAS_DIR or not os.path.isdir(METRICAS_DIR):
+        return [propia]
+    instantaneas = [propia]
+    for nombre in os.listdir(METRICAS_DIR):
+        ruta = os.path.join(METRICAS_DIR, nombre)
+        if not nombre.endswith(".json") or ruta == _volcado["archivo"]:
+            continue
+        try:
+            with open(ruta, encoding="utf-8") as f:
+                instantanea = json.load(f)
+        except (OSError, ValueError):
+            continue
+        # Los histogramas de los workers que ya han terminado se conservan (son acumulados),
+        # sus valores instantáneos no
+        if not _proceso_vivo(instantanea.get("pid", 0)):
+            instantanea["indicadores"] = {}
+        instantaneas.append(instantanea)
+    return instantaneas
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas(nombres, valores, extra=()):
+    pares = [("servicio", _nombre_servicio)] + list(zip(nombres, valores)) + list(extra)
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in pares) + "}"
+
+
+def exportar():
+    """
+    :return: Métricas de todos los workers en el formato de texto de Prometheus
+    """
+    instantaneas = _instantaneas()
+    lineas = []
+    with _lock:
+        histogramas = list(_histogramas)
+        indicadores = dict(_indicadores)
+
+    for histograma in histogramas:
+        sumadas = {}
+        for instantanea in instantaneas:
+            for clave, cuentas, suma in instantanea["histogramas"].get(histograma.nombre, []):
+                clave = tuple(clave)
+                actual = sumadas.setdefault(clave, [[0] * len(cuentas), 0.0])
+                actual[0] = [a + b for a, b in zip(actual[0], cuentas)]
+                actual[1] += suma
+        lineas.append(f"# HELP {histograma.nombre} {histograma.descripcion}")
+        lineas.append(f"# TYPE {histograma.nombre} histogram")
+        for clave, (cuentas, suma) in sorted(sumadas.items()):
+            acumulado = 0
+            for limite, cuenta in zip(list(histograma.cubos) + ["+Inf"], cuentas):
+                acumulado += cuenta
+                le = limite if limite == "+Inf" else f"{limite:g}"
+                lineas.append(f"{histograma.nombre}_bucket{_etiquetas(histograma.etiquetas, clave, [('le', le)])} {acumulado}")
+            lineas.append(f"{histograma.nombre}_sum{_etiquetas(histograma.etiquetas, clave)} {suma:.6f}")
+            lineas.append(f"{histograma.nombre}_count{_etiquetas(histograma.etiquetas, clave)} {acumulado}")
+
+    for nombre, (descripcion, _) in sorted(indicadores.items()):
+        valores = [i["indicadores"][nombre] for i in instantaneas if nombre in i["indicadores"]]
+        if not valores:
+            continue
+        lineas.append(f"# HELP {nombre} {descripcion}")
+        lineas.append(f"# TYPE {nombre} gauge")
+        lineas.append(f"{nombre}{_etiquetas((), ())} {sum(valores):g}")
+    return "\n".join(lineas) + "\n"
+
+
+_en_curso = [0]
+
+
+def registrar(app, nombre):
+    """
+    Instrumenta una aplicación Flask y añade el endpoint `GET /metrics`.
+
+    :param app: Aplicación Flask
+    :param nombre: Nombre del servicio (etiqueta `servicio` de todas las métricas)
+    """
+    global _nombre_servicio
+    # En modo monolito el motor importa los módulos de los otros servicios: se queda el primer nombre
+    if not _nombre_servicio:
+        _nombre_servicio = nombre
+    registrar_indicador("pixelar_peticiones_en_curso", "Peticiones HTTP en curso", lambda: _en_curso[0])
+
+    @app.before_request
+    def _antes():
+        _asegurar_volcado()
+        traza = Traza(request.headers.get(CABECERA_TRAZA))
+        g.instrumentacion = (traza, _traza.set(traza), _iniciar_perfil())
+        with _lock:
+            _en_curso[0] += 1
+
+    @app.after_request
+    def _despues(respuesta):
+        estado = g.get("instrumentacion")
+        if estado is None:
+            return respuesta
+        traza, token, perfil = estado
+        if perfil is not None:
+            g.instrumentacion = (traza, token, None)
+            ruta_perfil = _terminar_perfil(perfil, traza)
+            if ruta_perfil:
+                respuesta.headers["X-Perfil"] = os.path.basename(ruta_perfil)
+        ruta = request.url_rule.rule if request.url_rule is not None else "desconocida"
+        duracion = finalizar(traza, ruta, request.method, respuesta.status_code)
+
+        respuesta.headers[CABECERA_TRAZA] = traza.id
+        tramos = traza.copia_tramos()
+        if tramos:
+            tramos[f"{nombre}_total"] = duracion
+            # Se añaden a las etapas que ya traiga la respuesta (p. ej. las del motor reenviadas por el gateway)
+            previa = respuesta.headers.get("Server-Timing")
+            propia = server_timing(tramos)
+            respuesta.headers["Server-Timing"] = f"{previa}, {propia}" if previa else propia
+        return respuesta
+
+    @app.teardown_request
+    def _final(_error):
+        estado = g.pop("instrumentacion", None)
+        if estado is None:
+            return
+        _, token, perfil = estado
+        if perfil is not None:
+            # after_request no llegó a ejecutarse
+            try:
+                perfil.disable()
+            finally:
+                _lock_perfil.release()
+        with _lock:
+            _en_curso[0] -= 1
+        _traza.reset(token)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(exportar(), mimetype="text/plain; version=0.0.4")
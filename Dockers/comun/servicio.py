@@ -0,0 +1,104 @@
+"""
+Estado de preparación y cierre ordenado compartidos por los servicios.
+
+Cada servicio declara con `requerir` los componentes que deben estar listos
+antes de recibir tráfico (por ejemplo, un modelo cargado y calentado) y los
+marca con `marcar_listo` al terminar. `GET /listo` responde 200 solo cuando
+no queda ninguno pendiente; `GET /` sigue indicando únicamente que el proceso
+está vivo.
+
+Con `fijar_version` cada componente registra la configuración de la que
+dependen sus resultados (modelo, umbrales, ...). `GET /listo` devuelve su
+huella en "version", que el Engine usa en la clave de su caché de resultados.
+
+Las funciones registradas con `registrar_cierre` se ejecutan cuando gunicorn
+detiene el worker (ver gunicorn.conf.py), antes de que el intérprete termine.
+"""
+import hashlib
+import json
+import threading
+
+from flask import jsonify
+
+_pendientes = set()
+_al_cerrar = []
+_versiones = {}
+_lock = threading.Lock()
+
+
+def requerir(componente):
+    """
+    :param componente: Nombre del componente que debe estar listo para recibir tráfico
+    """
+    with _lock:
+        _pendientes.add(componente)
+
+
+def marcar_listo(componente):
+    """
+    :param componente: Nombre del componente que ya está listo
+    """
+    with _lock:
+        _pendientes.discard(componente)
+
+
+def pendientes():
+    """
+    :return: Lista ordenada de los componentes que aún no están listos
+    """
+    with _lock:
+        return sorted(_pendientes)
+
+
+def fijar_version(componente, configuracion):
+    """
+    :param componente: Nombre del componente
+    :param configuracion: Diccionario serializable en JSON con todo lo que cambia sus resultados
+    """
+    with _lock:
+        _versiones[componente] = configuracion
+
+
+def version():
+    """
+    :return: Huella SHA-256 de las configuraciones registradas con `fijar_version`
+    """
+    with _lock:
+        texto = json.dumps(_versiones, sort_keys=True, default=str)
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+
+def registrar_listo(app):
+    """
+    Añade el endpoint de preparación `GET /listo` a la aplicación.
+
+    :param app: Aplicación Flask
+    """
+    @app.route("/listo", methods=["GET"])
+    def listo():
+        faltan = pendientes()
+        if faltan:
+            return jsonify({"listo": False, "pendientes": faltan}), 503
+        return jsonify({"listo": True, "version": version()}), 200
+
+
+def registrar_cierre(funcion):
+    """
+    :param funcion: Función sin argumentos que se ejecuta al detener el proceso
+    """
+    with _lock:
+        _al_cerrar.append(funcion)
+
+
+def cerrar():
+    """
+    Ejecuta las funciones de cierre en orden inverso al de registro.
+    """
+    with _lock:
+        funciones = list(reversed(_al_cerrar))
+        _al_cerrar.clear()
+    for funcion in funciones:
+        try:
+            funcion()
+        except Exception as e:
+            print("Error en el cierre:", e)
@@ -0,0 +1,182 @@
+"""
+Validación de imágenes compartida por los servicios.
+
+Antes de decodificar se comprueba el tamaño del archivo, se identifica el
+formato por sus bytes mágicos y se leen las dimensiones de la cabecera, de
+modo que una imagen con demasiados píxeles (bomba de descompresión) se
+rechaza antes de reservar memoria. Después la imagen se decodifica una sola
+vez y el array resultante es el que usa el servicio.
+"""
+import os
+import struct
+
+import cv2
+import numpy as np
+
+# Límites por defecto (configurables con variables de entorno en cada servicio)
+MAX_BYTES = int(float(os.environ.get("MAX_MB_ARCHIVO", "10")) * 1024 * 1024)
+MAX_PIXELES = int(float(os.environ.get("MAX_MEGAPIXELES", "100")) * 1_000_000)
+
+# Marcadores JPEG SOF (Start Of Frame) que contienen las dimensiones
+_MARCADORES_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def detectar_formato(datos):
+    """
+    Identifica el formato de imagen por sus bytes mágicos.
+
+    :param datos: Bytes del archivo
+    :return: "jpeg", "png", "gif", "bmp", "webp" o None si no se reconoce
+    """
+    if datos[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if datos[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if datos[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if datos[:2] == b"BM":
+        return "bmp"
+    if datos[:4] == b"RIFF" and datos[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def _dimensiones_jpeg(datos):
+    i = 2
+    n = len(datos)
+    while i + 4 <= n:
+        if datos[i] != 0xFF:
+            raise ValueError("Estructura JPEG no válida")
+        marcador = datos[i + 1]
+        # Bytes de relleno entre marcadores
+        if marcador == 0xFF:
+            i += 1
+            continue
+        # Marcadores sin segmento (RSTn, TEM)
+        if 0xD0 <= marcador <= 0xD7 or marcador == 0x01:
+            i += 2
+            continue
+        if marcador in (0xD9, 0xDA):
+            break
+        longitud = struct.unpack(">H", datos[i + 2:i + 4])[0]
+        if marcador in _MARCADORES_SOF:
+            if i + 9 > n:
+                break
+            alto, ancho = struct.unpack(">HH", datos[i + 5:i + 9])
+            return ancho, alto
+        i += 2 + longitud
+    raise ValueError("No se encontraron las dimensiones en la cabecera JPEG")
+
+
+def _dimensiones_png(datos):
+    if len(datos) < 24 or datos[12:16] != b"IHDR":
+        raise ValueError("Cabecera PNG no válida")
+    return struct.unpack(">II", datos[16:24])
+
+
+def _dimensiones_gif(datos):
+    if len(datos) < 10:
+        raise ValueError("Cabecera GIF no válida")
+    return struct.unpack("<HH", datos[6:10])
+
+
+def _dimensiones_bmp(datos):
+    if len(datos) < 26:
+        raise ValueError("Cabecera BMP no válida")
+    tamano_dib = struct.unpack("<I", datos[14:18])[0]
+    if tamano_dib == 12:
+        return struct.unpack("<HH", datos[18:22])
+    ancho, alto = struct.unpack("<ii", datos[18:26])
+    return abs(ancho), abs(alto)
+
+
+def _dimensiones_webp(datos):
+    if len(datos) < 30:
+        raise ValueError("Cabecera WEBP no válida")
+    bloque = datos[12:16]
+    if bloque == b"VP8 ":
+        ancho, alto = struct.unpack("<HH", datos[26:30])
+        return ancho & 0x3FFF, alto & 0x3FFF
+    if bloque == b"VP8L":
+        bits = struct.unpack("<I", datos[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if bloque == b"VP8X":
+        ancho = int.from_bytes(datos[24:27], "little") + 1
+        alto = int.from_bytes(datos[27:30], "little") + 1
+        return ancho, alto
+    raise ValueError("Cabecera WEBP no válida")
+
+
+_LECTORES = {
+    "jpeg": _dimensiones_jpeg,
+    "png": _dimensiones_png,
+    "gif": _dimensiones_gif,
+    "bmp": _dimensiones_bmp,
+    "webp": _dimensiones_webp,
+}
+
+
+def leer_cabecera(datos):
+    """
+    Lee el formato y las dimensiones de una imagen sin decodificarla.
+
+    :param datos: Bytes del archivo
+    :return: Tupla (formato, ancho, alto)
+    :raises ValueError: Si el formato no se reconoce o la cabecera no es válida
+    """
+    formato = detectar_formato(datos)
+    if formato is None:
+        raise ValueError("Formato de imagen no reconocido")
+    ancho, alto = _LECTORES[formato](datos)
+    if ancho <= 0 or alto <= 0:
+        raise ValueError("Dimensiones de imagen no válidas")
+    return formato, ancho, alto
+
+
+def validar(datos, max_bytes=None, max_pixeles=None):
+    """
+    Valida una imagen sin decodificarla: tamaño, bytes mágicos y número de píxeles.
+
+    :param datos: Bytes del archivo
+    :param max_bytes: Tamaño máximo del archivo (por defecto MAX_BYTES)
+    :param max_pixeles: Número máximo de píxeles (por defecto MAX_PIXELES)
+    :return: Tupla (formato, ancho, alto)
+    :raises ValueError: Si la imagen no es válida
+    """
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    max_pixeles = MAX_PIXELES if max_pixeles is None else max_pixeles
+
+    if len(datos) == 0:
+        raise ValueError("El archivo está vacío")
+    if len(datos) > max_bytes:
+        raise ValueError(f"El tamaño del archivo excede el límite de {max_bytes / (1024 * 1024):g}MB")
+
+    try:
+        formato, ancho, alto = leer_cabecera(datos)
+    except (ValueError, struct.error) as e:
+        raise ValueError(f"Archivo de imagen no válido: {str(e)}")
+
+    if ancho * alto > max_pixeles:
+        raise ValueError(
+            f"La imagen tiene demasiados píxeles ({ancho}x{alto}); "
+            f"el límite es {max_pixeles / 1_000_000:g} megapíxeles"
+        )
+    return formato, ancho, alto
+
+
+def decodificar(datos, max_bytes=None, max_pixeles=None, flags=cv2.IMREAD_COLOR):
+    """
+    Valida la imagen a partir de su cabecera y la decodifica una sola vez.
+
+    :param datos: Bytes del archivo
+    :param max_bytes: Tamaño máximo del archivo (por defecto MAX_BYTES)
+    :param max_pixeles: Número máximo de píxeles (por defecto MAX_PIXELES)
+    :param flags: Flags de cv2.imdecode
+    :return: Imagen decodificada (numpy array)
+    :raises ValueError: Si la imagen no es válida o no se puede decodificar
+    """
+    validar(datos, max_bytes, max_pixeles)
+    img_np = cv2.imdecode(np.frombuffer(datos, np.uint8), flags)
+    if img_np is None or img_np.size == 0:
+        raise ValueError("Archivo de imagen no válido: No se puede leer la imagen")
+    return img_np